@@ -0,0 +1,1300 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Micro-benchmarks for the python P2P test framework.
+
+Runs offline against synthetic data, no bitcoind/komodod or nspv needed:
+
+    ./p2pbench.py parse --txs 4000 --rounds 10
+    ./p2pbench.py serialize
+    ./p2pbench.py memory --txs 10000
+    ./p2pbench.py lazy
+    ./p2pbench.py hashes
+    ./p2pbench.py revalidate
+    ./p2pbench.py headers
+    ./p2pbench.py merkle --sizes 1000,10000,100000
+    ./p2pbench.py equihash
+    ./p2pbench.py sapling
+    ./p2pbench.py p2p --peers 1,50,500 --messages 20000
+    ./p2pbench.py recv --blocks 50 --block-mb 1
+    ./p2pbench.py send --blocks 50 --messages 20000
+    ./p2pbench.py lock --peers 50 --messages 20000
+    ./p2pbench.py dispatch --messages 200000
+    ./p2pbench.py sync --messages 200
+    ./p2pbench.py pipeline --blocks 20 --txs 4000
+    ./p2pbench.py replay --blocks 50
+    ./p2pbench.py metrics --peers 50 --blocks 20
+    ./p2pbench.py store --blocks 50000
+    ./p2pbench.py index --blocks 20000
+    ./p2pbench.py load --blocks 100000
+    ./p2pbench.py fixture --blocks 10000
+
+The p2p benchmark starts a local listener in a child process and measures
+ping/pong round trips per second through NodeConn and AsyncNodeConn; recv
+streams large block messages from a child process into each and reports
+the CPU time spent per MB received; send floods a child process with
+block and inv messages from the test thread.  lock runs the p2p ping
+load with a test thread per peer checking its peer's state (and doing
+some I/O) under mininode_lock or under the peer's own NodeConnCB.lock.
+dispatch calls NodeConnCB.deliver() directly with inv and headers
+messages, with one handler per command and with three (fan-out).  sync
+times sync_with_ping() and a ping followed by wait_until() over one
+connection.  pipeline measures ping latency on one connection while
+another receives a flood of blocks, with the messages decoded on the
+network thread and in a ReceivePipeline.  replay writes a synthetic
+capture of blocks, headers, inv and ping messages and parses it back
+through got_data() (see p2preplay.py for real captures).  metrics runs
+dispatch, recv and p2p loads with the connection metrics off, on, and on
+with deliver times, then prints the per command counts and latencies they
+recorded.  store inserts
+and looks up --blocks block-sized records in the blockstore's RecordStore
+(with and without fsync batching) and in dbm.dumb, which it replaced, and
+reports the cost per record as the store grows.  index fills a BlockStore
+with a chain of --blocks blocks and times get_locator() and headers_for()
+answering a 2000-header getheaders from the middle of the chain, then
+times add_header() extending the chain, and racing two branches so the
+best tip of the ChainState reorgs every other header.  load generates a
+chain of --blocks synthetic blocks with a coinbase and loads it into a
+BlockStore one add_block() at a time and with add_blocks().  fixture
+generates a chain fixture of --blocks blocks, then times opening it,
+decoding its blocks and loading them with their transactions into a
+BlockStore and TxStore.
+"""
+
+import argparse
+import dbm.dumb
+import gc
+import multiprocessing
+import os
+import random
+import socket
+import struct
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from io import BytesIO
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import (
+    COIN,
+    SAPLING_VERSION_GROUP_ID,
+    BytesReader,
+    CBlock,
+    CBlockHeader,
+    CBlockLocator,
+    CInv,
+    CKomodoBlockHeader,
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxOut,
+    AsyncNetworkThread,
+    AsyncNodeConn,
+    NetworkThread,
+    NodeConn,
+    NodeConnBase,
+    NodeConnCB,
+    ReceivePipeline,
+    listen,
+    mininode_lock,
+    msg_block,
+    msg_generic,
+    msg_headers,
+    msg_inv,
+    msg_ping,
+    ser_compact_size,
+    uint256_from_compact,
+    wait_until,
+)
+from test_framework import headerbatch
+from test_framework.equihash import EquihashVerifier
+from test_framework.headerbatch import HeaderBatch, KomodoHeaderBatch, MEDIAN_TIME_SPAN
+from test_framework.merkle import MerkleTree, PartialMerkleTree, verify_branch
+from test_framework.p2pcapture import RECEIVED, CaptureReader, CaptureWriter, ReplayConn, replay_into
+from test_framework.blockstore import BlockStore, RecordStore, TxStore
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.chainfixture import ChainFixture, generate_chain
+from test_framework.script import CScript, OP_RETURN, OverwinterSignatureHash
+
+# A Komodo asset chain header with a valid Equihash solution (from the
+# txproof test vectors in src/merkle_c.c)
+KMD_HEADER = bytes.fromhex(
+    "04000000e99a161138c314476f8bb68ed07ff5486f10df9ed551c718e9a1b614ffe06a05"
+    "3e2f28dc66f8ca00fc38d1bf25ecc696ce0718574bdbad796dcefe84a42f31fffbc2f430"
+    "0c01f0b7820d00e3347c8da4ee614674376cbc45359daa54f9b5493e1a54335da0900720"
+    "05003f58e1e6ce2c678b46888dc937875ac55892274ec1a111da86cb71bf0000fd400501"
+    "06155f02cb18316a74b240d92cf0cacf953b42a01463fdf1135919edb380c284585a6ad8"
+    "e8386e2a561157040caef35455d7473551f2dfebdd9c9b9f79dc14b5a8fad84a623c6f72"
+    "286953ed5bd6b129d786e0041d03efbf96c1618cd7504cdcdfd97d1b1fdfe4f619549f1d"
+    "4e26d3ef4fe013598334ed81035e91c9730ddf9dde37a8d583ab380157c21d837d88322d"
+    "19a3513475edcadfe12dab9727f892422be6b1c5f859e20420802de949f00394d980b86a"
+    "af5e6570462c5ecc09fcdb5521c2daf19e74e3a6127b3e575bc79fa30513996cdf0ea620"
+    "5bf8252306ee7d35322edab4d7b81b4df5690c9316319777a2a7f6527c5e6201b460030c"
+    "f202ff39c9ad44f12fc10a87e5a1d8e72e4af3a9203562122ff7f687f8951ae49860995f"
+    "13e81c26af15b3a78dea88b7f793c79265cefc2208a90a5d899b300a4a6771a6dc5d49d9"
+    "a5aa9de165858d8a8d10930258a8922191e784e22bf64b3a4c5d828c13b694b81bdf2b0f"
+    "0de09909d5eb02cc3fdcc0f97330f7e5320d8e9d3e386569632d9031d71afeb81a020799"
+    "fe4f21022f7b155e65ff5a756376e639a01ad0bb1a320e0ddbd98977493079de76558982"
+    "32d09b1d327ef913161d0c7fbde59e333131e2acbbb76b752eaef038630e6629642cb306"
+    "91ba864c583065564f45b4be40ea3df7f7be1c2bdb35f0c8841955ab7bbed56196d4b507"
+    "cf641f4446abfd95dac223db33510d8cf5b66f561b559f066de5fe2ff80301c3f027d10c"
+    "760b4a254f16ff23d9654622ff5b3051a738632a19ffeed645031dc271a7ec109ce6bbdf"
+    "e9c3655e434277fabbf6400864935a738b0baaa109cacff9642b22fab797ffe75473dc29"
+    "60ae6c35fb8846b6de7204779645dd0e3e177c515cae334345f40f662d43c6bb9692beba"
+    "40ed34cd56d9639f318d1a114565326678ba0671dd7c3903a3e8bc134462b1057da116cb"
+    "c8be0d6040f91f452815696fc8699d757bd657119ac83ef2f7fad9e3660934522c168633"
+    "3434f1a2a0a1b2ea9ecb7e57333813dff7d9105cc57d952e36cd165ff9e232b1581ce505"
+    "1df9f1654e79af63cfb10e2aafbe61b64b54310e0d9c3b169f5f041b48e96abd79de8fb7"
+    "ca8ddf933205abeae5a69ca9df4fcca0cc4c95680833ab4281e120ca6c61ce1abfa34f17"
+    "02a27ca0198dd255d85c6503e8ceb206d902c3f15241b6b7c7f75ca6844a269e05fa88a7"
+    "db928524b2de12b5b7f39f82bc16f739c0168ebb5f12cc48c4e8ebe48c5e73503dbccfef"
+    "a6a72cacf71465937814d730a3982cf24595921c3cb7d81b09f2ffb79735e0f83443bd97"
+    "d3d0e8f0f2edbb9f1ce9434cb46360bb5e2b177887f927fe6f5c1f032d2b0e2490161fab"
+    "0da76784329e5566d5fdd5dd61e2602c6c3264b3ed01ffae9883e6dde4ebd4485f74db04"
+    "0f477d7fe38cb1b8933653fd71be31db85f3f74d283d87ed0a67d48db4a1240eac7f1981"
+    "2ceeb02b633ae293bb3aefcbffb59403eddc2747425379ffde7d477fea42b3eb851f869f"
+    "55977c5c8bb29d19be595b1011fccaec51a0a764fd97b74cdf512a7b617a8ca11844e774"
+    "eb8b29db9057760a06d62401f9fc1f78a11c42e5fb9f578698d631c33f22d5f2ade1f79d"
+    "87d03172bd6e9d19fed7e9d514dea678d205a7e7d06a8411a93f10596429ff98b0d4c3aa"
+    "be280ecfddb720392958bfb879ea1e5dc712f3cc29bc34b960b63c1add3c382b78c46b50"
+    "ffaa59d6d275c075420c6f9232025772d3026bb463f9bc63fc6325e52d8f20a1be091415"
+    "24e4ac6c05cfa9b381d20f5cb052e0ca20fe637d6642b3cae33d035bf68f89e7dcf0691b"
+    "61957f725a29f6124e98cbad3ac11a95d615c147aa0a20d2e01757609d2ed5aab9cdb71f"
+    "d653dcbea082a329fdc763")
+
+
+def make_block(num_txs, seed=1):
+    """Build a block of 2-in/2-out P2PKH-sized transactions (~370 bytes each)."""
+    rng = random.Random(seed)
+    block = create_block(rng.getrandbits(256), create_coinbase(1), 1500000000)
+    for i in range(num_txs):
+        tx = CTransaction()
+        for n in range(2):
+            tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), n), os.urandom(107), 0xffffffff))
+        for n in range(2):
+            tx.vout.append(CTxOut(rng.randrange(1, 10**8), os.urandom(25)))
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    return block
+
+
+def make_large_block(num_txs=14):
+    """Offline equivalent of util.mine_large_block: 14 ~66 kB transactions
+    padded with 128 OP_RETURN outputs each, close to the 1 MB limit."""
+    padding = CScript([OP_RETURN, b"\x01" * 512])
+    block = create_block(1, create_coinbase(1), 1500000000)
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(i + 1, 0), os.urandom(107), 0xffffffff))
+        tx.vout = [CTxOut(0, padding) for n in range(128)]
+        tx.vout.append(CTxOut(49 * COIN, os.urandom(25)))
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    return block
+
+
+def make_sapling_block(num_txs, seed=1):
+    """Build a block of v4 transactions: 1 transparent input and output,
+    and (every other tx) a shielded spend and 2 shielded outputs."""
+    rng = random.Random(seed)
+    block = create_block(rng.getrandbits(256), create_coinbase(1), 1500000000)
+    for i in range(num_txs):
+        tx = CTransaction()
+        tx.fOverwintered = True
+        tx.nVersion = 4
+        tx.nVersionGroupId = SAPLING_VERSION_GROUP_ID
+        tx.nExpiryHeight = 1000
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0), os.urandom(107), 0xffffffff))
+        tx.vout.append(CTxOut(rng.randrange(1, 10**8), os.urandom(25)))
+        if i % 2:
+            tx.vShieldedSpend = [os.urandom(384)]
+            tx.vShieldedOutput = [os.urandom(948), os.urandom(948)]
+            tx.bindingSig = os.urandom(64)
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    return block
+
+
+def timed(func, rounds):
+    """Return the best wall time of func() over rounds runs."""
+    best = float('inf')
+    for i in range(rounds):
+        gc.collect()
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def report(name, seconds, size=None):
+    line = "%-28s %10.3f ms" % (name, seconds * 1000)
+    if size is not None:
+        line += " %10.1f MB/s" % (size / seconds / 1e6)
+    print(line)
+
+
+# The stream parsing mininode.py did before BytesReader, kept as the
+# baseline of the parse benchmark: every field is a f.read() and a
+# struct.unpack(), and uint256s are read as 8 uint32s.
+
+def legacy_deser_compact_size(f):
+    nit = struct.unpack("<B", f.read(1))[0]
+    if nit == 253:
+        nit = struct.unpack("<H", f.read(2))[0]
+    elif nit == 254:
+        nit = struct.unpack("<I", f.read(4))[0]
+    elif nit == 255:
+        nit = struct.unpack("<Q", f.read(8))[0]
+    return nit
+
+
+def legacy_deser_string(f):
+    nit = legacy_deser_compact_size(f)
+    return f.read(nit)
+
+
+def legacy_deser_uint256(f):
+    r = 0
+    for i in range(8):
+        t = struct.unpack("<I", f.read(4))[0]
+        r += t << (i * 32)
+    return r
+
+
+def legacy_deser_vector(f, c):
+    nit = legacy_deser_compact_size(f)
+    r = []
+    for i in range(nit):
+        t = c()
+        t.deserialize(f)
+        r.append(t)
+    return r
+
+
+class LegacyOutPoint(object):
+    def deserialize(self, f):
+        self.hash = legacy_deser_uint256(f)
+        self.n = struct.unpack("<I", f.read(4))[0]
+
+
+class LegacyTxIn(object):
+    def deserialize(self, f):
+        self.prevout = LegacyOutPoint()
+        self.prevout.deserialize(f)
+        self.scriptSig = legacy_deser_string(f)
+        self.nSequence = struct.unpack("<I", f.read(4))[0]
+
+
+class LegacyTxOut(object):
+    def deserialize(self, f):
+        self.nValue = struct.unpack("<q", f.read(8))[0]
+        self.scriptPubKey = legacy_deser_string(f)
+
+
+class LegacyTransaction(object):
+    def deserialize(self, f):
+        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.vin = legacy_deser_vector(f, LegacyTxIn)
+        flags = 0
+        if len(self.vin) == 0:
+            flags = struct.unpack("<B", f.read(1))[0]
+            if flags != 0:
+                self.vin = legacy_deser_vector(f, LegacyTxIn)
+                self.vout = legacy_deser_vector(f, LegacyTxOut)
+        else:
+            self.vout = legacy_deser_vector(f, LegacyTxOut)
+        if flags != 0:
+            self.wit = [[legacy_deser_string(f) for n in range(legacy_deser_compact_size(f))]
+                        for i in range(len(self.vin))]
+        self.nLockTime = struct.unpack("<I", f.read(4))[0]
+        self.sha256 = None
+        self.hash = None
+
+
+class LegacyBlock(object):
+    def deserialize(self, f):
+        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.hashPrevBlock = legacy_deser_uint256(f)
+        self.hashMerkleRoot = legacy_deser_uint256(f)
+        self.nTime = struct.unpack("<I", f.read(4))[0]
+        self.nBits = struct.unpack("<I", f.read(4))[0]
+        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        self.sha256 = None
+        self.hash = None
+        self.vtx = legacy_deser_vector(f, LegacyTransaction)
+
+
+def bench_parse(args):
+    block = make_block(args.txs)
+    payload = block.serialize()
+    print("block: %d txs, %d bytes" % (args.txs + 1, len(payload)))
+
+    def parse_reader():
+        msg_block().deserialize(BytesReader(payload))
+
+    def parse_legacy():
+        LegacyBlock().deserialize(BytesIO(payload))
+
+    legacy = LegacyBlock()
+    legacy.deserialize(BytesIO(payload))
+    assert [tx.vout[0].nValue for tx in legacy.vtx] == [tx.vout[0].nValue for tx in block.vtx]
+
+    report("parse (BytesReader)", timed(parse_reader, args.rounds), len(payload))
+    report("parse (baseline, BytesIO)", timed(parse_legacy, args.rounds), len(payload))
+
+
+def bench_lazy(args):
+    block = make_block(args.txs)
+    payload = block.serialize()
+    print("block: %d txs, %d bytes" % (len(block.vtx), len(payload)))
+
+    def header_only():
+        CBlockHeader().deserialize(BytesReader(payload))
+
+    def read_block(lazy):
+        b = CBlock()
+        b.deserialize(BytesReader(payload), lazy)
+        return b
+
+    def merkle_check(lazy):
+        assert read_block(lazy).calc_merkle_root() == block.hashMerkleRoot
+
+    report("header only", timed(header_only, args.rounds))
+    report("read block (eager)", timed(lambda: read_block(False), args.rounds))
+    report("read block (lazy)", timed(lambda: read_block(True), args.rounds))
+    report("merkle check (eager)", timed(lambda: merkle_check(False), args.rounds))
+    report("merkle check (lazy)", timed(lambda: merkle_check(True), args.rounds))
+
+
+def bench_revalidate(args):
+    block = make_block(args.txs)
+    block.solve()
+    assert block.is_valid()
+    print("block: %d txs" % len(block.vtx))
+    report("block.is_valid()", timed(block.is_valid, args.rounds))
+    report("block.calc_merkle_root()", timed(block.calc_merkle_root, args.rounds))
+    report("block.serialize()", timed(block.serialize, args.rounds))
+
+
+def bench_serialize(args):
+    for name, block in (("mine_large_block", make_large_block()),
+                        ("%d small txs" % args.txs, make_block(args.txs))):
+        size = len(block.serialize())
+        print("%s: %d txs, %d bytes" % (name, len(block.vtx), size))
+        report("serialize", timed(block.serialize, args.rounds), size)
+
+
+def bench_hashes(args):
+    rng = random.Random(1)
+    inv = msg_inv([CInv(2, rng.getrandbits(256)) for i in range(50000)])
+    payload = inv.serialize()
+    print("msg_inv: %d entries, %d bytes" % (len(inv.inv), len(payload)))
+
+    def parse_inv():
+        m = msg_inv()
+        m.deserialize(BytesReader(payload))
+        return m
+
+    parsed = parse_inv()
+    report("parse inv", timed(parse_inv, args.rounds), len(payload))
+    report("serialize parsed inv", timed(parsed.serialize, args.rounds), len(payload))
+
+    headers = msg_headers()
+    headers.deserialize(BytesReader(make_headers(2000)))
+
+    def rehash_headers():
+        for header in headers.headers:
+            header.rehash()
+
+    report("rehash 2000 headers", timed(rehash_headers, args.rounds))
+
+
+def make_headers(count, seed=1):
+    """Serialized msg_headers payload for a chain of count headers."""
+    rng = random.Random(seed)
+    headers = msg_headers()
+    prev = rng.getrandbits(256)
+    for height in range(count):
+        header = CBlockHeader()
+        header.hashPrevBlock = prev
+        header.hashMerkleRoot = rng.getrandbits(256)
+        header.nTime = 1500000000 + height * 600
+        header.nBits = 0x207fffff
+        header.nNonce = rng.getrandbits(32)
+        header.rehash()
+        while header.sha256 > uint256_from_compact(header.nBits):
+            header.nNonce += 1
+            header.rehash()
+        headers.headers.append(header)
+        prev = header.sha256
+    return headers.serialize()
+
+
+def bench_headers(args):
+    payload = make_headers(2000)
+    count = 2000
+
+    def per_header():
+        m = msg_headers()
+        m.deserialize(BytesReader(payload))
+        times = []
+        prev = None
+        for header in m.headers:
+            header.rehash()
+            assert prev is None or header.hashPrevBlock == prev
+            assert header.sha256 <= uint256_from_compact(header.nBits)
+            assert not times or header.nTime > sorted(times[-MEDIAN_TIME_SPAN:])[len(times[-MEDIAN_TIME_SPAN:]) // 2]
+            times.append(header.nTime)
+            prev = header.sha256
+
+    def batch():
+        assert HeaderBatch.from_headers_payload(payload).is_valid()
+
+    def batch_python():
+        numpy = headerbatch.numpy
+        headerbatch.numpy = None
+        try:
+            batch()
+        finally:
+            headerbatch.numpy = numpy
+
+    print("msg_headers: %d headers, %d bytes" % (count, len(payload)))
+    for name, func in (("CBlockHeader per header", per_header),
+                       ("HeaderBatch (python)", batch_python),
+                       ("HeaderBatch (numpy)", batch)):
+        if name.endswith("(numpy)") and headerbatch.numpy is None:
+            print("%-28s numpy not installed" % name)
+            continue
+        seconds = timed(func, args.rounds)
+        print("%-28s %10.3f ms %10.0f headers/s" % (name, seconds * 1000, count / seconds))
+
+
+def bench_merkle(args):
+    rng = random.Random(1)
+    for count in args.sizes:
+        leaves = [rng.getrandbits(256).to_bytes(32, 'little') for i in range(count)]
+        picks = rng.sample(range(count), min(100, count))
+        tree = MerkleTree(leaves)
+        root = tree.calc_merkle_root()
+        print("%d leaves" % count)
+
+        def append_one():
+            tree.append(os.urandom(32))
+            tree.root()
+
+        def branches():
+            for index, branch in zip(picks, tree.get_branches(picks)):
+                assert verify_branch(leaves[index], branch, index, root)
+
+        def partial_tree():
+            p = PartialMerkleTree()
+            p.deserialize(BytesReader(PartialMerkleTree.from_tree(tree, picks).serialize()))
+            assert p.extract_matches()[2] == sorted(picks)
+
+        report("  CBlock.get_merkle_root", timed(lambda: CBlock().get_merkle_root(leaves), args.rounds))
+        report("  MerkleTree build", timed(lambda: MerkleTree(leaves), args.rounds))
+        report("  %d branches + verify" % len(picks), timed(branches, args.rounds))
+        report("  %d-leaf partial tree" % len(picks), timed(partial_tree, args.rounds))
+        report("  append + root", timed(append_one, args.rounds))
+
+
+def bench_equihash(args):
+    count = 2000
+    payload = ser_compact_size(count) + (KMD_HEADER + b"\x00") * count
+    print("%d Komodo headers, %d bytes" % (count, len(payload)))
+
+    def parse():
+        f = BytesReader(payload)
+        f.read_compact_size()
+        for i in range(count):
+            CKomodoBlockHeader().deserialize(f)
+            f.read_compact_size()
+
+    def parse_batch():
+        KomodoHeaderBatch.from_headers_payload(payload).get_headers()
+
+    header = CKomodoBlockHeader()
+    header.deserialize(BytesReader(KMD_HEADER))
+
+    def serialize():
+        for i in range(count):
+            header.serialize()
+
+    def rehash():
+        for i in range(count):
+            header.rehash()
+
+    for name, func, n in (("parse", parse, count),
+                          ("parse (KomodoHeaderBatch)", parse_batch, count),
+                          ("serialize", serialize, count),
+                          ("hash", rehash, count)):
+        seconds = timed(func, args.rounds)
+        print("%-28s %10.3f ms %10.0f headers/s" % (name, seconds * 1000, n / seconds))
+
+    batch = KomodoHeaderBatch.from_headers_payload(ser_compact_size(200) + (KMD_HEADER + b"\x00") * 200)
+    seconds = timed(lambda: batch.first_invalid_solution(), 1)
+    print("%-28s %10.3f ms %10.0f headers/s" % ("Equihash, 1 process", seconds * 1000, 200 / seconds))
+    batch = KomodoHeaderBatch.from_headers_payload(payload)
+    with EquihashVerifier() as verifier:
+        # start the workers
+        verifier.verify_headers([KMD_HEADER] * verifier.processes)
+        seconds = timed(lambda: batch.first_invalid_solution(verifier), 1)
+        print("%-28s %10.3f ms %10.0f headers/s" % ("Equihash, %d processes" % verifier.processes,
+                                                    seconds * 1000, count / seconds))
+
+
+def bench_sapling(args):
+    block = make_sapling_block(args.txs)
+    payload = block.serialize()
+    print("block: %d v4 txs, %d bytes" % (args.txs, len(payload)))
+
+    def parse():
+        b = msg_block()
+        b.deserialize(BytesReader(payload))
+        return b
+
+    def parse_all():
+        b = parse()
+        for tx in b.block.vtx:
+            tx.nVersion
+
+    def rehash_all():
+        for tx in parse().block.vtx:
+            tx.rehash()
+
+    report("parse block", timed(parse, args.rounds), len(payload))
+    report("parse block + every tx", timed(parse_all, args.rounds), len(payload))
+    report("parse + rehash every tx", timed(rehash_all, args.rounds), len(payload))
+    block = parse().block
+    report("serialize block", timed(block.serialize, args.rounds), len(payload))
+
+    script = CScript(os.urandom(25))
+    txs = block.vtx[1:]
+
+    def sighash():
+        for tx in txs:
+            OverwinterSignatureHash(script, tx, 0, 1, 10**8)
+
+    seconds = timed(sighash, args.rounds)
+    report("ZIP 243 sighash", seconds)
+    print("%28s %10.0f sighashes/s" % ("", len(txs) / seconds))
+
+
+class PingPeer(NodeConnCB):
+    """Keeps `window` pings in flight until `quota` pongs came back."""
+
+    def __init__(self, quota, window, done):
+        super().__init__()
+        self.quota = quota
+        self.window = window
+        self.done = done
+        self.sent = 0
+        self.received = 0
+
+    def start(self):
+        for i in range(min(self.window, self.quota)):
+            self.sent += 1
+            self.send_message(msg_ping(self.sent))
+
+    def on_pong(self, conn, message):
+        self.received += 1
+        if self.sent < self.quota:
+            self.sent += 1
+            conn.send_message(msg_ping(self.sent))
+        elif self.received == self.quota:
+            self.done.release()
+
+
+def run_listener(port):
+    listen("127.0.0.1", port, NodeConnCB)
+    AsyncNetworkThread().run()
+
+
+def ping_round_trips(conn_class, thread_class, port, peers, messages, window=10, observer=None):
+    done = threading.Semaphore(0)
+    quota = max(messages // peers, 1)
+    callbacks = []
+    start = time.perf_counter()
+    for i in range(peers):
+        callback = PingPeer(quota, window, done)
+        callback.add_connection(conn_class("127.0.0.1", port, None, callback))
+        callbacks.append(callback)
+    thread = thread_class()
+    thread.start()
+    for callback in callbacks:
+        callback.wait_for_verack()
+    connect_seconds = time.perf_counter() - start
+    observers = []
+    stop = threading.Event()
+    if observer is not None:
+        for callback in callbacks:
+            observers.append(threading.Thread(target=observer, args=(callback, stop)))
+            observers[-1].start()
+    start = time.perf_counter()
+    for callback in callbacks:
+        callback.start()
+    for callback in callbacks:
+        done.acquire()
+    seconds = time.perf_counter() - start
+    stop.set()
+    for observer_thread in observers:
+        observer_thread.join()
+    for callback in callbacks:
+        callback.connection.disconnect_node()
+    thread.join()
+    return connect_seconds, quota * peers, seconds
+
+
+def poll_under(lock_of, hold=0.0005, interval=0.002):
+    """A test thread checking a callback's state every `interval` seconds,
+    holding the lock for `hold` seconds of blocking I/O each time (as a
+    test does when it makes an RPC call under the lock)."""
+    def observer(callback, stop):
+        lock = lock_of(callback)
+        while not stop.is_set():
+            with lock:
+                callback.received
+                time.sleep(hold)
+            time.sleep(interval)
+    return observer
+
+
+def bench_lock(args):
+    port = 20000 + os.getpid() % 10000
+    listener = multiprocessing.get_context("fork").Process(target=run_listener, args=(port,), daemon=True)
+    listener.start()
+    time.sleep(0.5)
+    modes = [("no polling", None),
+             ("mininode_lock", poll_under(lambda callback: mininode_lock))]
+    if hasattr(NodeConnCB(), "lock"):
+        modes.append(("NodeConnCB.lock", poll_under(lambda callback: callback.lock)))
+    try:
+        for peers in args.peers:
+            for conn_name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                                        ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+                for mode, observer in modes:
+                    connect, count, seconds = ping_round_trips(conn_class, thread_class, port, peers,
+                                                               args.messages, observer=observer)
+                    print("%-14s %5d peers  %-16s %10.0f round trips/s"
+                          % (conn_name, peers, mode, count / seconds))
+    finally:
+        listener.terminate()
+
+
+def bench_sync(args):
+    port = 20000 + os.getpid() % 10000
+    listener = multiprocessing.get_context("fork").Process(target=run_listener, args=(port,), daemon=True)
+    listener.start()
+    time.sleep(0.5)
+    try:
+        for conn_name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                                    ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+            callback = NodeConnCB()
+            callback.add_connection(conn_class("127.0.0.1", port, None, callback))
+            thread = thread_class()
+            thread.start()
+            callback.wait_for_verack()
+
+            def ping_and_wait():
+                nonce = callback.ping_counter
+                callback.ping_counter += 1
+                callback.send_message(msg_ping(nonce))
+                wait_until(lambda: callback.last_pong.nonce == nonce, timeout=60)
+
+            for name, sync in (("sync_with_ping()", callback.sync_with_ping),
+                               ("wait_until(mininode_lock)", ping_and_wait)):
+                start = time.perf_counter()
+                for i in range(args.messages):
+                    sync()
+                seconds = time.perf_counter() - start
+                print("%-14s %-26s %8.3f ms" % (conn_name, name, seconds * 1000 / args.messages))
+            callback.connection.disconnect_node()
+            thread.join()
+    finally:
+        listener.terminate()
+
+
+class MessageCounter(NodeConnCB):
+    def __init__(self):
+        super().__init__()
+        self.received = 0
+
+    def on_inv(self, conn, message):
+        self.received += 1
+
+    def on_headers(self, conn, message):
+        self.received += 1
+
+
+def bench_dispatch(args):
+    messages = [msg_inv([CInv(2, 1)]), msg_headers()] * (args.messages // 2)
+    modes = [("1 handler", 0)]
+    if hasattr(NodeConnCB, "add_handler"):
+        modes.append(("3 handlers (fan-out)", 2))
+    for name, extra in modes:
+        callback = MessageCounter()
+        counts = [0] * extra
+        for i in range(extra):
+            def count(conn, message, i=i):
+                counts[i] += 1
+            callback.add_handler(b"inv", count)
+            callback.add_handler(b"headers", count)
+
+        def run():
+            deliver = callback.deliver
+            for message in messages:
+                deliver(None, message)
+        seconds = timed(run, args.rounds)
+        assert callback.received == len(messages) * args.rounds
+        assert counts == [len(messages) * args.rounds] * extra
+        print("%-28s %10.0f msgs/s" % (name, len(messages) / seconds))
+
+
+def bench_p2p(args):
+    port = 20000 + os.getpid() % 10000
+    listener = multiprocessing.get_context("fork").Process(target=run_listener, args=(port,), daemon=True)
+    listener.start()
+    time.sleep(0.5)
+    try:
+        for peers in args.peers:
+            for name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                                   ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+                connect, count, seconds = ping_round_trips(conn_class, thread_class, port, peers, args.messages)
+                print("%-14s %5d peers  connect %8.1f ms %10.0f round trips/s"
+                      % (name, peers, connect * 1000, count / seconds))
+    finally:
+        listener.terminate()
+
+
+class BlockCounter(NodeConnCB):
+    def __init__(self, count, done):
+        super().__init__()
+        self.count = count
+        self.done = done
+
+    def on_block(self, conn, message):
+        self.count -= 1
+        if self.count == 0:
+            self.done.release()
+
+
+def run_sender(sock, stream):
+    conn, addr = sock.accept()
+    conn.sendall(stream)
+    # Wait for the receiver to hang up (closing with unread data would
+    # reset the connection)
+    while conn.recv(65536):
+        pass
+
+
+def receive_blocks(conn_class, thread_class, stream, count):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    sender = multiprocessing.get_context("fork").Process(target=run_sender, args=(sock, stream), daemon=True)
+    sender.start()
+    done = threading.Semaphore(0)
+    callback = BlockCounter(count, done)
+    conn = conn_class("127.0.0.1", sock.getsockname()[1], None, callback, send_version=False)
+    callback.add_connection(conn)
+    # The sender is another process, so this is the receiving side only
+    cpu = time.process_time()
+    wall = time.perf_counter()
+    thread = thread_class()
+    thread.start()
+    done.acquire()
+    cpu = time.process_time() - cpu
+    wall = time.perf_counter() - wall
+    conn.disconnect_node()
+    thread.join()
+    sender.join()
+    sock.close()
+    return cpu, wall
+
+
+def bench_recv(args):
+    block = make_large_block(14 * args.block_mb)
+    framer = NodeConnBase()
+    framer._init_state("127.0.0.1", 0, None, None, "regtest")
+    frame = framer._build_message(msg_block(block))
+    stream = frame * args.blocks
+    size = len(stream) / 1e6
+    print("%d block messages of %d bytes" % (args.blocks, len(frame)))
+    for name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                           ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+        cpu, wall = min(receive_blocks(conn_class, thread_class, stream, args.blocks)
+                        for i in range(args.rounds))
+        print("%-14s %8.2f ms CPU/MB %10.1f MB/s" % (name, cpu * 1000 / size, size / wall))
+
+
+def run_gated_sender(sock, stream, go):
+    conn, addr = sock.accept()
+    go.wait()
+    conn.sendall(stream)
+    while conn.recv(65536):
+        pass
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+def bench_pipeline(args):
+    block = make_block(args.txs)
+    framer = NodeConnBase()
+    framer._init_state("127.0.0.1", 0, None, None, "regtest")
+    frame = framer._build_message(msg_block(block))
+    stream = frame * args.blocks
+    size = len(stream) / 1e6
+    print("%d block messages of %d txs, %d bytes" % (args.blocks, args.txs + 1, len(frame)))
+    context = multiprocessing.get_context("fork")
+    port = 20000 + os.getpid() % 10000
+    listener = context.Process(target=run_listener, args=(port,), daemon=True)
+    listener.start()
+    time.sleep(0.5)
+    pipeline = ReceivePipeline()
+    try:
+        for name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                               ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+            for mode in ("inline", "pipelined"):
+                if mode == "pipelined":
+                    conn_class = type("Pipelined" + name, (conn_class,), {"pipeline": pipeline})
+                sock = socket.socket()
+                sock.bind(("127.0.0.1", 0))
+                sock.listen(1)
+                go = context.Event()
+                sender = context.Process(target=run_gated_sender, args=(sock, stream, go), daemon=True)
+                sender.start()
+                pinger = NodeConnCB()
+                pinger.add_connection(conn_class("127.0.0.1", port, None, pinger))
+                done = threading.Semaphore(0)
+                counter = BlockCounter(args.blocks, done)
+                counter.add_connection(conn_class("127.0.0.1", sock.getsockname()[1], None, counter,
+                                                  send_version=False))
+                thread = thread_class()
+                thread.start()
+                pinger.wait_for_verack()
+                go.set()
+                latencies = []
+                start = time.perf_counter()
+                while not done.acquire(blocking=False):
+                    t = time.perf_counter()
+                    pinger.sync_with_ping()
+                    latencies.append(time.perf_counter() - t)
+                wall = time.perf_counter() - start
+                print("%-14s %-10s %8.1f MB/s  ping p50 %7.2f ms  p99 %7.2f ms  max %7.2f ms"
+                      % (name, mode, size / wall, percentile(latencies, 0.5) * 1000,
+                         percentile(latencies, 0.99) * 1000, max(latencies) * 1000))
+                pinger.connection.disconnect_node()
+                counter.connection.disconnect_node()
+                thread.join()
+                sender.join()
+                sock.close()
+    finally:
+        pipeline.close()
+        listener.terminate()
+
+
+def bench_replay(args):
+    framer = NodeConnBase()
+    framer._init_state("127.0.0.1", 0, None, None, "regtest")
+    rng = random.Random(1)
+    frames = [framer._build_message(msg_block(make_block(args.txs))),
+              framer._build_message(msg_generic(b"headers", make_headers(2000)))]
+    frames += [framer._build_message(msg_inv([CInv(2, rng.getrandbits(256)) for j in range(10)]))
+               for i in range(100)]
+    frames += [framer._build_message(msg_ping(i)) for i in range(100)]
+    # Per block: the block, a headers message, 100 inv and 100 ping
+    session = frames * args.blocks
+    size = sum(len(frame) for frame in session)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "bench.p2pcap")
+        start = time.perf_counter()
+        with CaptureWriter(path) as capture:
+            for i, frame in enumerate(session):
+                capture.write(RECEIVED, framer, frame, timestamp=i * 1000000)
+        seconds = time.perf_counter() - start
+        print("%d messages, %d bytes" % (len(session), size))
+        print("%-28s %10.1f MB/s %10.0f msgs/s" % ("capture", size / seconds / 1e6, len(session) / seconds))
+        with CaptureReader(path) as reader:
+            records = reader.select(RECEIVED)
+
+            def replay():
+                assert replay_into(ReplayConn(NodeConnCB()), records) == size
+            seconds = timed(replay, args.rounds)
+            print("%-28s %10.1f MB/s %10.0f msgs/s" % ("replay (got_data)", size / seconds / 1e6,
+                                                        len(session) / seconds))
+            del records
+
+
+def bench_metrics(args):
+    registry = NodeConnBase.metrics
+    if registry is None:
+        print("no metrics in this tree")
+        return
+    messages = [msg_inv([CInv(2, 1)]), msg_headers()] * (args.messages // 2)
+    block = make_large_block(14 * args.block_mb)
+    framer = NodeConnBase()
+    framer._init_state("127.0.0.1", 0, None, None, "regtest")
+    stream = framer._build_message(msg_block(block)) * args.blocks
+    size = len(stream) / 1e6
+    port = 20000 + os.getpid() % 10000
+    listener = multiprocessing.get_context("fork").Process(target=run_listener, args=(port,), daemon=True)
+    listener.start()
+    time.sleep(0.5)
+    try:
+        for mode, metrics, deliver_times in (("metrics off", None, False), ("metrics on", registry, False),
+                                             ("+ deliver", registry, True)):
+            NodeConnBase.metrics = metrics
+            registry.time_deliver(deliver_times)
+            registry.reset()
+            conn = NodeConnBase()
+            conn._init_state("127.0.0.1", 0, None, None, "regtest")
+            callback = MessageCounter()
+
+            def run():
+                deliver = callback.deliver
+                for message in messages:
+                    deliver(conn, message)
+            seconds = timed(run, args.rounds)
+            print("%-12s dispatch %10.0f msgs/s" % (mode, len(messages) / seconds))
+            for name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                                   ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+                cpu, wall = min(receive_blocks(conn_class, thread_class, stream, args.blocks)
+                                for i in range(args.rounds))
+                connect, count, seconds = ping_round_trips(conn_class, thread_class, port, args.peers[0],
+                                                           args.messages)
+                print("%-12s %-14s recv %8.2f ms CPU/MB  %d peers %10.0f round trips/s"
+                      % (mode, name, cpu * 1000 / size, args.peers[0], count / seconds))
+    finally:
+        NodeConnBase.metrics = registry
+        registry.time_deliver(False)
+        listener.terminate()
+    snapshot = registry.snapshot()
+    print("%d connections recorded, %d bytes of JSON"
+          % (len(snapshot["connections"]), len(registry.to_json())))
+    print("%-10s %9s %12s %12s %12s %12s" % ("command", "received", "bytes", "parse p50", "parse p99",
+                                              "deliver p50"))
+    for command, m in sorted(snapshot["commands"].items(), key=lambda item: -item[1]["parse"]["total"]):
+        if m["received"]:
+            print("%-10s %9d %12d %9.1f us %9.1f us %9.1f us"
+                  % (command, m["received"], m["received_bytes"], (m["parse"]["p50"] or 0) / 1000,
+                     (m["parse"]["p99"] or 0) / 1000, (m["deliver"]["p50"] or 0) / 1000))
+    pings = [c["ping"] for c in snapshot["connections"] if c["ping"]["count"]]
+    if pings:
+        print("ping round trip p50 %.1f us, p99 %.1f us over %d connections"
+              % (percentile([p["p50"] for p in pings], 0.5) / 1000,
+                 percentile([p["p99"] for p in pings], 0.5) / 1000, len(pings)))
+
+
+def run_sink(sock, expected, pipe):
+    conn, addr = sock.accept()
+    buf = bytearray(1 << 20)
+    received = 0
+    while received < expected:
+        n = conn.recv_into(buf)
+        if n == 0:
+            break
+        received += n
+    pipe.send((received, time.perf_counter()))
+    while conn.recv_into(buf):
+        pass
+
+
+def send_flood(conn_class, thread_class, messages):
+    framer = NodeConnBase()
+    framer._init_state("127.0.0.1", 0, None, None, "regtest")
+    expected = sum(len(framer._build_message(m)) for m in messages)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    parent, child = multiprocessing.get_context("fork").Pipe()
+    sink = multiprocessing.get_context("fork").Process(target=run_sink, args=(sock, expected, child), daemon=True)
+    sink.start()
+    callback = NodeConnCB()
+    conn = conn_class("127.0.0.1", sock.getsockname()[1], None, callback, send_version=False)
+    callback.add_connection(conn)
+    thread = thread_class()
+    thread.start()
+    while conn.state != "connected":
+        time.sleep(0.01)
+    cpu = time.process_time()
+    start = time.perf_counter()
+    for m in messages:
+        conn.send_message(m)
+    received, end = parent.recv()
+    cpu = time.process_time() - cpu
+    conn.disconnect_node()
+    thread.join()
+    sink.join()
+    sock.close()
+    assert received == expected
+    return expected, end - start, cpu
+
+
+def bench_store(args):
+    rng = random.Random(1)
+    # Records the size of a block with a few transactions
+    records = [(rng.getrandbits(256).to_bytes(32, "little"), os.urandom(rng.randrange(250, 2000)))
+               for i in range(args.blocks)]
+    steps = 5
+    chunk = len(records) // steps
+    stores = [
+        ("dbm.dumb", lambda path: dbm.dumb.open(path, "c")),
+        ("RecordStore", lambda path: RecordStore(path + ".dat")),
+        ("RecordStore sync_every=100", lambda path: RecordStore(path + ".dat", sync_every=100)),
+    ]
+    print("%d records, %d bytes; us per record as the store grows" % (len(records),
+                                                                      sum(len(v) for k, v in records)))
+    print("%-34s %s" % ("", " ".join("%9d" % (chunk * (i + 1)) for i in range(steps))))
+    for name, open_store in stores:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = open_store(os.path.join(tmpdir, "blocks"))
+            put = store.put if isinstance(store, RecordStore) else store.__setitem__
+            inserts = []
+            lookups = []
+            for step in range(steps):
+                batch = records[step * chunk:(step + 1) * chunk]
+                start = time.perf_counter()
+                for key, value in batch:
+                    put(key, value)
+                inserts.append((time.perf_counter() - start) / len(batch))
+                keys = [records[rng.randrange((step + 1) * chunk)][0] for i in range(chunk)]
+                start = time.perf_counter()
+                for key in keys:
+                    store.get(key)
+                lookups.append((time.perf_counter() - start) / len(keys))
+            start = time.perf_counter()
+            store.close()
+            closed = time.perf_counter() - start
+            print("%-34s %s" % (name + " insert", " ".join("%9.1f" % (t * 1e6) for t in inserts)))
+            print("%-34s %s" % (name + " lookup", " ".join("%9.1f" % (t * 1e6) for t in lookups)))
+            print("%-34s %9.1f ms" % (name + " close", closed * 1000))
+
+
+def bench_index(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = BlockStore(tmpdir)
+        hashes = []
+        blockhash = 0
+        start = time.perf_counter()
+        for height in range(args.blocks):
+            block = create_block(blockhash, create_coinbase(height), 1500000000 + height)
+            block.rehash()
+            store.add_block(block)
+            blockhash = block.sha256
+            hashes.append(blockhash)
+        seconds = time.perf_counter() - start
+        print("%d blocks" % args.blocks)
+        print("%-28s %10.1f us/block" % ("add_block", seconds / args.blocks * 1e6))
+        report("get_locator", timed(store.get_locator, args.rounds))
+        locator = CBlockLocator()
+        locator.vHave = [hashes[len(hashes) // 2]]
+        report("headers_for", timed(lambda: store.headers_for(locator, 0), args.rounds))
+
+        def make_header(parent, nonce):
+            header = CBlockHeader()
+            header.hashPrevBlock = parent.sha256
+            header.nTime = parent.nTime + 1
+            header.nBits = 0x207fffff
+            header.nNonce = nonce
+            header.rehash()
+            return header
+
+        headers = []
+        parent = store.get_header(blockhash)
+        for i in range(args.blocks):
+            parent = make_header(parent, 0)
+            headers.append(parent)
+        start = time.perf_counter()
+        for header in headers:
+            store.add_header(header)
+        seconds = time.perf_counter() - start
+        print("%-28s %10.1f us/header" % ("add_header (extend)", seconds / len(headers) * 1e6))
+        # Each round a sibling of the tip and a child of the sibling: a
+        # reorg of depth 1
+        headers = []
+        for i in range(args.blocks // 2):
+            sibling = make_header(store.get_header(parent.hashPrevBlock) if i == 0 else headers[-2], 1)
+            parent = make_header(sibling, 0)
+            headers += [sibling, parent]
+        chainstate = store.chainstate
+        reorgs = chainstate.reorg_count
+        start = time.perf_counter()
+        for header in headers:
+            store.add_header(header)
+        seconds = time.perf_counter() - start
+        print("%-28s %10.1f us/header %d reorgs" % ("add_header (reorgs)", seconds / len(headers) * 1e6,
+                                                   chainstate.reorg_count - reorgs))
+        store.close()
+
+
+def bench_load(args):
+    start = time.perf_counter()
+    blocks = []
+    blockhash = 0
+    for height in range(args.blocks):
+        block = create_block(blockhash, create_coinbase(height), 1500000000 + height)
+        block.rehash()
+        blockhash = block.sha256
+        blocks.append(block)
+    print("%d blocks generated in %.2f s" % (args.blocks, time.perf_counter() - start))
+
+    def add_one_by_one(store):
+        for block in blocks:
+            store.add_block(block)
+
+    def add_blocks(store):
+        store.add_blocks(blocks)
+
+    for load in (add_one_by_one, add_blocks):
+        def run():
+            with tempfile.TemporaryDirectory() as tmpdir:
+                store = BlockStore(tmpdir)
+                load(store)
+                assert store.chainstate.tip.height == args.blocks - 1
+                store.close()
+        seconds = timed(run, args.rounds)
+        print("%-28s %10.2f s %10.1f us/block" % (load.__name__, seconds, seconds / args.blocks * 1e6))
+
+
+def bench_fixture(args):
+    with tempfile.TemporaryDirectory() as tmpdir:
+        path = os.path.join(tmpdir, "chain.fixture")
+        start = time.perf_counter()
+        generate_chain(path, args.blocks).close()
+        print("%d blocks, %d bytes generated in %.2f s"
+              % (args.blocks, os.path.getsize(path), time.perf_counter() - start))
+
+        report("open", timed(lambda: ChainFixture(path).close(), args.rounds))
+        fixture = ChainFixture(path)
+        report("blocks()", timed(fixture.blocks, args.rounds))
+
+        def load():
+            with tempfile.TemporaryDirectory() as storedir:
+                block_store = BlockStore(storedir)
+                tx_store = TxStore(storedir)
+                fixture.load_into(block_store, tx_store)
+                assert block_store.chainstate.tip.height == args.blocks - 1
+                block_store.close()
+                tx_store.close()
+        report("load_into()", timed(load, args.rounds))
+        fixture.close()
+
+
+def bench_send(args):
+    payload = make_large_block(14 * args.block_mb).serialize()
+    rng = random.Random(1)
+    inv = msg_inv([CInv(2, rng.getrandbits(256))]).serialize()
+    floods = (("%d x %d byte blocks" % (args.blocks, len(payload)),
+               [msg_generic(b"block", payload)] * args.blocks),
+              ("%d x 1 entry invs" % args.messages,
+               [msg_generic(b"inv", inv)] * args.messages))
+    for flood_name, messages in floods:
+        print(flood_name)
+        for name, conn_class, thread_class in (("NodeConn", NodeConn, NetworkThread),
+                                               ("AsyncNodeConn", AsyncNodeConn, AsyncNetworkThread)):
+            size, seconds, cpu = min(send_flood(conn_class, thread_class, messages)
+                                     for i in range(args.rounds))
+            print("%-14s %10.1f MB/s %10.0f msgs/s %8.2f ms CPU/MB"
+                  % (name, size / seconds / 1e6, len(messages) / seconds, cpu * 1000 / (size / 1e6)))
+
+
+def retained(func):
+    """Run func() and return (result, bytes still allocated by it)."""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        result = func()
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return result, after - before
+
+
+def bench_memory(args):
+    payload = make_headers(2000)
+
+    def parse_headers():
+        m = msg_headers()
+        m.deserialize(BytesReader(payload))
+        return m
+
+    m, size = retained(parse_headers)
+    print("msg_headers: %d headers, %d bytes on the wire" % (len(m.headers), len(payload)))
+    print("%-28s %10.1f bytes/header" % ("in memory", size / len(m.headers)))
+
+    payload = make_block(args.txs).serialize()
+
+    def parse_block():
+        m = msg_block()
+        m.deserialize(BytesReader(payload))
+        return m
+
+    m, size = retained(parse_block)
+    print("block: %d txs, %d bytes on the wire" % (len(m.block.vtx), len(payload)))
+    print("%-28s %10.1f bytes/tx" % ("in memory", size / len(m.block.vtx)))
+
+
+BENCHMARKS = {
+    "hashes": bench_hashes,
+    "index": bench_index,
+    "dispatch": bench_dispatch,
+    "equihash": bench_equihash,
+    "fixture": bench_fixture,
+    "headers": bench_headers,
+    "lock": bench_lock,
+    "merkle": bench_merkle,
+    "lazy": bench_lazy,
+    "load": bench_load,
+    "memory": bench_memory,
+    "metrics": bench_metrics,
+    "p2p": bench_p2p,
+    "parse": bench_parse,
+    "pipeline": bench_pipeline,
+    "replay": bench_replay,
+    "recv": bench_recv,
+    "revalidate": bench_revalidate,
+    "send": bench_send,
+    "sapling": bench_sapling,
+    "serialize": bench_serialize,
+    "store": bench_store,
+    "sync": bench_sync,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("--txs", type=int, default=2500,
+                        help="transactions per synthetic block (default: %(default)s)")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="repetitions, best time is reported (default: %(default)s)")
+    parser.add_argument("--sizes", default="1000,10000,100000",
+                        type=lambda s: [int(x) for x in s.split(",")],
+                        help="tree sizes for the merkle benchmark (default: %(default)s)")
+    parser.add_argument("--peers", default="1,50,500",
+                        type=lambda s: [int(x) for x in s.split(",")],
+                        help="connection counts for the p2p benchmark (default: %(default)s)")
+    parser.add_argument("--blocks", type=int, default=50,
+                        help="block messages per run of the recv benchmark (default: %(default)s)")
+    parser.add_argument("--block-mb", type=int, default=1,
+                        help="approximate block size in MB for the recv benchmark (default: %(default)s)")
+    parser.add_argument("--messages", type=int, default=20000,
+                        help="pings per run of the p2p benchmark (default: %(default)s)")
+    args = parser.parse_args()
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == '__main__':
+    main()
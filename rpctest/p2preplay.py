@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Replay P2P captures (see test_framework/p2pcapture.py) offline.
+
+    ./p2preplay.py info session.p2pcap
+    ./p2preplay.py parse session.p2pcap --rounds 5
+    ./p2preplay.py serve session.p2pcap --port 18444 --pace 1
+
+parse feeds the messages received in the capture to a NodeConnCB through
+got_data(), as fast as possible unless --pace is given, and reports the
+parsing throughput.  serve listens on --port and pushes the same messages
+to each client that connects, e.g.
+
+    ./bitcoin-spv --regtest -i 127.0.0.1:18444 scan
+
+--conn picks one connection of a capture with several (numbered from 0).
+"""
+
+import argparse
+import collections
+import gc
+import os
+import sys
+import time
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import NodeConnCB
+from test_framework.p2pcapture import RECEIVED, CaptureReader, CaptureServer, ReplayConn, replay_into
+
+
+def command_of(frame):
+    return bytes(frame[4:16]).split(b"\x00", 1)[0].decode("ascii", "replace")
+
+
+def info(reader, args):
+    stats = collections.defaultdict(lambda: [0, 0])
+    first = last = None
+    for record in reader:
+        if first is None:
+            first = record.timestamp
+        last = record.timestamp
+        s = stats[(record.conn, record.direction, command_of(record.frame))]
+        s[0] += 1
+        s[1] += len(record.frame)
+    if first is None:
+        print("empty capture")
+        return
+    print("%.3f s recorded" % ((last - first) / 1e9))
+    for (conn, direction, command), (count, size) in sorted(stats.items()):
+        print("conn %-3d %-8s %-12s %8d msgs %12d bytes"
+              % (conn, "received" if direction == RECEIVED else "sent", command, count, size))
+
+
+def parse(reader, args):
+    records = reader.select(RECEIVED, args.conn)
+    net = args.net
+    best = float('inf')
+    for i in range(args.rounds):
+        conn = ReplayConn(NodeConnCB(), net)
+        gc.collect()
+        start = time.perf_counter()
+        size = replay_into(conn, records, pace=args.pace)
+        best = min(best, time.perf_counter() - start)
+    print("%d messages, %d bytes" % (len(records), size))
+    print("%10.1f MB/s %10.0f msgs/s" % (size / best / 1e6, len(records) / best))
+
+
+def serve(reader, args):
+    server = CaptureServer(reader.select(RECEIVED, args.conn), args.host, args.port,
+                           pace=args.pace, connections=args.connections)
+    print("serving on %s:%d" % (args.host, server.port))
+    server.start()
+    try:
+        server.join()
+    except KeyboardInterrupt:
+        server.stop()
+    for size, seconds in server.results:
+        print("sent %d bytes in %.3f s" % (size, seconds))
+
+
+COMMANDS = {
+    "info": info,
+    "parse": parse,
+    "serve": serve,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("capture")
+    parser.add_argument("--conn", type=int, default=None,
+                        help="connection to replay (default: all)")
+    parser.add_argument("--pace", type=float, default=None,
+                        help="replay at this multiple of the recorded speed (default: as fast as possible)")
+    parser.add_argument("--rounds", type=int, default=5,
+                        help="repetitions of parse, best time is reported (default: %(default)s)")
+    parser.add_argument("--net", default="regtest",
+                        help="network of the capture for parse (default: %(default)s)")
+    parser.add_argument("--host", default="127.0.0.1",
+                        help="address to serve on (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=18444,
+                        help="port to serve on, 0 for any (default: %(default)s)")
+    parser.add_argument("--connections", type=int, default=1,
+                        help="clients to serve before exiting (default: %(default)s)")
+    args = parser.parse_args()
+    with CaptureReader(args.capture) as reader:
+        COMMANDS[args.command](reader, args)
+
+
+if __name__ == '__main__':
+    main()
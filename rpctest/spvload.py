@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Load an SPV client with many simulated full-node peers.
+
+    ./spvload.py serve --peers 50 --slow 10 --headers 20000 \\
+        --client "./bitcoin-spv --regtest -i {peers} -m {count} scan"
+    ./spvload.py serve --peers 8 --komodo --magic f9eee48d --genesis <hash> \\
+        --client "./nspv KMD -i {peers} -m {count}"
+    ./spvload.py selftest --peers 1,10,50 --slow 20 --headers 20000
+
+serve starts the peers (see test_framework/loadgen.py), runs the client
+command with {peers} replaced by their host:port list and {count} by
+their number, and reports once the client exits (or on ctrl-c).  After
+the client has been served the whole chain, the peers announce --flood
+new blocks at --rate per second.  --magic and --genesis give the network
+of a client that isn't regtest.
+
+selftest runs the same with a python client in a child process instead,
+for each number of peers: it connects to all of them, sends NSPV_INFO to
+each, syncs the headers from the first peer to answer and follows the
+announcements.
+
+Reported: the time to connect (selftest) and to sync the headers,
+the headers served per second of sync, the round trip time of NSPV_INFO
+(selftest), the time the peers took from a request to its response
+(fast and slow peers apart), and the time from an announcement to the
+client's request for it.
+"""
+
+import argparse
+import multiprocessing
+import os
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.loadgen import (
+    MAX_HEADERS_RESULTS,
+    MSG_BLOCK,
+    NSPV_INFO,
+    NSPV_INFORESP,
+    REGTEST_GENESIS,
+    PeerSwarm,
+    SyntheticChain,
+    percentile,
+)
+from test_framework.mininode import (
+    NetworkThread,
+    NodeConn,
+    NodeConnBase,
+    NodeConnCB,
+    msg_getheaders,
+    msg_getnSPV,
+)
+
+
+def ms(pair):
+    if pair is None:
+        return "       -       -"
+    return "%8.2f%8.2f" % (pair[0] * 1000, pair[1] * 1000)
+
+
+def report(summary):
+    sync = summary["sync_seconds"]
+    print("%d/%d peers connected, %d requests, %d headers, %d blocks, %d nSPV responses, %d bytes sent"
+          % (summary["connected"], summary["peers"], summary["requests"], summary["headers"],
+             summary["blocks"], summary["nspv"], summary["bytes"]))
+    if sync is not None:
+        print("chain served in %.3f s, %.0f headers/s" % (sync, summary["headers"] / sync))
+    print("service ms p50/p99: fast %s  slow %s" % (ms(summary.get("service_fast")),
+                                                   ms(summary.get("service_slow"))))
+    print("reaction to %d announcements ms p50/p99: %s" % (summary["announced"],
+                                                         ms(summary.get("reaction"))))
+
+
+# Block locator of the chain hashes (genesis first): the last 10 blocks,
+# then exponentially further back, then the genesis
+def get_locator(hashes):
+    locator = []
+    height = len(hashes) - 1
+    step = 1
+    while height > 0:
+        locator.append(hashes[height])
+        if len(locator) >= 10:
+            step *= 2
+        height -= step
+    locator.append(hashes[0])
+    return locator
+
+
+class SyncState(object):
+    """Headers chain of the selftest client, shared by its connections.
+
+    All of it runs on the NetworkThread."""
+
+    def __init__(self, genesis, peers, target, done):
+        self.hashes = [genesis]
+        self.known = {genesis}
+        self.peers = peers
+        self.target = target
+        self.done = done
+        self.start = time.perf_counter()
+        self.connected = None
+        self.synced = None
+        self.syncing = None
+        self.handshakes = 0
+        self.requested = set()
+        self.rtts = []
+        self.orphans = 0
+
+    def ready(self, client):
+        self.handshakes += 1
+        if self.handshakes == self.peers:
+            self.connected = time.perf_counter()
+        client.request_info()
+        if self.syncing is None and self.synced is None:
+            self.syncing = client
+            client.request_headers()
+
+    def connect(self, client, headers):
+        for header in headers:
+            header.calc_sha256()
+            if header.hashPrevBlock == self.hashes[-1]:
+                self.hashes.append(header.sha256)
+                self.known.add(header.sha256)
+            elif header.sha256 not in self.known:
+                self.orphans += 1
+        if client is self.syncing:
+            if len(headers) == MAX_HEADERS_RESULTS:
+                client.request_headers()
+            else:
+                self.syncing = None
+                self.synced = time.perf_counter()
+        self.check_done()
+
+    def check_done(self):
+        if (self.synced is not None and len(self.hashes) > self.target
+                and len(self.rtts) == self.peers):
+            self.done.set()
+
+
+class SyncClient(NodeConnCB):
+    def __init__(self, state):
+        super().__init__()
+        self.state = state
+        self.info_sent = None
+
+    def request_headers(self):
+        message = msg_getheaders()
+        message.locator.vHave = get_locator(self.state.hashes)
+        self.send_message(message)
+
+    def request_info(self):
+        self.info_sent = time.perf_counter()
+        self.send_message(msg_getnSPV(bytes([NSPV_INFO])))
+
+    def on_verack(self, conn, message):
+        super().on_verack(conn, message)
+        self.state.ready(self)
+
+    def on_headers(self, conn, message):
+        self.state.connect(self, message.headers)
+
+    def on_inv(self, conn, message):
+        state = self.state
+        for inv in message.inv:
+            if inv.type == MSG_BLOCK and inv.hash not in state.known and inv.hash not in state.requested:
+                state.requested.add(inv.hash)
+                self.request_headers()
+
+    def on_nSPV(self, conn, message):
+        if message.get_type() == NSPV_INFORESP and self.info_sent is not None:
+            self.state.rtts.append(time.perf_counter() - self.info_sent)
+            self.info_sent = None
+            self.state.check_done()
+
+
+def run_client(pipe, target):
+    ports = pipe.recv()
+    done = threading.Event()
+    state = SyncState(REGTEST_GENESIS, len(ports), target, done)
+    clients = []
+    for port in ports:
+        client = SyncClient(state)
+        client.add_connection(NodeConn("127.0.0.1", port, None, client))
+        clients.append(client)
+    thread = NetworkThread()
+    thread.start()
+    if not done.wait(600):
+        print("selftest client timed out at height %d" % (len(state.hashes) - 1))
+    for client in clients:
+        client.connection.disconnect_node()
+    thread.join()
+    pipe.send({
+        "connect": state.connected - state.start if state.connected else None,
+        "sync": state.synced - state.start if state.synced else None,
+        "height": len(state.hashes) - 1,
+        "orphans": state.orphans,
+        "rtt": (percentile(state.rtts, 0.5), percentile(state.rtts, 0.99)) if state.rtts else None,
+    })
+
+
+# Start flooding once the whole chain was served
+def flood_after_sync(swarm, args, stop):
+    if not args.flood:
+        return
+    while swarm.synced is None:
+        if stop.wait(0.05):
+            return
+    swarm.flood(args.rate, args.flood)
+
+
+def selftest(args):
+    chain = None
+    print("%d headers, %d blocks flooded at %g/s, %d%% slow peers (+%g ms)"
+          % (args.headers, args.flood, args.rate, args.slow, args.delay * 1000))
+    print("%6s %9s %9s %10s %16s %16s %16s %16s"
+          % ("peers", "connect s", "sync s", "headers/s", "nSPV rtt ms",
+             "fast svc ms", "slow svc ms", "reaction ms"))
+    context = multiprocessing.get_context("fork")
+    for peers in [int(n) for n in args.peers.split(",")]:
+        # Flooding extends the chain
+        if chain is None or chain.height() != args.headers:
+            chain = SyntheticChain(args.headers)
+        # Fork the client before the swarm starts the network thread
+        parent, child = context.Pipe()
+        process = context.Process(target=run_client, args=(child, args.headers + args.flood), daemon=True)
+        process.start()
+        swarm = PeerSwarm(chain, peers, slow=peers * args.slow // 100, delay=args.delay)
+        swarm.start()
+        stop = threading.Event()
+        flooder = threading.Thread(target=flood_after_sync, args=(swarm, args, stop))
+        flooder.start()
+        parent.send([stats.port for stats in swarm.stats])
+        result = parent.recv()
+        stop.set()
+        flooder.join()
+        process.join()
+        swarm.close()
+        summary = swarm.summary()
+        sync = result["sync"]
+        print("%6d %9s %9s %10s %s %s %s %s"
+              % (peers, "%.3f" % result["connect"] if result["connect"] else "-",
+                 "%.3f" % sync if sync else "-",
+                 "%.0f" % (args.headers / sync) if sync else "-",
+                 ms(result["rtt"]), ms(summary.get("service_fast")),
+                 ms(summary.get("service_slow")), ms(summary.get("reaction"))))
+        if result["height"] != chain.height() or result["orphans"]:
+            print("%6s client at height %d of %d, %d headers not connecting"
+                  % ("", result["height"], chain.height(), result["orphans"]))
+
+
+def serve(args):
+    net = "regtest"
+    if args.magic:
+        net = "custom"
+        NodeConnBase.MAGIC_BYTES[net] = bytes.fromhex(args.magic)
+    genesis = int(args.genesis, 16) if args.genesis else REGTEST_GENESIS
+    start = time.perf_counter()
+    chain = SyntheticChain(args.headers, genesis=genesis, komodo=args.komodo)
+    print("%d headers generated in %.1f s" % (args.headers, time.perf_counter() - start))
+    swarm = PeerSwarm(chain, args.peers, slow=args.peers * args.slow // 100, delay=args.delay,
+                      port=args.port, net=net)
+    swarm.start()
+    print("peers on %s" % swarm.addresses())
+    stop = threading.Event()
+    flooder = threading.Thread(target=flood_after_sync, args=(swarm, args, stop))
+    flooder.start()
+    try:
+        if args.client:
+            command = args.client.format(peers=swarm.addresses(), count=args.peers)
+            client = subprocess.Popen(shlex.split(command), stdout=subprocess.DEVNULL)
+            start = time.perf_counter()
+            client.wait()
+            print("client exited with %d after %.3f s" % (client.returncode, time.perf_counter() - start))
+        else:
+            while True:
+                time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    stop.set()
+    flooder.join()
+    swarm.close()
+    report(swarm.summary())
+
+
+COMMANDS = {
+    "selftest": selftest,
+    "serve": serve,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("command", choices=sorted(COMMANDS))
+    parser.add_argument("--peers", default="8",
+                        help="number of peers; for selftest a comma separated list (default: %(default)s)")
+    parser.add_argument("--slow", type=int, default=0,
+                        help="percentage of slow peers (default: %(default)s)")
+    parser.add_argument("--delay", type=float, default=0.2,
+                        help="seconds a slow peer takes to answer (default: %(default)s)")
+    parser.add_argument("--headers", type=int, default=20000,
+                        help="length of the chain (default: %(default)s)")
+    parser.add_argument("--flood", type=int, default=0,
+                        help="blocks to announce after the chain was served (default: %(default)s)")
+    parser.add_argument("--rate", type=float, default=10,
+                        help="announcements per second (default: %(default)s)")
+    parser.add_argument("--port", type=int, default=0,
+                        help="port of the first peer, 0 for any free ports (default: %(default)s)")
+    parser.add_argument("--client", default=None,
+                        help="command of the client for serve, with {peers} and {count}")
+    parser.add_argument("--komodo", action="store_true",
+                        help="serve Komodo (Equihash) headers")
+    parser.add_argument("--magic", default=None,
+                        help="network magic of the client in hex (default: regtest)")
+    parser.add_argument("--genesis", default=None,
+                        help="genesis block hash of the client in hex (default: regtest)")
+    args = parser.parse_args()
+    if args.command == "serve":
+        args.peers = int(args.peers)
+    COMMANDS[args.command](args)
+
+
+if __name__ == '__main__':
+    main()
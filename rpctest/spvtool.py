@@ -5,7 +5,9 @@
 
 from test_framework.test_framework import BitcoinTestFramework
 from test_framework.util import *
+from test_framework.chainfixture import generate_chain
 import subprocess
+import time
 
 class SPVToolTest (BitcoinTestFramework):
     def __init__(self):
@@ -18,13 +20,13 @@ class SPVToolTest (BitcoinTestFramework):
         self.nodes = start_nodes(1, self.options.tmpdir, self.extra_args[:3])
         self.is_network_split=False
         self.sync_all()
-        cur_time = int(time.time())- 100*600
-        for i in range(100):
-            self.nodes[0].setmocktime(cur_time + 600)
-            self.nodes[0].generate(1)
-            cur_time += 600
-
-        self.nodes[0].setmocktime(cur_time + 1600)
+        # 100 blocks 10 minutes apart, the last one a minute ago: bitcoin-spv
+        # only fetches the blocks of headers from the last hour or so (by
+        # its own clock), so the chain is generated for each run
+        fixture = generate_chain(os.path.join(self.options.tmpdir, "chain-100.fixture"), 100,
+                                 start_time=int(time.time()) - 100 * 600 - 60)
+        fixture.submit(self.nodes[0])
+        fixture.close()
     
     def execute_and_get_response(self, cmd):
         dummyfile = self.options.tmpdir + "/dummy"
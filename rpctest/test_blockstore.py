@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import logging
+import os
+import sys
+import zlib
+
+import pytest
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.blockstore import RecordStore
+
+"""
+   Offline checks that RecordStore reopens a file whose end was torn by a
+   crash: the complete records are kept and the rest is truncated.
+   To run: "python3 -m pytest test_blockstore.py" from rpctest directory
+"""
+
+COUNT = 10
+ERASED = 3
+
+
+def key(i):
+    return i.to_bytes(32, "little")
+
+
+def value(i):
+    return bytes([i]) * (100 + i)
+
+
+# The bytes RecordStore appends to store value(i) under key(i)
+def record(i):
+    data = value(i)
+    return RecordStore.RECORD.pack(RecordStore.RECORD_MAGIC, key(i), len(data), zlib.crc32(data)) + data
+
+
+# A closed store of COUNT records, one of them erased.  Returns its size.
+def make_store(path):
+    store = RecordStore(path)
+    store.put_many((key(i), value(i)) for i in range(COUNT))
+    store.erase(key(ERASED))
+    store.close()
+    return os.path.getsize(path)
+
+
+def append(path, data):
+    with open(path, "ab") as f:
+        f.write(data)
+
+
+def check_records(store):
+    assert len(store) == COUNT - 1
+    assert store.get(key(ERASED)) is None
+    for i in range(COUNT):
+        if i != ERASED:
+            assert bytes(store.get(key(i))) == value(i)
+
+
+def reopen(path, caplog):
+    caplog.clear()
+    with caplog.at_level(logging.WARNING, logger="TestFramework.blockstore"):
+        return RecordStore(path)
+
+
+def dropped_warnings(caplog):
+    return [r for r in caplog.records if "dropping" in r.getMessage()]
+
+
+# Cut in the record header, in the value, and one byte short of the end
+@pytest.mark.parametrize("length", [1, RecordStore.RECORD.size, RecordStore.RECORD.size + 50,
+                                    len(record(COUNT)) - 1])
+def test_torn_record(tmp_path, caplog, length):
+    path = str(tmp_path / "store")
+    size = make_store(path)
+    append(path, record(COUNT)[:length])
+    store = reopen(path, caplog)
+    check_records(store)
+    assert key(COUNT) not in store
+    assert len(dropped_warnings(caplog)) == 1
+    assert os.path.getsize(path) == size
+    # The store goes on from the last complete record
+    store.put(key(COUNT), value(COUNT))
+    store.close()
+    store = reopen(path, caplog)
+    assert not dropped_warnings(caplog)
+    assert bytes(store.get(key(COUNT))) == value(COUNT)
+    store.close()
+    assert os.path.getsize(path) == size + len(record(COUNT))
+
+
+def test_corrupt_last_record(tmp_path, caplog):
+    path = str(tmp_path / "store")
+    size = make_store(path)
+    corrupt = bytearray(record(COUNT))
+    corrupt[-1] ^= 0xff
+    append(path, bytes(corrupt))
+    store = reopen(path, caplog)
+    check_records(store)
+    assert key(COUNT) not in store
+    assert len(dropped_warnings(caplog)) == 1
+    store.close()
+    assert os.path.getsize(path) == size
+
+
+def test_preallocated_zeros(tmp_path, caplog):
+    # A crash before close() leaves the zeros allocated ahead of the
+    # records: they are dropped without a warning
+    path = str(tmp_path / "store")
+    size = make_store(path)
+    append(path, bytes(RecordStore.PREALLOCATE))
+    store = reopen(path, caplog)
+    check_records(store)
+    assert not dropped_warnings(caplog)
+    assert os.path.getsize(path) == size
+    store.close()
+
+
+def test_unclosed_store(tmp_path, caplog):
+    path = str(tmp_path / "store")
+    store = RecordStore(path)
+    store.put_many((key(i), value(i)) for i in range(COUNT))
+    store.erase(key(ERASED))
+    store.sync()
+    # As after a crash: the file is still extended ahead of the records
+    assert os.path.getsize(path) > store.size
+    reopened = reopen(path, caplog)
+    check_records(reopened)
+    assert not dropped_warnings(caplog)
+    reopened.close()
+    store.close()
+
+
+def test_not_a_store(tmp_path):
+    path = str(tmp_path / "store")
+    with open(path, "wb") as f:
+        f.write(b"not a record store")
+    with pytest.raises(IOError):
+        RecordStore(path)
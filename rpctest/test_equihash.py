@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.equihash import EquihashVerifier, is_valid_solution
+from test_framework.merkle import CKomodoMerkleBlock
+from test_framework.mininode import BytesReader, CKomodoBlockHeader
+
+"""
+   Offline checks of the Equihash (200,9) verifier and of Komodo headers.
+   To run: "python3 -m pytest test_equihash.py" from rpctest directory
+"""
+
+# A Komodo asset chain header with a valid Equihash solution (from the
+# txproof test vectors in src/merkle_c.c)
+KMD_HEADER = bytes.fromhex(
+    "04000000e99a161138c314476f8bb68ed07ff5486f10df9ed551c718e9a1b614ffe06a05"
+    "3e2f28dc66f8ca00fc38d1bf25ecc696ce0718574bdbad796dcefe84a42f31fffbc2f430"
+    "0c01f0b7820d00e3347c8da4ee614674376cbc45359daa54f9b5493e1a54335da0900720"
+    "05003f58e1e6ce2c678b46888dc937875ac55892274ec1a111da86cb71bf0000fd400501"
+    "06155f02cb18316a74b240d92cf0cacf953b42a01463fdf1135919edb380c284585a6ad8"
+    "e8386e2a561157040caef35455d7473551f2dfebdd9c9b9f79dc14b5a8fad84a623c6f72"
+    "286953ed5bd6b129d786e0041d03efbf96c1618cd7504cdcdfd97d1b1fdfe4f619549f1d"
+    "4e26d3ef4fe013598334ed81035e91c9730ddf9dde37a8d583ab380157c21d837d88322d"
+    "19a3513475edcadfe12dab9727f892422be6b1c5f859e20420802de949f00394d980b86a"
+    "af5e6570462c5ecc09fcdb5521c2daf19e74e3a6127b3e575bc79fa30513996cdf0ea620"
+    "5bf8252306ee7d35322edab4d7b81b4df5690c9316319777a2a7f6527c5e6201b460030c"
+    "f202ff39c9ad44f12fc10a87e5a1d8e72e4af3a9203562122ff7f687f8951ae49860995f"
+    "13e81c26af15b3a78dea88b7f793c79265cefc2208a90a5d899b300a4a6771a6dc5d49d9"
+    "a5aa9de165858d8a8d10930258a8922191e784e22bf64b3a4c5d828c13b694b81bdf2b0f"
+    "0de09909d5eb02cc3fdcc0f97330f7e5320d8e9d3e386569632d9031d71afeb81a020799"
+    "fe4f21022f7b155e65ff5a756376e639a01ad0bb1a320e0ddbd98977493079de76558982"
+    "32d09b1d327ef913161d0c7fbde59e333131e2acbbb76b752eaef038630e6629642cb306"
+    "91ba864c583065564f45b4be40ea3df7f7be1c2bdb35f0c8841955ab7bbed56196d4b507"
+    "cf641f4446abfd95dac223db33510d8cf5b66f561b559f066de5fe2ff80301c3f027d10c"
+    "760b4a254f16ff23d9654622ff5b3051a738632a19ffeed645031dc271a7ec109ce6bbdf"
+    "e9c3655e434277fabbf6400864935a738b0baaa109cacff9642b22fab797ffe75473dc29"
+    "60ae6c35fb8846b6de7204779645dd0e3e177c515cae334345f40f662d43c6bb9692beba"
+    "40ed34cd56d9639f318d1a114565326678ba0671dd7c3903a3e8bc134462b1057da116cb"
+    "c8be0d6040f91f452815696fc8699d757bd657119ac83ef2f7fad9e3660934522c168633"
+    "3434f1a2a0a1b2ea9ecb7e57333813dff7d9105cc57d952e36cd165ff9e232b1581ce505"
+    "1df9f1654e79af63cfb10e2aafbe61b64b54310e0d9c3b169f5f041b48e96abd79de8fb7"
+    "ca8ddf933205abeae5a69ca9df4fcca0cc4c95680833ab4281e120ca6c61ce1abfa34f17"
+    "02a27ca0198dd255d85c6503e8ceb206d902c3f15241b6b7c7f75ca6844a269e05fa88a7"
+    "db928524b2de12b5b7f39f82bc16f739c0168ebb5f12cc48c4e8ebe48c5e73503dbccfef"
+    "a6a72cacf71465937814d730a3982cf24595921c3cb7d81b09f2ffb79735e0f83443bd97"
+    "d3d0e8f0f2edbb9f1ce9434cb46360bb5e2b177887f927fe6f5c1f032d2b0e2490161fab"
+    "0da76784329e5566d5fdd5dd61e2602c6c3264b3ed01ffae9883e6dde4ebd4485f74db04"
+    "0f477d7fe38cb1b8933653fd71be31db85f3f74d283d87ed0a67d48db4a1240eac7f1981"
+    "2ceeb02b633ae293bb3aefcbffb59403eddc2747425379ffde7d477fea42b3eb851f869f"
+    "55977c5c8bb29d19be595b1011fccaec51a0a764fd97b74cdf512a7b617a8ca11844e774"
+    "eb8b29db9057760a06d62401f9fc1f78a11c42e5fb9f578698d631c33f22d5f2ade1f79d"
+    "87d03172bd6e9d19fed7e9d514dea678d205a7e7d06a8411a93f10596429ff98b0d4c3aa"
+    "be280ecfddb720392958bfb879ea1e5dc712f3cc29bc34b960b63c1add3c382b78c46b50"
+    "ffaa59d6d275c075420c6f9232025772d3026bb463f9bc63fc6325e52d8f20a1be091415"
+    "24e4ac6c05cfa9b381d20f5cb052e0ca20fe637d6642b3cae33d035bf68f89e7dcf0691b"
+    "61957f725a29f6124e98cbad3ac11a95d615c147aa0a20d2e01757609d2ed5aab9cdb71f"
+    "d653dcbea082a329fdc763")
+
+KMD_HEADER_HASH = "07346a1ca4bde1517ae0cae7a4591b74c094e4e7a1fdcd59a59dc6fcb7a0513d"
+
+
+def parse_header(raw):
+    header = CKomodoBlockHeader()
+    header.deserialize(BytesReader(raw))
+    return header
+
+
+def test_header_round_trip():
+    header = parse_header(KMD_HEADER)
+    assert len(header.nSolution) == 1344
+    assert header.serialize() == KMD_HEADER
+    header.calc_sha256()
+    assert header.hash == KMD_HEADER_HASH
+
+
+def test_valid_solution():
+    header = parse_header(KMD_HEADER)
+    assert is_valid_solution(header.get_equihash_input(), header.nSolution)
+
+
+def test_corrupted_solution():
+    header = parse_header(KMD_HEADER)
+    equihash_input = header.get_equihash_input()
+    solution = header.nSolution
+    for pos in (0, 1, len(solution) // 2, len(solution) - 1):
+        corrupted = bytearray(solution)
+        corrupted[pos] ^= 0x01
+        assert not is_valid_solution(equihash_input, bytes(corrupted))
+    # Wrong length
+    assert not is_valid_solution(equihash_input, solution[:-1])
+    assert not is_valid_solution(equihash_input, solution + b"\x00")
+    # The same solution doesn't solve another header
+    header.nNonce ^= 1
+    assert not is_valid_solution(header.get_equihash_input(), solution)
+
+
+def test_verifier_pool():
+    bad = bytearray(KMD_HEADER)
+    bad[-1] ^= 0x01
+    with EquihashVerifier(processes=2, chunksize=1) as verifier:
+        assert verifier.verify_headers([KMD_HEADER, bytes(bad), parse_header(KMD_HEADER)]) == [True, False, True]
+
+
+def test_header_from_plain_header():
+    block = create_block(0x1234, create_coinbase(1), 1500000000)
+    block.vtx.append(create_coinbase(2))
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    header = CKomodoBlockHeader(block)
+    assert header.hashFinalSaplingRoot == 0 and header.nSolution == b""
+    assert header.nNonce == block.nNonce and header.hashMerkleRoot == block.hashMerkleRoot
+    # Hashed over the Komodo serialization
+    assert header.sha256 != block.sha256
+    assert parse_header(header.serialize()).rehash() == header.sha256
+
+    # A txproof of a block built offline
+    proof = CKomodoMerkleBlock.from_block(block, [block.vtx[1].sha256])
+    parsed = CKomodoMerkleBlock()
+    parsed.deserialize(BytesReader(proof.serialize()))
+    assert parsed.get_matched_txids() == [block.vtx[1].sha256]
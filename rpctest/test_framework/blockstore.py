@@ -5,95 +5,585 @@
 """BlockStore and TxStore helper classes."""
 
 from .mininode import *
-from io import BytesIO
-import dbm.dumb as dbmd
+from collections import deque, namedtuple
+import mmap
+import os
+import struct
+import threading
+import zlib
 
 logger = logging.getLogger("TestFramework.blockstore")
 
+class RecordStore(object):
+    """Append-only store of values keyed by 32 byte hashes.
+
+    The values are appended to one flat file and an in-memory dict maps
+    each key to the offset and length of its latest value, so an insert is
+    one buffered write and a lookup one dict access, however many records
+    the file holds.  get() returns a read-only memoryview of an mmap of the
+    file, not a copy.
+
+    The file is FILE_MAGIC followed by records of
+
+        uint32     RECORD_MAGIC
+        32 bytes   key
+        uint32     length of the value, or TOMBSTONE when the key was erased
+        uint32     crc32 of the value (0 for a TOMBSTONE)
+        length     value
+
+    The file is extended (sparsely) ahead of the records and mapped whole,
+    so a record written is read back without remapping; close() truncates
+    it to the records.  Opening an existing file rebuilds the index from
+    the records and truncates it at the first incomplete or corrupt one,
+    which is where a crash leaves the end of the records.  The writes are
+    only fsynced every sync_every records (never when 0), by sync() and by
+    close().
+    """
+    FILE_MAGIC = b"rpcstor1"
+    RECORD_MAGIC = 0x64726372
+    RECORD = struct.Struct("<I32sII")
+    TOMBSTONE = 0xffffffff
+    # Least the file is extended by
+    PREALLOCATE = 1 << 24
+
+    def __init__(self, path, sync_every=0):
+        self.path = path
+        self.sync_every = sync_every
+        self.lock = threading.Lock()
+        # key -> (offset of the value, length)
+        self.index = {}
+        self.file = open(path, "r+b" if os.path.exists(path) else "w+b")
+        self.allocated = self.file.seek(0, os.SEEK_END)
+        if self.allocated == 0:
+            self.file.write(self.FILE_MAGIC)
+            self.file.flush()
+            self.allocated = len(self.FILE_MAGIC)
+        # End of the records, and of those written to the file
+        self.size = self.flushed = self.allocated
+        self.map = None
+        self.view = None
+        self.unsynced = 0
+        self._remap()
+        self._load()
+        self.file.seek(self.size)
+
+    # Rebuild the index and cut off a torn tail
+    def _load(self):
+        view = self.view
+        if bytes(view[:len(self.FILE_MAGIC)]) != self.FILE_MAGIC:
+            self.close()
+            raise IOError("%s is not a record store" % self.path)
+        index = self.index
+        record = self.RECORD
+        pos = len(self.FILE_MAGIC)
+        end = self.allocated
+        while pos + record.size <= end:
+            magic, key, length, crc = record.unpack_from(view, pos)
+            if magic != self.RECORD_MAGIC:
+                break
+            if length == self.TOMBSTONE and crc == 0:
+                index.pop(key, None)
+                pos += record.size
+                continue
+            start = pos + record.size
+            if start + length > end or zlib.crc32(view[start:start + length]) != crc:
+                break
+            index[key] = (start, length)
+            pos = start + length
+        if pos != end:
+            # Only zeros past the records: space allocated ahead of them
+            if view[pos:end].tobytes().strip(b"\0"):
+                logger.warning("%s: dropping %d bytes after the last complete record" % (self.path, end - pos))
+            self.file.truncate(pos)
+            self.allocated = pos
+            self._remap()
+        self.size = self.flushed = pos
+
+    # Map the whole file.  The old map is dropped rather than closed, the
+    # views handed out keep it alive as long as they need it.
+    def _remap(self):
+        self.map = mmap.mmap(self.file.fileno(), self.allocated, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, key):
+        return key in self.index
+
+    def keys(self):
+        with self.lock:
+            return list(self.index)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return None
+            offset, length = entry
+            if offset + length > self.flushed:
+                self.file.flush()
+                self.flushed = self.size
+            return self.view[offset:offset + length]
+
+    def put(self, key, value):
+        with self.lock:
+            length = len(value)
+            offset = self.size + self.RECORD.size
+            self._reserve(offset + length)
+            self.file.write(self.RECORD.pack(self.RECORD_MAGIC, key, length, zlib.crc32(value)))
+            self.file.write(value)
+            self.index[key] = (offset, length)
+            self.size = offset + length
+            self._written(1)
+
+    # Append many (key, value) pairs with one write
+    def put_many(self, items):
+        record = self.RECORD
+        magic = self.RECORD_MAGIC
+        parts = []
+        entries = []
+        with self.lock:
+            offset = self.size
+            for key, value in items:
+                length = len(value)
+                parts.append(record.pack(magic, key, length, zlib.crc32(value)))
+                parts.append(value)
+                offset += record.size
+                entries.append((key, (offset, length)))
+                offset += length
+            self._reserve(offset)
+            self.file.write(b"".join(parts))
+            self.index.update(entries)
+            self.size = offset
+            self._written(len(entries))
+
+    def erase(self, key):
+        with self.lock:
+            del self.index[key]
+            self._reserve(self.size + self.RECORD.size)
+            self.file.write(self.RECORD.pack(self.RECORD_MAGIC, key, self.TOMBSTONE, 0))
+            self.size += self.RECORD.size
+            self._written(1)
+
+    # Extend the file and its map to at least end
+    def _reserve(self, end):
+        if end <= self.allocated:
+            return
+        self.file.flush()
+        self.flushed = self.size
+        self.allocated = max(end, 2 * self.allocated, self.PREALLOCATE)
+        self.file.truncate(self.allocated)
+        self._remap()
+
+    def _written(self, records):
+        self.unsynced += records
+        if self.sync_every and self.unsynced >= self.sync_every:
+            self._sync()
+
+    def _sync(self):
+        self.file.flush()
+        self.flushed = self.size
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def sync(self):
+        with self.lock:
+            self._sync()
+
+    def close(self):
+        with self.lock:
+            if self.file.closed:
+                return
+            self.file.flush()
+            self.file.truncate(self.size)
+            if self.sync_every:
+                os.fsync(self.file.fileno())
+            self.file.close()
+            self.view.release()
+            try:
+                self.map.close()
+            except BufferError:
+                # Values are still referenced, the map goes with the last
+                pass
+            self.map = self.view = None
+
+# Height of the ancestor a header's skip pointer points to, as in
+# bitcoind's CBlockIndex::BuildSkip: any ancestor is reached in
+# O(log(height)) steps
+def skip_height(height):
+    if height < 2:
+        return 0
+    if height & 1:
+        n = height - 1
+        n &= n - 1
+        return (n & (n - 1)) + 1
+    return height & (height - 1)
+
+_proofs = {}
+
+# Expected number of hashes for a block of target nBits, as bitcoind's
+# GetBlockProof(): 2**256 / (target + 1), 0 for an invalid target
+def block_proof(nBits):
+    proof = _proofs.get(nBits)
+    if proof is None:
+        exponent = nBits >> 24
+        mantissa = nBits & 0x007fffff
+        if exponent <= 3:
+            target = mantissa >> (8 * (3 - exponent))
+        else:
+            target = mantissa << (8 * (exponent - 3))
+        if nBits & 0x00800000 or target == 0 or target >> 256:
+            proof = 0
+        else:
+            proof = (1 << 256) // (target + 1)
+        _proofs[nBits] = proof
+    return proof
+
+class HeaderEntry(object):
+    """A header in a HeaderIndex, linked to its parent entry.
+
+    chainwork is the sum of the block_proof() of the header and its
+    ancestors in the index."""
+    __slots__ = ("header", "hash", "height", "parent", "skip", "root", "chainwork")
+
+    def __init__(self, header, parent, chain=None):
+        self.header = header
+        self.hash = header.sha256
+        self.link(parent, chain)
+
+    # (Re)compute height, skip pointer and root from the parent, which
+    # is None for a header whose parent isn't known.  chain: the entries
+    # of the parent's branch by height, if at hand.
+    def link(self, parent, chain=None):
+        self.parent = parent
+        if parent is None:
+            self.height = 0
+            self.skip = None
+            self.root = self
+            self.chainwork = block_proof(self.header.nBits)
+        else:
+            self.height = parent.height + 1
+            if chain is not None:
+                self.skip = chain[skip_height(self.height)]
+            else:
+                self.skip = parent.get_ancestor(skip_height(self.height))
+            self.root = parent.root
+            self.chainwork = parent.chainwork + block_proof(self.header.nBits)
+
+    def get_ancestor(self, height):
+        if height > self.height or height < 0:
+            return None
+        walk = self
+        h = self.height
+        while h > height:
+            hs = skip_height(h)
+            hsp = skip_height(h - 1)
+            if walk.skip is not None and (hs == height or
+                                          (hs > height and not (hsp < hs - 2 and hsp >= height))):
+                walk = walk.skip
+                h = hs
+            else:
+                walk = walk.parent
+                h -= 1
+        return walk
+
+    def __repr__(self):
+        return "HeaderEntry(hash=%064x height=%d)" % (self.hash, self.height)
+
+class HeaderIndex(object):
+    """Index of the headers of a BlockStore.
+
+    Maps each hash to a HeaderEntry with its height, parent and skip
+    pointer, and keeps the branch of the tip as a list by height (like
+    bitcoind's CChain), so the headers of a range of heights are a slice
+    of it and the ancestor at any height is one lookup, or O(log(height))
+    steps off the tip's branch.
+
+    Heights count from the first header of a branch whose parent isn't
+    known (normally the genesis block).  A header may arrive before its
+    parent: it then starts a branch at height 0, which is linked under the
+    parent when it arrives.
+
+    observers are called with each new entry and the list of the entries
+    whose height and chainwork changed with it (those it was linked
+    above).
+    """
+
+    def __init__(self):
+        # hash -> HeaderEntry
+        self.entries = {}
+        # root entry -> entries under it (itself included) in the order
+        # added, parents before children
+        self.branches = {}
+        # hash of a missing parent -> root entries waiting for it
+        self.orphans = {}
+        self.observers = []
+        self.tip = None
+        # tip's ancestors, by height
+        self.chain = []
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, blockhash):
+        return blockhash in self.entries
+
+    def get(self, blockhash):
+        return self.entries.get(blockhash)
+
+    # Add (or replace) a header, returns its HeaderEntry
+    def add(self, header):
+        entry = self.entries.get(header.sha256)
+        if entry is not None:
+            entry.header = header
+            return entry
+        parent = self.entries.get(header.hashPrevBlock)
+        if parent is not None and self.contains(parent):
+            entry = HeaderEntry(header, parent, self.chain)
+        else:
+            entry = HeaderEntry(header, parent)
+        self.entries[entry.hash] = entry
+        if entry.parent is None:
+            self.branches[entry] = [entry]
+            self.orphans.setdefault(header.hashPrevBlock, []).append(entry)
+        else:
+            self.branches[entry.root].append(entry)
+        moved = []
+        for root in self.orphans.pop(entry.hash, ()):
+            moved += self._attach(root, entry)
+        for observer in self.observers:
+            observer(entry, moved)
+        return entry
+
+    # Link the branch of root under its parent, which just arrived.
+    # Returns the entries relinked.
+    def _attach(self, root, parent):
+        moved = self.branches.pop(root)
+        relink_tip = self.tip is not None and self.tip.root is root
+        root.link(parent)
+        for entry in moved[1:]:
+            entry.link(entry.parent)
+        self.branches[parent.root].extend(moved)
+        if relink_tip:
+            # The heights of the tip's branch changed
+            del self.chain[:]
+            self.set_tip(self.tip)
+        return moved
+
+    def set_tip(self, entry):
+        self.tip = entry
+        chain = self.chain
+        if entry is None:
+            del chain[:]
+            return
+        del chain[entry.height + 1:]
+        if len(chain) <= entry.height:
+            chain.extend([None] * (entry.height + 1 - len(chain)))
+        walk = entry
+        while walk is not None and chain[walk.height] is not walk:
+            chain[walk.height] = walk
+            walk = walk.parent
+
+    def contains(self, entry):
+        """Whether entry is on the tip's branch."""
+        return entry.height < len(self.chain) and self.chain[entry.height] is entry
+
+    # Ancestor of entry at height
+    def ancestor(self, entry, height):
+        if self.contains(entry):
+            return self.chain[height] if 0 <= height <= entry.height else None
+        return entry.get_ancestor(height)
+
+    # The entries of entry's branch from height start to height end
+    # (inclusive), as a slice of the chain when entry is on it
+    def range(self, entry, start, end):
+        if self.contains(entry):
+            return self.chain[start:end + 1]
+        entries = []
+        walk = entry.get_ancestor(end)
+        while walk is not None and walk.height >= start:
+            entries.append(walk)
+            walk = walk.parent
+        entries.reverse()
+        return entries
+
+# A change of best tip that isn't an extension of the old one.
+# disconnected: the entries of the old branch, old tip first
+# connected: the entries of the new branch, first after the fork first
+# fork: their last common ancestor (None when on unconnected branches)
+Reorg = namedtuple("Reorg", "fork disconnected connected")
+
+def reorg_path(old, new):
+    """Reorg from HeaderEntry old to HeaderEntry new."""
+    disconnected = []
+    connected = []
+    while old is not None and (new is None or old.height > new.height):
+        disconnected.append(old)
+        old = old.parent
+    while new is not None and (old is None or new.height > old.height):
+        connected.append(new)
+        new = new.parent
+    while old is not new:
+        disconnected.append(old)
+        connected.append(new)
+        old = old.parent
+        new = new.parent
+    connected.reverse()
+    return Reorg(old, disconnected, connected)
+
+class ChainState(object):
+    """Best chain of a HeaderIndex by chainwork.
+
+    Follows the headers added to the index: each one is compared with the
+    best tip by the chainwork of its branch, the first seen winning ties,
+    so keeping the best tip is O(1) per header.  tips are the entries
+    without children, one per branch.  Each time the best tip moves to
+    another branch the Reorg is kept in reorgs (the last MAX_REORGS).
+    """
+    MAX_REORGS = 1000
+
+    def __init__(self, headers):
+        self.headers = headers
+        self.tip = None
+        self.tips = set()
+        self.reorgs = deque(maxlen=self.MAX_REORGS)
+        self.reorg_count = 0
+        self.max_reorg_depth = 0
+        for entry in self.headers.entries.values():
+            self._header_added(entry, ())
+        headers.observers.append(self._header_added)
+
+    def _header_added(self, entry, moved):
+        tips = self.tips
+        tips.discard(entry.parent)
+        tips.add(entry)
+        best = self.tip
+        if best is None or entry.chainwork > best.chainwork:
+            best = entry
+        for relinked in moved:
+            tips.discard(relinked.parent)
+            if relinked.chainwork > best.chainwork:
+                best = relinked
+        if best is not self.tip:
+            self._set_tip(best)
+
+    def _set_tip(self, entry):
+        old = self.tip
+        self.tip = entry
+        if old is None or entry.parent is old:
+            return
+        reorg = reorg_path(old, entry)
+        if not reorg.disconnected:
+            return
+        self.reorgs.append(reorg)
+        self.reorg_count += 1
+        self.max_reorg_depth = max(self.max_reorg_depth, len(reorg.disconnected))
+
+    # Last common ancestor of the best tip and entry
+    def fork_point(self, entry):
+        return reorg_path(self.tip, entry).fork
+
+    # The branches, best first: (tip, fork point with the best chain)
+    def branches(self):
+        return [(tip, self.fork_point(tip))
+                for tip in sorted(self.tips, key=lambda e: (-e.chainwork, e is not self.tip))]
+
 class BlockStore(object):
     """BlockStore helper class.
 
     BlockStore keeps a map of blocks and implements helper functions for
     responding to getheaders and getdata, and for constructing a getheaders
-    message.
+    message.  The headers of the blocks (and those added with add_header)
+    are kept in a HeaderIndex, whose chain follows currentBlock, and
+    chainstate follows their best chain.
     """
 
-    def __init__(self, datadir):
-        self.blockDB = dbmd.open(datadir + "/blocks", 'c')
+    def __init__(self, datadir, sync_every=0):
+        self.blockDB = RecordStore(datadir + "/blocks.dat", sync_every)
         self.currentBlock = 0
-        self.headers_map = dict()
+        self.headers = HeaderIndex()
+        self.chainstate = ChainState(self.headers)
 
     def close(self):
         self.blockDB.close()
 
     def erase(self, blockhash):
-        del self.blockDB[repr(blockhash)]
+        self.blockDB.erase(ser_uint256(blockhash))
 
-    # lookup an entry and return the item as raw bytes
+    # lookup an entry and return the item as a read-only memoryview of the
+    # raw bytes (valid after close() too)
     def get(self, blockhash):
-        value = None
-        try:
-            value = self.blockDB[repr(blockhash)]
-        except KeyError:
-            return None
-        return value
+        return self.blockDB.get(ser_uint256(blockhash))
 
     # lookup an entry and return it as a CBlock
-    def get_block(self, blockhash):
+    # lazy: only decode the transactions when they are accessed
+    def get_block(self, blockhash, lazy=False):
         ret = None
         serialized_block = self.get(blockhash)
         if serialized_block is not None:
-            f = BytesIO(serialized_block)
+            f = BytesReader(serialized_block)
             ret = CBlock()
-            ret.deserialize(f)
+            ret.deserialize(f, lazy)
             ret.calc_sha256()
         return ret
 
     def get_header(self, blockhash):
-        try:
-            return self.headers_map[blockhash]
-        except KeyError:
+        entry = self.headers.get(blockhash)
+        if entry is None:
             return None
+        return entry.header
 
-    # Note: this pulls full blocks out of the database just to retrieve
-    # the headers -- perhaps we could keep a separate data structure
-    # to avoid this overhead.
+    # The headers from the last block of the locator on current_tip's
+    # branch (or from the start of the branch) up to 2000 headers, to
+    # hash_stop or to current_tip
     def headers_for(self, locator, hash_stop, current_tip=None):
         if current_tip is None:
             current_tip = self.currentBlock
-        current_block_header = self.get_header(current_tip)
-        if current_block_header is None:
+        tip = self.headers.get(current_tip)
+        if tip is None:
             return None
 
         response = msg_headers()
-        headersList = [ current_block_header ]
         maxheaders = 2000
-        while (headersList[0].sha256 not in locator.vHave):
-            prevBlockHash = headersList[0].hashPrevBlock
-            prevBlockHeader = self.get_header(prevBlockHash)
-            if prevBlockHeader is not None:
-                headersList.insert(0, prevBlockHeader)
-            else:
-                break
-        headersList = headersList[:maxheaders] # truncate if we have too many
-        hashList = [x.sha256 for x in headersList]
-        index = len(headersList)
-        if (hash_stop in hashList):
-            index = hashList.index(hash_stop)+1
-        response.headers = headersList[:index]
+        start = 0
+        for blockhash in locator.vHave:
+            entry = self.headers.get(blockhash)
+            if (entry is not None and entry.height > start
+                    and self.headers.ancestor(tip, entry.height) is entry):
+                start = entry.height
+        end = min(tip.height, start + maxheaders - 1)
+        stop = self.headers.get(hash_stop)
+        if (stop is not None and start <= stop.height < end
+                and self.headers.ancestor(tip, stop.height) is stop):
+            end = stop.height
+        response.headers = [entry.header for entry in self.headers.range(tip, start, end)]
         return response
 
     def add_block(self, block):
         block.calc_sha256()
-        try:
-            self.blockDB[repr(block.sha256)] = bytes(block.serialize())
-        except TypeError as e:
-            logger.exception("Unexpected error")
+        self.blockDB.put(ser_uint256(block.sha256), block.serialize())
         self.currentBlock = block.sha256
-        self.headers_map[block.sha256] = CBlockHeader(block)
+        self.headers.set_tip(self.headers.add(CBlockHeader(block)))
+
+    # Add many blocks at once: serialized in one pass, written with one
+    # write, and the last one becomes currentBlock
+    def add_blocks(self, blocks):
+        if not blocks:
+            return
+        records = []
+        for block in blocks:
+            block.calc_sha256()
+            records.append((ser_uint256(block.sha256), block.serialize()))
+        self.blockDB.put_many(records)
+        headers = self.headers
+        for block in blocks:
+            # Moving the tip along finds the skip pointers on the chain
+            headers.set_tip(headers.add(CBlockHeader(block)))
+        self.currentBlock = blocks[-1].sha256
 
     def add_header(self, header):
-        self.headers_map[header.sha256] = header
+        self.headers.add(header)
 
     # lookup the hashes in "inv", and return p2p messages for delivering
     # blocks found.
@@ -113,13 +603,11 @@ class BlockStore(object):
         r = []
         counter = 0
         step = 1
-        lastBlock = self.get_block(current_tip)
-        while lastBlock is not None:
-            r.append(lastBlock.hashPrevBlock)
-            for i in range(step):
-                lastBlock = self.get_block(lastBlock.hashPrevBlock)
-                if lastBlock is None:
-                    break
+        tip = self.headers.get(current_tip)
+        height = tip.height if tip is not None else -1
+        while height >= 0:
+            r.append(self.headers.ancestor(tip, height).header.hashPrevBlock)
+            height -= step
             counter += 1
             if counter > 10:
                 step *= 2
@@ -128,26 +616,22 @@ class BlockStore(object):
         return locator
 
 class TxStore(object):
-    def __init__(self, datadir):
-        self.txDB = dbmd.open(datadir + "/transactions", 'c')
+    def __init__(self, datadir, sync_every=0):
+        self.txDB = RecordStore(datadir + "/transactions.dat", sync_every)
 
     def close(self):
         self.txDB.close()
 
-    # lookup an entry and return the item as raw bytes
+    # lookup an entry and return the item as a read-only memoryview of the
+    # raw bytes
     def get(self, txhash):
-        value = None
-        try:
-            value = self.txDB[repr(txhash)]
-        except KeyError:
-            return None
-        return value
+        return self.txDB.get(ser_uint256(txhash))
 
     def get_transaction(self, txhash):
         ret = None
         serialized_tx = self.get(txhash)
         if serialized_tx is not None:
-            f = BytesIO(serialized_tx)
+            f = BytesReader(serialized_tx)
             ret = CTransaction()
             ret.deserialize(f)
             ret.calc_sha256()
@@ -155,10 +639,14 @@ class TxStore(object):
 
     def add_transaction(self, tx):
         tx.calc_sha256()
-        try:
-            self.txDB[repr(tx.sha256)] = bytes(tx.serialize())
-        except TypeError as e:
-            logger.exception("Unexpected error")
+        self.txDB.put(ser_uint256(tx.sha256), tx.serialize())
+
+    def add_transactions(self, txs):
+        records = []
+        for tx in txs:
+            tx.calc_sha256()
+            records.append((ser_uint256(tx.sha256), tx.serialize()))
+        self.txDB.put_many(records)
 
     def get_transactions(self, inv):
         responses = []
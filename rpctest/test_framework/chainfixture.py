@@ -0,0 +1,287 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Synthetic block chains saved as binary fixtures.
+
+generate_chain() builds a deterministic regtest chain offline with
+create_block() and create_coinbase() and saves it; ChainFixture maps the
+file back without decoding anything until it is asked for:
+
+    fixture = ChainFixture.cached(os.path.join(cachedir, "chain-10000.fixture"), 10000)
+    fixture.header(10000), fixture.block(5000), fixture.transaction(txid)
+    block_store.add_blocks(fixture.blocks())
+    fixture.submit(node)            # instead of mining with generate()
+    fixture.close()
+
+Heights count from the genesis block, which is not in the fixture (as in
+loadgen.SyntheticChain).  Block h has time start_time + h * spacing and a
+coinbase paying to OP_TRUE, or to pubkey_of(h).  With spend, each block
+after COINBASE_MATURITY also has a transaction spending the coinbase of
+the block COINBASE_MATURITY below it (if that one pays to OP_TRUE), so the
+chain is valid for a regtest node.
+
+File format: FILE_HEADER (FILE_MAGIC, FORMAT_VERSION, the parameters and
+the number of blocks and of transactions), then
+
+    32 bytes * blocks          block hashes, by height from 1
+    uint64 * (blocks + 1)      offsets of the blocks, and of the end of the
+                               last one
+    (32 bytes, uint64, uint32) * transactions
+                               txid, offset and length of the transactions
+                               the blocks, serialized
+"""
+
+import mmap
+import os
+import struct
+
+from .blocktools import create_block, create_coinbase, create_transaction
+from .loadgen import REGTEST_GENESIS
+from .mininode import BytesReader, CBlock, CBlockHeader, CTransaction, ser_compact_size, ser_uint256, uint256_from_str
+from .script import CScript, OP_TRUE
+
+FILE_MAGIC = b"rpcchain"
+FORMAT_VERSION = 1
+
+# magic, format version, genesis hash, start_time, spacing, flags, blocks,
+# transactions
+FILE_HEADER = struct.Struct("<8sI32sIIIII")
+_offset = struct.Struct("<Q")
+_tx_entry = struct.Struct("<32sQI")
+
+# flags
+SPEND = 1
+# Some coinbases pay to pubkey_of(height): not reused by cached()
+CUSTOM_COINBASES = 2
+
+COINBASE_MATURITY = 100
+
+# Time of the genesis block of the fixtures, the blocks follow it
+DEFAULT_START_TIME = 1500000000
+
+
+def generate_chain(path, length, genesis=REGTEST_GENESIS, start_time=DEFAULT_START_TIME,
+                   spacing=600, spend=True, pubkey_of=None):
+    """Build a chain of length blocks on genesis and save it at path.
+
+    pubkey_of(height) may give a pubkey (bytes) for the coinbase of the
+    block to pay to, instead of OP_TRUE.  The file is written under
+    another name and moved into place.  Returns the ChainFixture.
+    """
+    flags = (SPEND if spend else 0) | (CUSTOM_COINBASES if pubkey_of is not None else 0)
+    hashes = []
+    blocks = []
+    txs = []
+    coinbases = []
+    blockhash = genesis
+    for height in range(1, length + 1):
+        pubkey = pubkey_of(height) if pubkey_of is not None else None
+        coinbase = create_coinbase(height, pubkey)
+        block = create_block(blockhash, coinbase, start_time + height * spacing)
+        block.nVersion = 4
+        coinbases.append((coinbase, pubkey))
+        if spend and height > COINBASE_MATURITY:
+            mature, mature_pubkey = coinbases[height - 1 - COINBASE_MATURITY]
+            if mature_pubkey is None:
+                block.vtx.append(create_transaction(mature, 0, b"", mature.vout[0].nValue,
+                                                    CScript([OP_TRUE])))
+        block.hashMerkleRoot = block.calc_merkle_root()
+        block.solve()
+        blockhash = block.sha256
+        hashes.append(ser_uint256(blockhash))
+        # The block as CBlock.serialize() has it, with the transactions
+        # apart to index them
+        raw_txs = [tx.serialize() for tx in block.vtx]
+        blocks.append((CBlockHeader.serialize(block) + ser_compact_size(len(raw_txs)), raw_txs))
+        txs.extend((ser_uint256(tx.sha256), len(raw)) for tx, raw in zip(block.vtx, raw_txs))
+
+    data_start = (FILE_HEADER.size + 32 * length + _offset.size * (length + 1)
+                  + _tx_entry.size * len(txs))
+    offsets = []
+    tx_entries = []
+    position = data_start
+    tx_index = 0
+    for header, raw_txs in blocks:
+        offsets.append(_offset.pack(position))
+        position += len(header)
+        for raw in raw_txs:
+            txid, size = txs[tx_index]
+            tx_entries.append(_tx_entry.pack(txid, position, size))
+            position += size
+            tx_index += 1
+    offsets.append(_offset.pack(position))
+
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    partial = path + ".partial"
+    with open(partial, "wb") as f:
+        f.write(FILE_HEADER.pack(FILE_MAGIC, FORMAT_VERSION, ser_uint256(genesis), start_time,
+                                 spacing, flags, length, len(txs)))
+        f.write(b"".join(hashes))
+        f.write(b"".join(offsets))
+        f.write(b"".join(tx_entries))
+        for header, raw_txs in blocks:
+            f.write(header)
+            f.write(b"".join(raw_txs))
+    os.replace(partial, path)
+    return ChainFixture(path)
+
+
+class ChainFixture(object):
+    """A chain saved by generate_chain(), read through mmap.
+
+    The raw blocks and transactions are memoryviews of the mapping, and
+    blocks() gives lazy CBlocks that keep theirs without copying.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self.map) < FILE_HEADER.size or self.map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a chain fixture" % path)
+        (magic, version, genesis, self.start_time, self.spacing, self.flags,
+         self.length, self.tx_count) = FILE_HEADER.unpack_from(self.map, 0)
+        if version != FORMAT_VERSION:
+            self.map.close()
+            raise ValueError("%s: fixture format version %d, expected %d" % (path, version, FORMAT_VERSION))
+        self.genesis = int.from_bytes(genesis, "little")
+        self.view = memoryview(self.map)
+        self.hashes_start = FILE_HEADER.size
+        self.offsets_start = self.hashes_start + 32 * self.length
+        self.txs_start = self.offsets_start + _offset.size * (self.length + 1)
+        # Built on first use: hash (bytes) -> height, txid (bytes) -> tx
+        # table entry
+        self._heights = None
+        self._txids = None
+
+    @classmethod
+    def cached(cls, path, length, genesis=REGTEST_GENESIS, start_time=DEFAULT_START_TIME,
+               spacing=600, spend=True):
+        """The fixture at path if it has these parameters, else a new one
+        generated there."""
+        if os.path.exists(path):
+            try:
+                fixture = cls(path)
+            except ValueError:
+                fixture = None
+            if fixture is not None:
+                if (fixture.length == length and fixture.genesis == genesis
+                        and fixture.start_time == start_time and fixture.spacing == spacing
+                        and fixture.flags == (SPEND if spend else 0)):
+                    return fixture
+                fixture.close()
+        return generate_chain(path, length, genesis, start_time, spacing, spend)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Blocks are still referenced; the mapping goes with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __len__(self):
+        return self.length
+
+    def height(self):
+        return self.length
+
+    def block_hash(self, height):
+        if height == 0:
+            return self.genesis
+        start = self.hashes_start + 32 * (height - 1)
+        return int.from_bytes(self.view[start:start + 32], "little")
+
+    # Height of a block hash, None if it isn't in the fixture
+    def height_of(self, blockhash):
+        if self._heights is None:
+            table = self.map[self.hashes_start:self.offsets_start]
+            self._heights = dict((table[i:i + 32], i // 32 + 1) for i in range(0, len(table), 32))
+        return self._heights.get(ser_uint256(blockhash))
+
+    # The hash of a header is in the hash table, no need to hash it again
+    def _set_hash(self, header, height):
+        start = self.hashes_start + 32 * (height - 1)
+        h = self.map[start:start + 32]
+        header.sha256 = uint256_from_str(h)
+        header.hash = h[::-1].hex()
+
+    def raw_block(self, height):
+        start, end = struct.unpack_from("<QQ", self.view, self.offsets_start + _offset.size * (height - 1))
+        return self.view[start:end]
+
+    def header(self, height):
+        header = CBlockHeader()
+        header.deserialize(BytesReader(self.raw_block(height)[:80]))
+        self._set_hash(header, height)
+        return header
+
+    def block(self, height, lazy=True):
+        block = CBlock()
+        block.deserialize(BytesReader(self.raw_block(height)), lazy)
+        self._set_hash(block, height)
+        return block
+
+    # Blocks start to end (inclusive, default the tip)
+    def blocks(self, start=1, end=None, lazy=True):
+        if end is None:
+            end = self.length
+        return [self.block(height, lazy) for height in range(start, end + 1)]
+
+    def headers(self, start=1, end=None):
+        if end is None:
+            end = self.length
+        return [self.header(height) for height in range(start, end + 1)]
+
+    def raw_transaction(self, txid):
+        if self._txids is None:
+            table = self.map[self.txs_start:self.txs_start + _tx_entry.size * self.tx_count]
+            self._txids = dict((table[i:i + 32], i) for i in range(0, len(table), _tx_entry.size))
+        entry = self._txids.get(ser_uint256(txid))
+        if entry is None:
+            return None
+        offset, size = struct.unpack_from("<QI", self.view, self.txs_start + entry + 32)
+        return self.view[offset:offset + size]
+
+    def transaction(self, txid):
+        raw = self.raw_transaction(txid)
+        if raw is None:
+            return None
+        tx = CTransaction()
+        tx.deserialize(BytesReader(raw))
+        tx.calc_sha256()
+        return tx
+
+    # txid (bytes) and raw transaction of all the transactions, in order
+    def raw_transactions(self):
+        view = self.view
+        end = self.txs_start + _tx_entry.size * self.tx_count
+        return [(txid, view[offset:offset + size])
+                for txid, offset, size in _tx_entry.iter_unpack(self.map[self.txs_start:end])]
+
+    # Load the blocks (and their transactions) into a BlockStore and
+    # TxStore.  The transactions go in as they are in the file, without
+    # decoding them.
+    def load_into(self, block_store, tx_store=None):
+        block_store.add_blocks(self.blocks())
+        if tx_store is not None:
+            tx_store.txDB.put_many(self.raw_transactions())
+
+    # submitblock the blocks start to end to a node, over RPC
+    def submit(self, node, start=1, end=None):
+        if end is None:
+            end = self.length
+        for height in range(start, end + 1):
+            result = node.submitblock(bytes(self.raw_block(height)).hex())
+            if result is not None:
+                raise AssertionError("submitblock of block %d: %s" % (height, result))
@@ -196,10 +196,11 @@ class TestManager(object):
             return all(node.verack_received for node in self.test_nodes)
         return wait_until(veracked, timeout=10)
 
+    # Each node's pong is waited for on that node's own lock, which only its
+    # deliveries notify
     def wait_for_pings(self, counter):
-        def received_pongs():
-            return all(node.received_ping_response(counter) for node in self.test_nodes)
-        return wait_until(received_pongs)
+        return all(node.wait_until(lambda node=node: node.received_ping_response(counter))
+                   for node in self.test_nodes)
 
     # sync_blocks: Wait for all connections to request the blockhash given
     # then send get_headers to find out the tip of each node, and synchronize
@@ -295,6 +296,37 @@ class TestManager(object):
                     return False
             return True
 
+    # Add to shared block_store, set the last one as current block
+    # If there was an open getdata request for a block previously, and we
+    # didn't have an entry in the block_store, then immediately deliver,
+    # because the node wouldn't send another getdata request while the
+    # earlier one is outstanding.
+    def add_blocks(self, blocks):
+        first_with_hash = []
+        added = set()
+        for block in blocks:
+            first_with_hash.append(block.sha256 not in added and self.block_store.get(block.sha256) is None)
+            added.add(block.sha256)
+        with mininode_lock:
+            self.block_store.add_blocks(blocks)
+            for block, first_block_with_hash in zip(blocks, first_with_hash):
+                for c in self.connections:
+                    if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
+                        # There was a previous request for this block hash
+                        # Most likely, we delivered a header for this block
+                        # but never had the block to respond to the getdata
+                        c.send_message(msg_block(block))
+                    else:
+                        c.cb.block_request_map[block.sha256] = False
+
+    # Add to shared tx store and clear map entries
+    def add_transactions(self, txs):
+        with mininode_lock:
+            self.tx_store.add_transactions(txs)
+            for tx in txs:
+                for c in self.connections:
+                    c.cb.tx_request_map[tx.sha256] = False
+
     def run(self):
         # Wait until verack is received
         self.wait_for_verack()
@@ -307,10 +339,21 @@ class TestManager(object):
             [ block, block_outcome, tip ] = [ None, None, None ]
             [ tx, tx_outcome ] = [ None, None ]
             invqueue = []
+            # Blocks and transactions that aren't synced one at a time
+            # are added to the stores in batches, before anything else is
+            # sent
+            pending_blocks = []
+            pending_txs = []
 
             for test_obj in test_instance.blocks_and_transactions:
                 b_or_t = test_obj[0]
                 outcome = test_obj[1]
+                if pending_blocks and not isinstance(b_or_t, CBlock):
+                    self.add_blocks(pending_blocks)
+                    pending_blocks = []
+                if pending_txs and not isinstance(b_or_t, CTransaction):
+                    self.add_transactions(pending_txs)
+                    pending_txs = []
                 # Determine if we're dealing with a block or tx
                 if isinstance(b_or_t, CBlock):  # Block test runner
                     block = b_or_t
@@ -322,28 +365,10 @@ class TestManager(object):
                     if len(test_obj) >= 3:
                         tip = test_obj[2]
 
-                    # Add to shared block_store, set as current block
-                    # If there was an open getdata request for the block
-                    # previously, and we didn't have an entry in the
-                    # block_store, then immediately deliver, because the
-                    # node wouldn't send another getdata request while
-                    # the earlier one is outstanding.
-                    first_block_with_hash = True
-                    if self.block_store.get(block.sha256) is not None:
-                        first_block_with_hash = False
-                    with mininode_lock:
-                        self.block_store.add_block(block)
-                        for c in self.connections:
-                            if first_block_with_hash and block.sha256 in c.cb.block_request_map and c.cb.block_request_map[block.sha256] == True:
-                                # There was a previous request for this block hash
-                                # Most likely, we delivered a header for this block
-                                # but never had the block to respond to the getdata
-                                c.send_message(msg_block(block))
-                            else:
-                                c.cb.block_request_map[block.sha256] = False
                     # Either send inv's to each node and sync, or add
                     # to invqueue for later inv'ing.
                     if (test_instance.sync_every_block):
+                        self.add_blocks([block])
                         # if we expect success, send inv and sync every block
                         # if we expect failure, just push the block and see what happens.
                         if outcome == True:
@@ -357,6 +382,7 @@ class TestManager(object):
                         if (not self.check_results(tip, outcome)):
                             raise AssertionError("Test failed at test %d" % test_number)
                     else:
+                        pending_blocks.append(block)
                         invqueue.append(CInv(2, block.sha256))
                 elif isinstance(b_or_t, CBlockHeader):
                     block_header = b_or_t
@@ -367,23 +393,30 @@ class TestManager(object):
                     assert(isinstance(b_or_t, CTransaction))
                     tx = b_or_t
                     tx_outcome = outcome
-                    # Add to shared tx store and clear map entry
-                    with mininode_lock:
-                        self.tx_store.add_transaction(tx)
-                        for c in self.connections:
-                            c.cb.tx_request_map[tx.sha256] = False
                     # Again, either inv to all nodes or save for later
                     if (test_instance.sync_every_tx):
+                        self.add_transactions([tx])
                         [ c.cb.send_inv(tx) for c in self.connections ]
                         self.sync_transaction(tx.sha256, 1)
                         if (not self.check_mempool(tx.sha256, outcome)):
                             raise AssertionError("Test failed at test %d" % test_number)
                     else:
+                        pending_txs.append(tx)
                         invqueue.append(CInv(1, tx.sha256))
                 # Ensure we're not overflowing the inv queue
                 if len(invqueue) == MAX_INV_SZ:
+                    if pending_blocks:
+                        self.add_blocks(pending_blocks)
+                        pending_blocks = []
+                    if pending_txs:
+                        self.add_transactions(pending_txs)
+                        pending_txs = []
                     [ c.send_message(msg_inv(invqueue)) for c in self.connections ]
                     invqueue = []
+            if pending_blocks:
+                self.add_blocks(pending_blocks)
+            if pending_txs:
+                self.add_transactions(pending_txs)
 
             # Do final sync if we weren't syncing on every block or every tx.
             if (not test_instance.sync_every_block and block is not None):
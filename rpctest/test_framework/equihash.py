@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Equihash solution verification (Zcash/Komodo proof of work).
+
+is_valid_solution() checks one solution the way zcashd/komodod's
+Equihash<N,K>::IsValidSolution does.  EquihashVerifier spreads the checks
+for many headers over a process pool:
+
+    with EquihashVerifier() as verifier:
+        results = verifier.verify_headers(headers)
+
+Nothing beyond the standard library is needed (blake2b is in hashlib).
+"""
+
+import hashlib
+import os
+import struct
+from concurrent.futures import ProcessPoolExecutor
+
+from .mininode import BytesReader, CKomodoBlockHeader
+
+# Komodo's parameters
+EQUIHASH_N = 200
+EQUIHASH_K = 9
+
+
+def _solution_indexes(solution, bits):
+    """Unpack the big endian `bits`-bit indexes of a minimal solution."""
+    count = len(solution) * 8 // bits
+    value = int.from_bytes(solution, 'big')
+    mask = (1 << bits) - 1
+    return [(value >> (bits * (count - 1 - i))) & mask for i in range(count)]
+
+
+def is_valid_solution(header, solution, n=EQUIHASH_N, k=EQUIHASH_K):
+    """Check an Equihash solution.
+
+    header: the serialized header without the solution (140 bytes for
+    Komodo), solution: the minimal (packed) solution.
+    """
+    collision_bits = n // (k + 1)
+    count = 1 << k
+    if len(solution) * 8 != count * (collision_bits + 1):
+        return False
+    indexes = _solution_indexes(solution, collision_bits + 1)
+    if len(set(indexes)) != count:
+        return False
+
+    # Each blake2b output holds the n-bit hashes of several indexes
+    per_output = 512 // n
+    hash_bytes = n // 8
+    state = hashlib.blake2b(digest_size=per_output * hash_bytes,
+                            person=b"ZcashPoW" + struct.pack("<II", n, k))
+    state.update(header)
+    outputs = {}
+    level = []
+    for i in indexes:
+        block, offset = divmod(i, per_output)
+        out = outputs.get(block)
+        if out is None:
+            h = state.copy()
+            h.update(struct.pack("<I", block))
+            out = outputs[block] = h.digest()
+        level.append((int.from_bytes(out[offset * hash_bytes:(offset + 1) * hash_bytes], 'big'),
+                      i))
+
+    # Adjacent pairs must collide on the next collision_bits bits and be
+    # ordered by their first index; the xor of everything must be zero.
+    for r in range(1, k + 1):
+        shift = n - r * collision_bits
+        merged = []
+        for j in range(0, len(level), 2):
+            (a, first_a), (b, first_b) = level[j], level[j + 1]
+            x = a ^ b
+            if x >> shift:
+                return False
+            if first_b < first_a:
+                return False
+            merged.append((x, first_a))
+        level = merged
+    return level[0][0] == 0
+
+
+def _verify_serialized(raw):
+    header = CKomodoBlockHeader()
+    header.deserialize(BytesReader(raw))
+    return is_valid_solution(header.get_equihash_input(), header.nSolution)
+
+
+class EquihashVerifier(object):
+    """Verify the Equihash solutions of many headers on a process pool."""
+
+    def __init__(self, processes=None, chunksize=64):
+        self.processes = processes or os.cpu_count() or 1
+        self.chunksize = chunksize
+        self.executor = ProcessPoolExecutor(self.processes)
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    # headers: CKomodoBlockHeader objects or their serializations.
+    # Returns a bool per header.
+    def verify_headers(self, headers):
+        raws = [h if isinstance(h, (bytes, bytearray)) else h.serialize() for h in headers]
+        return list(self.executor.map(_verify_serialized, raws, chunksize=self.chunksize))
+
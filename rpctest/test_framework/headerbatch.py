@@ -0,0 +1,285 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Batch validation of block headers.
+
+HeaderBatch keeps the headers of a headers message in the buffer they
+arrived in and checks the whole run at once: hashPrevBlock linkage, proof
+of work against nBits and the median-time-past rule.  With numpy the records
+are viewed as a structured array and the checks are array operations;
+without numpy the same checks run in a python loop.
+
+    batch = HeaderBatch.from_headers_payload(payload)
+    bad = batch.first_invalid(prev_hash=tip.sha256)
+    if bad is not None:
+        index, reason = bad
+"""
+
+import hashlib
+import struct
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .equihash import is_valid_solution
+from .mininode import (
+    EQUIHASH_SOLUTION_SIZE,
+    BytesReader,
+    CBlockHeader,
+    CKomodoBlockHeader,
+    Hash256,
+    ser_uint256,
+)
+
+_uint32 = struct.Struct("<I")
+
+# Number of previous blocks used for the median time past
+MEDIAN_TIME_SPAN = 11
+
+
+class HeaderBatch(object):
+    """A run of serialized block headers, consecutive in one buffer.
+
+    Each record is `stride` bytes, of which the first SIZE are the header
+    (a headers message adds a transaction count byte to each record).
+    """
+
+    SIZE = 80
+    # (name, numpy format, offset)
+    FIELDS = (
+        ("nVersion", "<i4", 0),
+        ("hashPrevBlock", ("u1", 32), 4),
+        ("hashMerkleRoot", ("u1", 32), 36),
+        ("nTime", "<u4", 68),
+        ("nBits", "<u4", 72),
+        ("nNonce", "<u4", 76),
+    )
+    header_class = CBlockHeader
+
+    def __init__(self, data, count=None, stride=None):
+        self.data = memoryview(data).cast("B")
+        self.stride = self.SIZE if stride is None else stride
+        if count is None:
+            count = len(self.data) // self.stride
+        if count * self.stride > len(self.data):
+            raise ValueError("%d headers don't fit in %d bytes" % (count, len(self.data)))
+        self.count = count
+        self._hashes = None
+
+    # Wrap the payload of a headers message (compact size + records of
+    # a header followed by a zero transaction count).
+    @classmethod
+    def from_headers_payload(cls, payload):
+        f = BytesReader(payload)
+        count = f.read_compact_size()
+        stride = cls.SIZE + 1
+        batch = cls(f.read(count * stride), count, stride)
+        if batch.data[cls.SIZE::stride].tobytes().count(0) != count:
+            raise ValueError("headers message with transactions")
+        return batch
+
+    def __len__(self):
+        return self.count
+
+    def get_raw(self, i):
+        offset = i * self.stride
+        return self.data[offset:offset + self.SIZE]
+
+    # Double SHA256 of every header, concatenated (32 bytes each)
+    def get_hashes(self):
+        if self._hashes is None:
+            sha256 = hashlib.sha256
+            data = self.data
+            size = self.SIZE
+            self._hashes = b"".join([sha256(sha256(data[o:o + size]).digest()).digest()
+                                     for o in range(0, self.count * self.stride, self.stride)])
+        return self._hashes
+
+    def get_hash(self, i):
+        return Hash256(self.get_hashes()[32 * i:32 * i + 32])
+
+    # The headers as CBlockHeader objects, with sha256/hash already set
+    def get_headers(self):
+        hashes = self.get_hashes()
+        r = []
+        for i in range(self.count):
+            header = self.header_class()
+            header.deserialize(BytesReader(self.get_raw(i)))
+            h = hashes[32 * i:32 * i + 32]
+            header.sha256 = int.from_bytes(h, 'little')
+            header.hash = h[::-1].hex()
+            r.append(header)
+        return r
+
+    # Validate the run of headers.  prev_hash is the hash the first header
+    # must build on, prev_times the timestamps of the blocks before it
+    # (oldest first) for the median time past check; either may be omitted.
+    # Returns None if all headers pass, else (index, reason) of the first
+    # one that doesn't.
+    def first_invalid(self, prev_hash=None, prev_times=()):
+        if self.count == 0:
+            return None
+        prev_times = list(prev_times)[-MEDIAN_TIME_SPAN:]
+        if numpy is not None:
+            failures = self._check_numpy(prev_hash, prev_times)
+        else:
+            failures = self._check_python(prev_hash, prev_times)
+        failures = [(index, reason) for index, reason in failures if index is not None]
+        if not failures:
+            return None
+        return min(failures)
+
+    def is_valid(self, prev_hash=None, prev_times=()):
+        return self.first_invalid(prev_hash, prev_times) is None
+
+    def _dtype(self):
+        return numpy.dtype({
+            "names": [name for name, fmt, offset in self.FIELDS],
+            "formats": [fmt for name, fmt, offset in self.FIELDS],
+            "offsets": [offset for name, fmt, offset in self.FIELDS],
+            "itemsize": self.stride,
+        })
+
+    def _check_numpy(self, prev_hash, prev_times):
+        n = self.count
+        records = numpy.frombuffer(self.data, dtype=self._dtype(), count=n)
+        hashes = numpy.frombuffer(self.get_hashes(), dtype=numpy.uint8).reshape(n, 32)
+        rows = numpy.arange(n)
+
+        # Each header's hashPrevBlock is the hash of the one before it
+        linked = numpy.ones(n, dtype=bool)
+        prev = records["hashPrevBlock"]
+        linked[1:] = (prev[1:] == hashes[:-1]).all(axis=1)
+        if prev_hash is not None:
+            linked[0] = prev[0].tobytes() == ser_uint256(prev_hash)
+
+        # Expand nBits into 32-byte little endian targets, the sign bit
+        # left out of the mantissa as in SetCompact()
+        nbits = records["nBits"].astype(numpy.int64)
+        exponent = nbits >> 24
+        mantissa = nbits & 0x007fffff
+        targets = numpy.zeros((n, 32), dtype=numpy.uint8)
+        overflow = numpy.zeros(n, dtype=bool)
+        for k in range(3):
+            pos = exponent - 3 + k
+            byte = (mantissa >> (8 * k)) & 0xff
+            inside = (pos >= 0) & (pos < 32)
+            targets[rows[inside], pos[inside]] = byte[inside]
+            overflow |= (pos >= 32) & (byte != 0)
+        # As CheckProofOfWork(): a negative, zero or overflowing target
+        # fails whatever the hash
+        negative = ((nbits & 0x00800000) != 0) & ((nbits & 0x007fffff) != 0)
+        zero = ~targets.any(axis=1)
+
+        # hash <= target, comparing big endian from the first differing byte
+        h = hashes[:, ::-1]
+        t = targets[:, ::-1]
+        differ = h != t
+        first = differ.argmax(axis=1)
+        pow_ok = ((~differ.any(axis=1) | (h[rows, first] < t[rows, first]))
+                  & ~overflow & ~negative & ~zero)
+
+        # nTime must be above the median of the previous MEDIAN_TIME_SPAN
+        # blocks (fewer at the start of the chain)
+        times = numpy.concatenate((numpy.array(prev_times, dtype=numpy.int64),
+                                   records["nTime"].astype(numpy.int64)))
+        offset = len(prev_times)
+        time_ok = numpy.ones(n, dtype=bool)
+        for i in range(max(1 - offset, 0), min(MEDIAN_TIME_SPAN - offset, n)):
+            time_ok[i] = times[offset + i] > _median(times[:offset + i].tolist())
+        start = MEDIAN_TIME_SPAN - offset
+        if start < n:
+            windows = numpy.lib.stride_tricks.sliding_window_view(times[:-1], MEDIAN_TIME_SPAN)
+            medians = numpy.partition(windows, MEDIAN_TIME_SPAN // 2, axis=1)[:, MEDIAN_TIME_SPAN // 2]
+            time_ok[max(start, 0):] = times[offset + max(start, 0):] > medians[max(-start, 0):]
+
+        return [(_first_false(linked), "bad-prevblk"),
+                (_first_false(pow_ok), "high-hash"),
+                (_first_false(time_ok), "time-too-old")]
+
+    def _check_python(self, prev_hash, prev_times):
+        hashes = self.get_hashes()
+        size = self.SIZE
+        data = self.data
+        offsets = dict((name, offset) for name, fmt, offset in self.FIELDS)
+        prev_offset = offsets["hashPrevBlock"]
+        time_offset = offsets["nTime"]
+        bits_offset = offsets["nBits"]
+        prev_hash = None if prev_hash is None else ser_uint256(prev_hash)
+        times = list(prev_times)
+        failures = {}
+        for i in range(self.count):
+            offset = i * self.stride
+            header = data[offset:offset + size]
+            if prev_hash is not None and header[prev_offset:prev_offset + 32] != prev_hash:
+                failures.setdefault("bad-prevblk", i)
+            h = hashes[32 * i:32 * i + 32]
+            prev_hash = h
+            nTime = _uint32.unpack_from(header, time_offset)[0]
+            nBits = _uint32.unpack_from(header, bits_offset)[0]
+            target = _target(nBits)
+            if (not 0 < target < 1 << 256 or (nBits & 0x00800000 and nBits & 0x007fffff)
+                    or int.from_bytes(h, 'little') > target):
+                failures.setdefault("high-hash", i)
+            if times and nTime <= _median(times[-MEDIAN_TIME_SPAN:]):
+                failures.setdefault("time-too-old", i)
+            times.append(nTime)
+        return [(index, reason) for reason, index in failures.items()]
+
+    def __repr__(self):
+        return "HeaderBatch(count=%i stride=%i)" % (self.count, self.stride)
+
+
+class KomodoHeaderBatch(HeaderBatch):
+    """HeaderBatch of 1487-byte Komodo (Equihash) headers."""
+
+    SIZE = 143 + EQUIHASH_SOLUTION_SIZE
+    FIELDS = (
+        ("nVersion", "<i4", 0),
+        ("hashPrevBlock", ("u1", 32), 4),
+        ("hashMerkleRoot", ("u1", 32), 36),
+        ("hashFinalSaplingRoot", ("u1", 32), 68),
+        ("nTime", "<u4", 100),
+        ("nBits", "<u4", 104),
+        ("nNonce", ("u1", 32), 108),
+        ("nSolution", ("u1", EQUIHASH_SOLUTION_SIZE), 143),
+    )
+    header_class = CKomodoBlockHeader
+
+    # Check the Equihash solutions, on verifier's process pool if given
+    # (see equihash.EquihashVerifier).  Returns the index of the first
+    # header with a bad solution, or None.
+    def first_invalid_solution(self, verifier=None):
+        raws = [self.get_raw(i) for i in range(self.count)]
+        if verifier is not None:
+            results = verifier.verify_headers([raw.tobytes() for raw in raws])
+        else:
+            results = [raw[140:143] == b"\xfd\x40\x05" and is_valid_solution(raw[:140], raw[143:])
+                       for raw in raws]
+        for i, ok in enumerate(results):
+            if not ok:
+                return i
+        return None
+
+
+# The target of nBits as arith_uint256::SetCompact() expands it: the
+# mantissa without its sign bit, also for exponents below 3
+def _target(nBits):
+    exponent = nBits >> 24
+    mantissa = nBits & 0x007fffff
+    if exponent < 3:
+        return mantissa >> (8 * (3 - exponent))
+    return mantissa << (8 * (exponent - 3))
+
+
+# Same as GetMedianTimePast(): the upper middle element for an even count
+def _median(times):
+    return sorted(times)[len(times) // 2]
+
+
+def _first_false(ok):
+    bad = numpy.flatnonzero(~ok)
+    return int(bad[0]) if len(bad) else None
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Simulated full-node peers for load testing the SPV clients.
+
+A PeerSwarm listens on N local ports with a SimPeer behind each accepted
+connection.  The peers share one SyntheticChain of headers: they answer
+getheaders and getdata from it, answer the nSPV requests of nspv, and can
+flood inv and headers announcements of new blocks.  Some peers may be
+slow, answering every request after a delay.
+
+    chain = SyntheticChain(20000)
+    swarm = PeerSwarm(chain, peers=50, slow=10)
+    swarm.start()
+    # ./bitcoin-spv --regtest -i <swarm.addresses()> -m 50 scan
+    swarm.flood(rate=10, count=100)
+    ...
+    swarm.close()
+    print(swarm.summary())
+
+nspv and bitcoin-spv don't check the proof of work of headers (see
+btc_headers_db_connect_hdr), so Komodo headers come with an empty Equihash
+solution.  Regtest headers are ground to meet their nBits (two hashes on
+average) and pass the checks of headerbatch.py too.  Each block is its
+header and a coinbase.
+
+Everything a peer does runs on the AsyncNetworkThread, which also owns
+the chain once started.
+"""
+
+import random
+import struct
+import time
+
+from .blocktools import create_coinbase
+from .mininode import (
+    NODE_NETWORK,
+    AsyncNetworkThread,
+    AsyncNodeConn,
+    CBlockHeader,
+    CInv,
+    CKomodoBlockHeader,
+    NodeConnCB,
+    close_listener,
+    listen,
+    msg_generic,
+    msg_inv,
+    msg_nSPV,
+    network_event_loop,
+    ser_compact_size,
+    ser_uint256,
+    uint256_from_compact,
+)
+
+# Service bit of the full nodes that answer nSPV requests (nSPV_defs.h)
+NODE_NSPV = (1 << 30)
+
+# nSPV request and response types (nSPV_defs.h)
+NSPV_INFO = 0x00
+NSPV_INFORESP = 0x01
+NSPV_NTZS = 0x04
+NSPV_NTZSRESP = 0x05
+NSPV_PROTOCOL_VERSION = 0x00000003
+
+MSG_TX = 1
+MSG_BLOCK = 2
+
+# Most headers in one headers message
+MAX_HEADERS_RESULTS = 2000
+
+REGTEST_GENESIS = 0x0f9188f13cb7b2c71f2a335e3a4fc328bf5beb436012afca590b1a11466e2206
+
+_ntz = struct.Struct("<32s32s32siiI")
+_info = struct.Struct("<ii")
+_int32 = struct.Struct("<i")
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(int(len(values) * p), len(values) - 1)]
+
+
+class SyntheticChain(object):
+    """A chain of headers built on the block hash `genesis`.
+
+    Heights count from the genesis block (height 0), which is not part of
+    the chain.  records[h] is header h serialized as in a headers message
+    (followed by a zero transaction count), hashes[h] its hash as an int.
+    """
+
+    def __init__(self, length=0, genesis=REGTEST_GENESIS, komodo=False, seed=1,
+                 start_time=1500000000, spacing=60):
+        self.komodo = komodo
+        self.rng = random.Random(seed)
+        self.start_time = start_time
+        self.spacing = spacing
+        self.hashes = [genesis]
+        self.records = [None]
+        self.height_of = {genesis: 0}
+        self.extend(length)
+
+    def height(self):
+        return len(self.hashes) - 1
+
+    def tip(self):
+        return self.hashes[-1]
+
+    # Append count headers, returns the height of the new tip
+    def extend(self, count):
+        for i in range(count):
+            height = len(self.hashes)
+            if self.komodo:
+                header = CKomodoBlockHeader()
+                header.nBits = 0x200f0f0f
+                header.nNonce = self.rng.getrandbits(256)
+                header.nSolution = bytes(1344)
+            else:
+                header = CBlockHeader()
+                header.nBits = 0x207fffff
+                header.nNonce = self.rng.getrandbits(32)
+            header.nVersion = 4
+            header.hashPrevBlock = self.hashes[-1]
+            header.hashMerkleRoot = create_coinbase(height).sha256
+            header.nTime = self.start_time + height * self.spacing
+            header.rehash()
+            while not self.komodo and header.sha256 > uint256_from_compact(header.nBits):
+                header.nNonce += 1
+                header.rehash()
+            self.hashes.append(header.sha256)
+            self.records.append(header.serialize() + b"\x00")
+            self.height_of[header.sha256] = height
+        return self.height()
+
+    # Height of the first hash of a block locator that is in the chain,
+    # 0 (the genesis) if none is
+    def locate(self, hashes):
+        for h in hashes:
+            height = self.height_of.get(h)
+            if height is not None:
+                return height
+        return 0
+
+    # Payload of a headers message with the headers after height start, up
+    # to count of them or up to the one with hash stop
+    def headers_payload(self, start, count=MAX_HEADERS_RESULTS, stop=0):
+        end = min(start + count, self.height())
+        if stop:
+            end = min(end, self.height_of.get(stop, end))
+        records = self.records[start + 1:end + 1]
+        return len(records), ser_compact_size(len(records)) + b"".join(records)
+
+    # Payload of the block message of height
+    def block_payload(self, height):
+        return self.records[height][:-1] + ser_compact_size(1) + create_coinbase(height).serialize()
+
+    # Header of height in the layout of struct NSPV_equihdr (with no
+    # length before nSolution)
+    def equihdr(self, height):
+        record = self.records[height]
+        if height == 0:
+            return bytes(140 + 1344)
+        if self.komodo:
+            return record[:140] + record[143:-1]
+        return record[:68] + bytes(32) + record[68:76] + record[76:80] + bytes(28) + bytes(1344)
+
+
+class PeerStats(object):
+    """What one simulated peer did, for PeerSwarm.summary()."""
+    __slots__ = ("index", "port", "delay", "connections", "requests", "headers_sent",
+                 "blocks_sent", "nspv_sent", "bytes_sent", "service", "reaction")
+
+    def __init__(self, index, delay):
+        self.index = index
+        self.port = None
+        self.delay = delay
+        self.connections = 0
+        self.requests = 0
+        self.headers_sent = 0
+        self.blocks_sent = 0
+        self.nspv_sent = 0
+        self.bytes_sent = 0
+        # Seconds from receiving each request to sending the response
+        self.service = []
+        # Seconds from an announcement to the client's request for it
+        self.reaction = []
+
+
+class SimConn(AsyncNodeConn):
+    """AsyncNodeConn whose version message gives the chain height."""
+
+    def _version_message(self, services):
+        vt = super()._version_message(services)
+        vt.nStartingHeight = self.cb.swarm.chain.height()
+        return vt
+
+
+class SimPeer(NodeConnCB):
+    """One connection to a simulated full node of a PeerSwarm."""
+
+    def __init__(self, swarm, stats):
+        super().__init__()
+        self.swarm = swarm
+        self.stats = stats
+        # Announced hashes this client asked for
+        self.reacted = set()
+
+    def on_open(self, conn):
+        self.stats.connections += 1
+        self.swarm.opened(self)
+
+    def on_close(self, conn):
+        self.swarm.closed(self)
+
+    def on_getheaders(self, conn, message):
+        received = time.perf_counter()
+        chain = self.swarm.chain
+        start = chain.locate(message.locator.vHave)
+        self._react(received, chain.hashes[start:start + 2])
+        count, payload = chain.headers_payload(start, stop=message.hashstop)
+        self.stats.headers_sent += count
+        self._respond(msg_generic(b"headers", payload), received,
+                      synced=count and start + count >= self.swarm.sync_height)
+
+    def on_getdata(self, conn, message):
+        received = time.perf_counter()
+        chain = self.swarm.chain
+        hashes = [inv.hash for inv in message.inv if inv.type == MSG_BLOCK]
+        self._react(received, hashes)
+        for h in hashes:
+            height = chain.height_of.get(h)
+            if height:
+                self.stats.blocks_sent += 1
+                self._respond(msg_generic(b"block", chain.block_payload(height)), received)
+
+    def on_getnSPV(self, conn, message):
+        received = time.perf_counter()
+        responder = self.nspv_responders.get(message.get_type())
+        if responder is not None:
+            self.stats.nspv_sent += 1
+            self._respond(msg_nSPV(responder(self, message.payload)), received)
+
+    # NSPV_INFO [int32 height]: the chain tip and the header at height
+    # (the tip if not given), with no notarization
+    def _nspv_info(self, request):
+        chain = self.swarm.chain
+        tip = chain.height()
+        height = _int32.unpack_from(request, 1)[0] if len(request) == 5 else 0
+        if not 0 < height <= tip:
+            height = tip
+        return (bytes([NSPV_INFORESP]) + bytes(_ntz.size) + ser_uint256(chain.tip())
+                + _info.pack(tip, height) + chain.equihdr(height)
+                + struct.pack("<I", NSPV_PROTOCOL_VERSION))
+
+    # NSPV_NTZS int32 height: no notarizations around it
+    def _nspv_ntzs(self, request):
+        height = _int32.unpack_from(request, 1)[0] if len(request) == 5 else 0
+        return bytes([NSPV_NTZSRESP]) + bytes(2 * _ntz.size) + _int32.pack(height)
+
+    nspv_responders = {
+        NSPV_INFO: _nspv_info,
+        NSPV_NTZS: _nspv_ntzs,
+    }
+
+    # Announce the block of height with an inv and a headers message
+    def announce(self, height):
+        chain = self.swarm.chain
+        self._send(msg_inv([CInv(MSG_BLOCK, chain.hashes[height])]), None)
+        count, payload = chain.headers_payload(height - 1, 1)
+        self._send(msg_generic(b"headers", payload), None)
+
+    def _react(self, received, hashes):
+        self.stats.requests += 1
+        for h in hashes:
+            announced = self.swarm.announced.get(h)
+            if announced is not None and h not in self.reacted:
+                self.reacted.add(h)
+                self.stats.reaction.append(received - announced)
+
+    # synced: the response completes the headers up to the swarm's
+    # sync_height
+    def _respond(self, message, received, synced=False):
+        delay = self.stats.delay
+        if delay:
+            network_event_loop().call_later(delay, self._send, message, received, synced)
+        else:
+            self._send(message, received, synced)
+
+    def _send(self, message, received, synced=False):
+        conn = self.connection
+        if conn.state != "connected":
+            return
+        conn.send_message(message)
+        self.stats.bytes_sent += len(message.serialize())
+        now = time.perf_counter()
+        if received is not None:
+            self.stats.service.append(now - received)
+        if synced and self.swarm.synced is None:
+            self.swarm.synced = now
+
+
+class PeerSwarm(object):
+    """peers simulated full nodes listening on consecutive local ports.
+
+    slow of them, spread among the others, answer each request after
+    delay seconds.  port is the first port to listen on, 0 for any free
+    ports.  The swarm runs on the AsyncNetworkThread, started by start()
+    if it isn't running.
+    """
+
+    def __init__(self, chain, peers, slow=0, delay=0.2, host="127.0.0.1", port=0,
+                 net="regtest", services=NODE_NETWORK | NODE_NSPV):
+        self.chain = chain
+        self.host = host
+        self.port = port
+        self.net = net
+        self.services = services
+        self.stats = [PeerStats(i, delay if (i * slow) % peers < slow else 0.0)
+                      for i in range(peers)]
+        self.servers = []
+        self.thread = None
+        # Connected SimPeers
+        self.peers = []
+        # Block hash -> time it was first announced
+        self.announced = {}
+        # When the first client connected and when the headers up to
+        # sync_height had all been asked for
+        self.sync_height = chain.height()
+        self.started = None
+        self.synced = None
+        self.flooded = 0
+
+    def start(self):
+        for stats in self.stats:
+            server = listen(self.host, self.port + stats.index if self.port else 0,
+                            lambda stats=stats: SimPeer(self, stats), self.net, self.services,
+                            conn_class=SimConn)
+            stats.port = server.sockets[0].getsockname()[1]
+            self.servers.append(server)
+        if not network_event_loop().is_running():
+            self.thread = AsyncNetworkThread()
+            self.thread.start()
+
+    # The -i argument of nspv and bitcoin-spv
+    def addresses(self):
+        return ",".join("%s:%d" % (self.host, stats.port) for stats in self.stats)
+
+    def opened(self, peer):
+        if self.started is None:
+            self.started = time.perf_counter()
+        self.peers.append(peer)
+
+    def closed(self, peer):
+        if peer in self.peers:
+            self.peers.remove(peer)
+
+    # Mine count blocks, rate per second, each announced by every peer
+    def flood(self, rate, count):
+        loop = network_event_loop()
+        loop.call_soon_threadsafe(self._flood, 1.0 / rate, count)
+
+    def _flood(self, interval, count):
+        height = self.chain.extend(1)
+        self.announced[self.chain.tip()] = time.perf_counter()
+        self.flooded += 1
+        for peer in list(self.peers):
+            peer.announce(height)
+        if count > 1:
+            network_event_loop().call_later(interval, self._flood, interval, count - 1)
+
+    def close(self):
+        for server in self.servers:
+            close_listener(server)
+        self.servers = []
+        for peer in list(self.peers):
+            peer.connection.disconnect_node()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def summary(self):
+        stats = self.stats
+        fast = [t for s in stats if not s.delay for t in s.service]
+        slow = [t for s in stats if s.delay for t in s.service]
+        reaction = [t for s in stats for t in s.reaction]
+        headers = sum(s.headers_sent for s in stats)
+        r = {
+            "peers": len(stats),
+            "connected": sum(1 for s in stats if s.connections),
+            "requests": sum(s.requests for s in stats),
+            "headers": headers,
+            "blocks": sum(s.blocks_sent for s in stats),
+            "nspv": sum(s.nspv_sent for s in stats),
+            "bytes": sum(s.bytes_sent for s in stats),
+            "announced": self.flooded,
+            "sync_seconds": None,
+        }
+        if self.started is not None and self.synced is not None:
+            r["sync_seconds"] = self.synced - self.started
+        for name, values in (("service_fast", fast), ("service_slow", slow), ("reaction", reaction)):
+            if values:
+                r[name] = (percentile(values, 0.5), percentile(values, 0.99))
+        return r
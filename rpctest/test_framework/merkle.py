@@ -0,0 +1,333 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Merkle trees, branches and partial merkle trees.
+
+MerkleTree is built incrementally (append() only hashes the new path up
+the tree) and keeps every internal level, so the root and the branches
+for any number of leaves are read from the cache instead of rehashing the
+block.  PartialMerkleTree and CMerkleBlock are the CPartialMerkleTree and
+CMerkleBlock of bitcoind/komodod, i.e. the proof nSPV returns as the
+txproof of NSPV_gettxproof.
+
+Hashes are 32-byte strings in serialization (little endian) order, as
+returned by hash256() and ser_uint256().
+"""
+
+import hashlib
+import struct
+
+from .mininode import (
+    BytesReader,
+    BytesWriter,
+    CBlockHeader,
+    CKomodoBlockHeader,
+    LazyTxList,
+    deser_hash256_vector,
+    deser_string,
+    deserialize_stream,
+    ser_uint256,
+    uint256_from_str,
+)
+
+_uint32 = struct.Struct("<I")
+
+
+def _hash_pair(left, right):
+    return hashlib.sha256(hashlib.sha256(left + right).digest()).digest()
+
+
+class MerkleTree(object):
+    """Merkle tree over a growing list of leaf hashes.
+
+    levels[0] are the leaves, levels[k] the nodes of height k whose both
+    children exist.  A node at the right edge with a missing right child
+    pairs its left child with itself (bitcoin's rule for odd levels); those
+    nodes change with every append, so they are computed on demand and
+    cached until the next append.
+    """
+
+    def __init__(self, leaves=()):
+        self.levels = [[]]
+        self._edge = {}
+        self.extend(leaves)
+
+    @classmethod
+    def from_block(cls, block):
+        if type(block.vtx) is LazyTxList:
+            return cls(block.vtx.get_hashes())
+        return cls(ser_uint256(tx.sha256) for tx in block.vtx)
+
+    def __len__(self):
+        return len(self.levels[0])
+
+    def append(self, leaf):
+        if len(leaf) != 32:
+            raise ValueError("merkle leaf must be 32 bytes")
+        levels = self.levels
+        level = levels[0]
+        level.append(bytes(leaf))
+        k = 0
+        while len(level) % 2 == 0:
+            if k + 1 == len(levels):
+                levels.append([])
+            parent = levels[k + 1]
+            parent.append(_hash_pair(level[-2], level[-1]))
+            level = parent
+            k += 1
+        if self._edge:
+            self._edge = {}
+
+    # Same as append() for each leaf, hashing each new level in one pass
+    def extend(self, leaves):
+        leaves = [bytes(leaf) for leaf in leaves]
+        if any(len(leaf) != 32 for leaf in leaves):
+            raise ValueError("merkle leaf must be 32 bytes")
+        levels = self.levels
+        levels[0].extend(leaves)
+        k = 0
+        while len(levels[k]) > 1:
+            if k + 1 == len(levels):
+                levels.append([])
+            level = levels[k]
+            parent = levels[k + 1]
+            start = 2 * len(parent)
+            end = len(level) - len(level) % 2
+            if start == end:
+                break
+            parent.extend([_hash_pair(level[i], level[i + 1]) for i in range(start, end, 2)])
+            k += 1
+        if self._edge:
+            self._edge = {}
+
+    def height(self):
+        height = 0
+        while self.width(height) > 1:
+            height += 1
+        return height
+
+    # Number of nodes at the given height
+    def width(self, height):
+        return (len(self.levels[0]) + (1 << height) - 1) >> height
+
+    def node(self, height, pos):
+        level = self.levels[height] if height < len(self.levels) else ()
+        if pos < len(level):
+            return level[pos]
+        key = (height, pos)
+        h = self._edge.get(key)
+        if h is None:
+            left = self.node(height - 1, pos * 2)
+            if pos * 2 + 1 < self.width(height - 1):
+                right = self.node(height - 1, pos * 2 + 1)
+            else:
+                right = left
+            h = self._edge[key] = _hash_pair(left, right)
+        return h
+
+    def root(self):
+        if not self.levels[0]:
+            raise ValueError("empty merkle tree")
+        return self.node(self.height(), 0)
+
+    def calc_merkle_root(self):
+        return uint256_from_str(self.root())
+
+    # The sibling hashes from the leaf at index up to the root
+    def get_branch(self, index):
+        if not 0 <= index < len(self.levels[0]):
+            raise IndexError("merkle leaf index out of range")
+        branch = []
+        for height in range(self.height()):
+            sibling = index ^ 1
+            if sibling >= self.width(height):
+                sibling = index
+            branch.append(self.node(height, sibling))
+            index >>= 1
+        return branch
+
+    def get_branches(self, indexes):
+        return [self.get_branch(index) for index in indexes]
+
+
+# Fold a branch from get_branch() back into the root
+def branch_root(leaf, branch, index):
+    h = leaf
+    for sibling in branch:
+        if index & 1:
+            h = _hash_pair(sibling, h)
+        else:
+            h = _hash_pair(h, sibling)
+        index >>= 1
+    return h
+
+
+def verify_branch(leaf, branch, index, root):
+    return branch_root(leaf, branch, index) == ser_uint256(root)
+
+
+class PartialMerkleTree(object):
+    """CPartialMerkleTree: the subset of a merkle tree needed to prove that
+    some leaves are in it.
+
+    vHash are 32-byte hashes, vBits a list of bools (depth-first, one per
+    node visited).
+    """
+    __slots__ = ("nTransactions", "vHash", "vBits")
+
+    def __init__(self):
+        self.nTransactions = 0
+        self.vHash = []
+        self.vBits = []
+
+    # tree: a MerkleTree of all the leaves, matches: the indexes to prove
+    @classmethod
+    def from_tree(cls, tree, matches):
+        self = cls()
+        self.nTransactions = len(tree)
+        # Positions of the nodes with a match below them, per height
+        parents = [set(matches)]
+        for height in range(tree.height()):
+            parents.append(set(pos >> 1 for pos in parents[-1]))
+        self._build(tree, parents, tree.height(), 0)
+        return self
+
+    def _build(self, tree, parents, height, pos):
+        parent_of_match = pos in parents[height]
+        self.vBits.append(parent_of_match)
+        if height == 0 or not parent_of_match:
+            self.vHash.append(tree.node(height, pos))
+        else:
+            self._build(tree, parents, height - 1, pos * 2)
+            if pos * 2 + 1 < tree.width(height - 1):
+                self._build(tree, parents, height - 1, pos * 2 + 1)
+
+    def deserialize(self, f):
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self.nTransactions = f.unpack(_uint32)[0]
+        self.vHash = [bytes(h) for h in deser_hash256_vector(f)]
+        bits = deser_string(f)
+        self.vBits = [(bits[p // 8] >> (p % 8)) & 1 == 1 for p in range(len(bits) * 8)]
+
+    def serialize(self):
+        r = BytesWriter()
+        r += _uint32.pack(self.nTransactions)
+        r.write_compact_size(len(self.vHash))
+        for h in self.vHash:
+            r += h
+        bits = bytearray((len(self.vBits) + 7) // 8)
+        for p, bit in enumerate(self.vBits):
+            if bit:
+                bits[p // 8] |= 1 << (p % 8)
+        r.write_string(bytes(bits))
+        return bytes(r)
+
+    def _width(self, height):
+        return (self.nTransactions + (1 << height) - 1) >> height
+
+    # Recompute the root and collect the matched leaves, with the same
+    # checks as CPartialMerkleTree::ExtractMatches.  Returns
+    # (root, matched hashes, matched indexes), or None if the tree is
+    # malformed.
+    def extract_matches(self):
+        if self.nTransactions == 0:
+            return None
+        if len(self.vHash) > self.nTransactions:
+            return None
+        if len(self.vBits) < len(self.vHash):
+            return None
+        height = 0
+        while self._width(height) > 1:
+            height += 1
+        state = [0, 0, False]   # bits used, hashes used, bad
+        matches = []
+        indexes = []
+        try:
+            root = self._extract(height, 0, state, matches, indexes)
+        except IndexError:
+            return None
+        bits_used, hashes_used, bad = state
+        if bad:
+            return None
+        if (bits_used + 7) // 8 != (len(self.vBits) + 7) // 8:
+            return None
+        if hashes_used != len(self.vHash):
+            return None
+        return (root, matches, indexes)
+
+    def _extract(self, height, pos, state, matches, indexes):
+        parent_of_match = self.vBits[state[0]]
+        state[0] += 1
+        if height == 0 or not parent_of_match:
+            h = self.vHash[state[1]]
+            state[1] += 1
+            if height == 0 and parent_of_match:
+                matches.append(h)
+                indexes.append(pos)
+            return h
+        left = self._extract(height - 1, pos * 2, state, matches, indexes)
+        if pos * 2 + 1 < self._width(height - 1):
+            right = self._extract(height - 1, pos * 2 + 1, state, matches, indexes)
+            if right == left:
+                # the two subtrees cover different txids, so can't be equal
+                state[2] = True
+        else:
+            right = left
+        return _hash_pair(left, right)
+
+    def __repr__(self):
+        return "PartialMerkleTree(nTransactions=%i vHash=%s vBits=%s)" \
+            % (self.nTransactions, repr([uint256_from_str(h) for h in self.vHash]),
+               repr(self.vBits))
+
+
+class CMerkleBlock(object):
+    """A block header and a PartialMerkleTree proving some of its txids."""
+    __slots__ = ("header", "txn")
+
+    header_class = CBlockHeader
+
+    def __init__(self, header=None, txn=None):
+        self.header = self.header_class() if header is None else header
+        self.txn = PartialMerkleTree() if txn is None else txn
+
+    # txids: ints or Hash256s of the transactions to prove
+    @classmethod
+    def from_block(cls, block, txids, tree=None):
+        if tree is None:
+            tree = MerkleTree.from_block(block)
+        wanted = set(ser_uint256(txid) for txid in txids)
+        matches = [i for i, leaf in enumerate(tree.levels[0]) if leaf in wanted]
+        return cls(cls.header_class(block), PartialMerkleTree.from_tree(tree, matches))
+
+    def deserialize(self, f):
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self.header.deserialize(f)
+        self.txn.deserialize(f)
+
+    def serialize(self):
+        return self.header.serialize() + self.txn.serialize()
+
+    # The matched txids (as ints) if the proof is well formed and commits
+    # to the header's merkle root, else None
+    def get_matched_txids(self):
+        result = self.txn.extract_matches()
+        if result is None:
+            return None
+        root, matches, indexes = result
+        if uint256_from_str(root) != self.header.hashMerkleRoot:
+            return None
+        return [uint256_from_str(h) for h in matches]
+
+    def __repr__(self):
+        return "CMerkleBlock(header=%s txn=%s)" % (repr(self.header), repr(self.txn))
+
+
+class CKomodoMerkleBlock(CMerkleBlock):
+    """CMerkleBlock with a Komodo header, the txproof format of nSPV."""
+    __slots__ = ()
+
+    header_class = CKomodoBlockHeader
@@ -10,6 +10,8 @@ This python code was modified from ArtForz' public domain  half-a-node, as
 found in the mini-node branch of http://github.com/jgarzik/pynode.
 
 NodeConn: an object which manages p2p connectivity to a bitcoin node
+AsyncNodeConn: the same on an asyncio event loop (AsyncNetworkThread),
+               for many concurrent peers
 NodeConnCB: a base class that describes the interface for receiving
             callbacks with network messages from a NodeConn
 CBlock, CTransaction, CBlockHeader, CTxIn, CTxOut, etc....:
@@ -22,11 +24,12 @@ ser_*, deser_*: functions that handle serialization/deserialization
 
 import struct
 import socket
-import asyncore
+import asyncio
 import time
 import sys
 import random
 from .util import hex_str_to_bytes, bytes_to_hex_str
+from .p2pmetrics import MetricsRegistry
 from io import BytesIO
 from codecs import encode
 import hashlib
@@ -34,8 +37,22 @@ from threading import RLock
 from threading import Thread
 import logging
 import copy
+import os
+import threading
+import weakref
+from collections import deque
+from collections.abc import MutableSequence
+from itertools import islice
+from operator import attrgetter
 from test_framework.siphash import siphash256
 
+try:
+    import asyncore
+except ImportError:
+    # Gone since python 3.12, NodeConn is then AsyncNodeConn (see the end
+    # of this file)
+    asyncore = None
+
 BIP0031_VERSION = 60000
 MY_VERSION = 70014  # past bip-31 for ping/pong
 MY_SUBVERSION = b"/python-mininode-tester:0.0.3/"
@@ -51,6 +68,16 @@ NODE_GETUTXO = (1 << 1)
 NODE_BLOOM = (1 << 2)
 NODE_WITNESS = (1 << 3)
 
+# Overwinter/Sapling (Zcash, Komodo) transactions
+OVERWINTER_VERSION_GROUP_ID = 0x03C48270
+SAPLING_VERSION_GROUP_ID = 0x892F2085
+OVERWINTER_BRANCH_ID = 0x5BA81B19
+SAPLING_BRANCH_ID = 0x76B809BB
+SPEND_DESCRIPTION_SIZE = 384
+OUTPUT_DESCRIPTION_SIZE = 948
+JOINSPLIT_SIZE = 1802           # PHGR proofs, tx versions 2 and 3
+JOINSPLIT_SIZE_GROTH = 1698     # Groth proofs, tx version 4
+
 logger = logging.getLogger("TestFramework.mininode")
 
 # Keep our own socket map for asyncore, so that we can track disconnects
@@ -58,15 +85,419 @@ logger = logging.getLogger("TestFramework.mininode")
 # using select)
 mininode_socket_map = dict()
 
-# One lock for synchronizing all data access between the networking thread (see
-# NetworkThread below) and the thread running the test logic.  For simplicity,
-# NodeConn acquires this lock whenever delivering a message to to a NodeConnCB,
-# and whenever adding anything to the send buffer (in send_message()).  This
-# lock should be acquired in the thread running the test logic to synchronize
-# access to any data shared with the NodeConnCB or NodeConn.
-mininode_lock = RLock()
+# The AsyncNodeConn connections and listening servers, which keep the
+# AsyncNetworkThread running
+async_connections = set()
+async_servers = set()
+
+class MininodeLock(object):
+    """Reentrant lock over the locks of all the NodeConnCBs.
+
+    Message delivery only holds the receiving NodeConnCB's own lock, so
+    deliveries on different connections don't wait for each other.
+    Holding mininode_lock takes the lock of every NodeConnCB instead: it
+    waits for the deliveries in progress and blocks new ones, on every
+    connection, as the global lock it replaces did.  Threads wanting it
+    queue for it in turn.  A thread that holds NodeConnCB locks (a handler
+    during its delivery, say) gives them up while it waits, so that two
+    handlers taking it at once are served one after the other, and takes
+    them back before it gets mininode_lock.
+
+    A NodeConnCB created while another thread holds mininode_lock is only
+    covered by the next holder.
+
+    wait() is Condition.wait() with every delivery as the notification.
+    """
+
+    def __init__(self):
+        self._mutex = threading.Lock()
+        self._cond = threading.Condition(self._mutex)
+        self._owner = None
+        self._count = 0
+        # The NodeConnCBs, and the locks of those the owner took
+        self._callbacks = weakref.WeakSet()
+        self._held = []
+        # Deliveries seen by wait() so far
+        self._changes = 0
+
+    # Called by NodeConnCB.__init__()
+    def register(self, callback):
+        with self._mutex:
+            self._callbacks.add(callback)
+            if self._owner == threading.get_ident():
+                callback.lock.acquire()
+                self._held.append(callback.lock)
+
+    # Called on a delivery to a NodeConnCB with threads waiting on it
+    def notify_delivery(self):
+        with self._mutex:
+            self._changes += 1
+            self._cond.notify_all()
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = threading.get_ident()
+        with self._mutex:
+            if self._owner == me:
+                self._count += 1
+                return True
+            if not blocking and self._owner is not None:
+                return False
+            callbacks = list(self._callbacks)
+        deadline = None if timeout < 0 else time.monotonic() + timeout
+        # The NodeConnCB locks this thread holds, released (with their
+        # recursion state) while it waits
+        own = [(c.lock, c.lock._release_save()) for c in callbacks if c.lock._is_owned()]
+        held = []
+        try:
+            if not blocking:
+                wait = 0
+            else:
+                wait = None if deadline is None else deadline - time.monotonic()
+            with self._mutex:
+                if not self._cond.wait_for(lambda: self._owner is None, wait):
+                    return False
+                self._owner = me
+                self._count = 1
+                callbacks = list(self._callbacks)
+            owned = dict(own)
+            for callback in callbacks:
+                lock = callback.lock
+                if lock in owned:
+                    continue
+                if not lock.acquire(blocking, -1 if deadline is None else max(deadline - time.monotonic(), 0)):
+                    self._abandon(held)
+                    return False
+                held.append(lock)
+            self._held = held
+            return True
+        finally:
+            for lock, state in own:
+                lock._acquire_restore(state)
+
+    # Give up an acquire() that couldn't take all the locks
+    def _abandon(self, held):
+        for lock in held:
+            lock.release()
+        with self._mutex:
+            self._owner = None
+            self._count = 0
+            self._cond.notify_all()
+
+    def release(self):
+        with self._mutex:
+            if self._owner != threading.get_ident():
+                raise RuntimeError("cannot release un-acquired lock")
+            self._count -= 1
+            if self._count:
+                return
+            held = self._held
+            self._held = []
+        self._abandon(held)
+
+    __enter__ = acquire
+
+    def __exit__(self, *exc):
+        self.release()
+
+    # For threading.Condition(mininode_lock), as with an RLock
+    def _is_owned(self):
+        return self._owner == threading.get_ident()
+
+    def _release_save(self):
+        count = self._count
+        self._count = 1
+        self.release()
+        return count
+
+    def _acquire_restore(self, count):
+        self.acquire()
+        self._count = count
+
+    # Release the lock until a message has been delivered, or until
+    # timeout, then take it back.  Returns False on timeout.
+    def wait(self, timeout=None):
+        if not self._is_owned():
+            raise RuntimeError("cannot wait on un-acquired lock")
+        # No delivery runs while we hold the lock, so any change after
+        # this point is one we haven't seen.  Counting as a waiter of
+        # each NodeConnCB has its deliveries notify us.
+        changes = self._changes
+        callbacks = [c for c in self._callbacks if c.lock._is_owned()]
+        for callback in callbacks:
+            callback.waiting += 1
+        count = self._release_save()
+        try:
+            with self._mutex:
+                return self._cond.wait_for(lambda: self._changes != changes, timeout)
+        finally:
+            self._acquire_restore(count)
+            for callback in callbacks:
+                callback.waiting -= 1
+
+
+# Each NodeConnCB has a lock (NodeConnCB.lock) that is held while a message
+# is delivered to it; the thread running the test logic should hold it to
+# access data shared with that NodeConnCB.  For code that reads the state of
+# several connections at once, mininode_lock excludes message delivery to
+# all of them.  Send queues have their own locks.
+mininode_lock = MininodeLock()
+
+# Traffic counters and latency histograms of all connections (see
+# p2pmetrics.py)
+mininode_metrics = MetricsRegistry()
 
 # Serialization/deserialization tools
+
+# Precompiled struct formats shared by the (de)serializers below
+_int8 = struct.Struct("<b")
+_uint8 = struct.Struct("<B")
+_uint16 = struct.Struct("<H")
+_int32 = struct.Struct("<i")
+_uint32 = struct.Struct("<I")
+_int64 = struct.Struct("<q")
+_uint64 = struct.Struct("<Q")
+_bool = struct.Struct("<?")
+_port = struct.Struct(">H")
+_msg_header = struct.Struct("<4s12sI")
+_block_header = struct.Struct("<i32s32sIII")
+_komodo_header = struct.Struct("<i32s32s32sII32s")
+_outpoint = struct.Struct("<32sI")
+_inv = struct.Struct("<i32s")
+
+_UINT256_MASK = (1 << 256) - 1
+
+
+class BytesReader(object):
+    """Cursor over a memoryview of a serialized payload.
+
+    BytesReader can be passed anywhere a deserialize() method expects a
+    file-like object.  read() hands out memoryview slices instead of copies,
+    and the read_*/unpack helpers decode fields in place with precompiled
+    struct.Struct objects, so parsing a message does not copy each field
+    out of the receive buffer first.
+    """
+    __slots__ = ("buf", "pos", "base")
+
+    def __init__(self, data, pos=0):
+        buf = memoryview(data)
+        if buf.format != "B" or buf.ndim != 1:
+            buf = buf.cast("B")
+        self.buf = buf
+        self.pos = pos
+        self.base = 0
+
+    @classmethod
+    def from_stream(cls, f):
+        """Wrap the remainder of a file-like object (eg BytesIO).
+
+        Call sync(f) afterwards to advance f past the bytes consumed."""
+        base = f.tell()
+        r = cls(f.read())
+        r.base = base
+        return r
+
+    def sync(self, f):
+        f.seek(self.base + self.pos)
+
+    def tell(self):
+        return self.pos
+
+    def remaining(self):
+        return len(self.buf) - self.pos
+
+    def read(self, n=-1):
+        pos = self.pos
+        if n < 0:
+            v = self.buf[pos:]
+        else:
+            v = self.buf[pos:pos + n]
+        self.pos = pos + len(v)
+        return v
+
+    def read_bytes(self, n):
+        pos = self.pos
+        end = pos + n
+        if end > len(self.buf):
+            raise struct.error("read past end of buffer")
+        self.pos = end
+        return self.buf[pos:end].tobytes()
+
+    def unpack(self, st):
+        pos = self.pos
+        self.pos = pos + st.size
+        return st.unpack_from(self.buf, pos)
+
+    def read_compact_size(self):
+        buf = self.buf
+        pos = self.pos
+        nit = buf[pos]
+        if nit < 253:
+            self.pos = pos + 1
+            return nit
+        if nit == 253:
+            self.pos = pos + 3
+            return _uint16.unpack_from(buf, pos + 1)[0]
+        if nit == 254:
+            self.pos = pos + 5
+            return _uint32.unpack_from(buf, pos + 1)[0]
+        self.pos = pos + 9
+        return _uint64.unpack_from(buf, pos + 1)[0]
+
+    def read_uint256(self):
+        pos = self.pos
+        end = pos + 32
+        if end > len(self.buf):
+            raise struct.error("read past end of buffer")
+        self.pos = end
+        return int.from_bytes(self.buf[pos:end], 'little')
+
+    def read_hash256(self):
+        pos = self.pos
+        end = pos + 32
+        if end > len(self.buf):
+            raise struct.error("read past end of buffer")
+        self.pos = end
+        return _bytes_new(Hash256, self.buf[pos:end])
+
+    def read_string(self):
+        return self.read_bytes(self.read_compact_size())
+
+
+class BytesWriter(bytearray):
+    """Output buffer for serialize() methods.
+
+    Appending to a bytearray is amortized O(1), so building a message field
+    by field stays linear in its size, where b"" concatenation copies the
+    whole prefix again on every +=.  Plain += works for raw bytes; the
+    write_* helpers mirror the ser_* functions below.
+    """
+    __slots__ = ()
+
+    def write_compact_size(self, l):
+        if l < 253:
+            self.append(l)
+        else:
+            self += ser_compact_size(l)
+
+    def write_uint256(self, u):
+        if type(u) is Hash256:
+            self += u
+        else:
+            self += (u & _UINT256_MASK).to_bytes(32, 'little')
+
+    def write_string(self, s):
+        self.write_compact_size(len(s))
+        self += s
+
+    # ser_function_name: see ser_vector()
+    def write_vector(self, l, ser_function_name=None):
+        self.write_compact_size(len(l))
+        if ser_function_name:
+            for i in l:
+                self += getattr(i, ser_function_name)()
+        else:
+            for i in l:
+                self += i.serialize()
+
+    def getvalue(self):
+        return bytes(self)
+
+
+_bytes_new = bytes.__new__
+
+
+class Hash256(bytes):
+    """A 256-bit hash kept as its 32 serialized (little endian) bytes.
+
+    Drop-in for the python ints used for hashes elsewhere in this file: it
+    compares, orders and hashes like the int it represents (so it can be
+    looked up in dicts keyed by ints and vice versa), formats with %x, and
+    gives int()/hex views on demand.  (De)serializing it is a plain copy of
+    the 32 bytes, with no int conversion.
+    """
+    __slots__ = ()
+
+    # Hash256(b) takes the 32 bytes b; an int goes through from_int() instead
+    # of making that many zero bytes, as bytes(n) would.  The parsers build
+    # them with _bytes_new(Hash256, b), which skips this check.
+    def __new__(cls, value=bytes(32)):
+        if isinstance(value, int):
+            return cls.from_int(value)
+        return bytes.__new__(cls, value)
+
+    @classmethod
+    def from_int(cls, u):
+        return bytes.__new__(cls, (u & _UINT256_MASK).to_bytes(32, 'little'))
+
+    # From the usual (byte reversed) display hex, eg a txid from RPC
+    @classmethod
+    def from_hex(cls, s):
+        return bytes.__new__(cls, bytes.fromhex(s)[::-1])
+
+    def to_hex(self):
+        return self[::-1].hex()
+
+    def __int__(self):
+        return int.from_bytes(self, 'little')
+
+    __index__ = __int__
+
+    def __bool__(self):
+        return self.count(0) != 32
+
+    def __hash__(self):
+        return hash(int.from_bytes(self, 'little'))
+
+    # Never equal to plain bytes: those hash differently, and would break
+    # dicts and sets holding both
+    def __eq__(self, other):
+        if isinstance(other, Hash256):
+            return bytes.__eq__(self, other)
+        if isinstance(other, int):
+            return int.from_bytes(self, 'little') == other
+        if isinstance(other, bytes):
+            return False
+        return NotImplemented
+
+    def __ne__(self, other):
+        r = self.__eq__(other)
+        return r if r is NotImplemented else not r
+
+    def __lt__(self, other):
+        if isinstance(other, (Hash256, int)):
+            return int.from_bytes(self, 'little') < int(other)
+        return NotImplemented
+
+    def __le__(self, other):
+        if isinstance(other, (Hash256, int)):
+            return int.from_bytes(self, 'little') <= int(other)
+        return NotImplemented
+
+    def __gt__(self, other):
+        if isinstance(other, (Hash256, int)):
+            return int.from_bytes(self, 'little') > int(other)
+        return NotImplemented
+
+    def __ge__(self, other):
+        if isinstance(other, (Hash256, int)):
+            return int.from_bytes(self, 'little') >= int(other)
+        return NotImplemented
+
+    def __format__(self, spec):
+        return format(int.from_bytes(self, 'little'), spec)
+
+    # Same as the int, so message reprs in the logs don't change
+    def __repr__(self):
+        return repr(int.from_bytes(self, 'little'))
+
+
+def deserialize_stream(obj, f):
+    """Deserialize obj from a plain file-like object through a BytesReader."""
+    r = BytesReader.from_stream(f)
+    obj.deserialize(r)
+    r.sync(f)
+
+
 def sha256(s):
     return hashlib.new('sha256', s).digest()
 
@@ -79,7 +510,7 @@ def hash256(s):
 def ser_compact_size(l):
     r = b""
     if l < 253:
-        r = struct.pack("B", l)
+        r = _uint8.pack(l)
     elif l < 0x10000:
         r = struct.pack("<BH", 253, l)
     elif l < 0x100000000:
@@ -89,44 +520,57 @@ def ser_compact_size(l):
     return r
 
 def deser_compact_size(f):
-    nit = struct.unpack("<B", f.read(1))[0]
+    if type(f) is BytesReader:
+        return f.read_compact_size()
+    nit = _uint8.unpack(f.read(1))[0]
     if nit == 253:
-        nit = struct.unpack("<H", f.read(2))[0]
+        nit = _uint16.unpack(f.read(2))[0]
     elif nit == 254:
-        nit = struct.unpack("<I", f.read(4))[0]
+        nit = _uint32.unpack(f.read(4))[0]
     elif nit == 255:
-        nit = struct.unpack("<Q", f.read(8))[0]
+        nit = _uint64.unpack(f.read(8))[0]
     return nit
 
 def deser_string(f):
+    if type(f) is BytesReader:
+        return f.read_string()
     nit = deser_compact_size(f)
     return f.read(nit)
 
 def ser_string(s):
-    return ser_compact_size(len(s)) + s
+    l = len(s)
+    if l < 253:
+        return _uint8.pack(l) + s
+    return ser_compact_size(l) + s
 
 def deser_uint256(f):
-    r = 0
-    for i in range(8):
-        t = struct.unpack("<I", f.read(4))[0]
-        r += t << (i * 32)
-    return r
+    if type(f) is BytesReader:
+        return f.read_uint256()
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return int.from_bytes(s, 'little')
 
 
+# Returns plain bytes for both ints and Hash256, so the result is usable as a
+# canonical dict/database key for a hash.
 def ser_uint256(u):
-    rs = b""
-    for i in range(8):
-        rs += struct.pack("<I", u & 0xFFFFFFFF)
-        u >>= 32
-    return rs
+    if type(u) is Hash256:
+        return bytes(u)
+    return (u & _UINT256_MASK).to_bytes(32, 'little')
+
+
+def deser_hash256(f):
+    if type(f) is BytesReader:
+        return f.read_hash256()
+    s = f.read(32)
+    if len(s) != 32:
+        raise struct.error("unpack requires a buffer of 32 bytes")
+    return _bytes_new(Hash256, s)
 
 
 def uint256_from_str(s):
-    r = 0
-    t = struct.unpack("<IIIIIIII", s[:32])
-    for i in range(8):
-        r += t[i] << (i * 32)
-    return r
+    return int.from_bytes(s[:32], 'little')
 
 
 def uint256_from_compact(c):
@@ -136,12 +580,15 @@ def uint256_from_compact(c):
 
 
 def deser_vector(f, c):
-    nit = deser_compact_size(f)
+    rd = f if type(f) is BytesReader else BytesReader.from_stream(f)
+    nit = rd.read_compact_size()
     r = []
     for i in range(nit):
         t = c()
-        t.deserialize(f)
+        t.deserialize(rd)
         r.append(t)
+    if rd is not f:
+        rd.sync(f)
     return r
 
 
@@ -149,29 +596,33 @@ def deser_vector(f, c):
 # entries in the vector (we use this for serializing the vector of transactions
 # for a witness block).
 def ser_vector(l, ser_function_name=None):
-    r = ser_compact_size(len(l))
-    for i in l:
-        if ser_function_name:
-            r += getattr(i, ser_function_name)()
-        else:
-            r += i.serialize()
-    return r
+    r = BytesWriter()
+    r.write_vector(l, ser_function_name)
+    return bytes(r)
 
 
 def deser_uint256_vector(f):
     nit = deser_compact_size(f)
-    r = []
-    for i in range(nit):
-        t = deser_uint256(f)
-        r.append(t)
-    return r
+    data = f.read(32 * nit)
+    if len(data) != 32 * nit:
+        raise struct.error("unpack requires a buffer of %d bytes" % (32 * nit))
+    return [int.from_bytes(data[i:i+32], 'little') for i in range(0, 32 * nit, 32)]
+
+
+def deser_hash256_vector(f):
+    nit = deser_compact_size(f)
+    data = f.read(32 * nit)
+    if len(data) != 32 * nit:
+        raise struct.error("unpack requires a buffer of %d bytes" % (32 * nit))
+    return [_bytes_new(Hash256, data[i:i+32]) for i in range(0, 32 * nit, 32)]
 
 
 def ser_uint256_vector(l):
-    r = ser_compact_size(len(l))
+    r = BytesWriter()
+    r.write_compact_size(len(l))
     for i in l:
-        r += ser_uint256(i)
-    return r
+        r.write_uint256(i)
+    return bytes(r)
 
 
 def deser_string_vector(f):
@@ -184,30 +635,32 @@ def deser_string_vector(f):
 
 
 def ser_string_vector(l):
-    r = ser_compact_size(len(l))
+    r = BytesWriter()
+    r.write_compact_size(len(l))
     for sv in l:
-        r += ser_string(sv)
-    return r
+        r.write_string(sv)
+    return bytes(r)
 
 
 def deser_int_vector(f):
     nit = deser_compact_size(f)
     r = []
     for i in range(nit):
-        t = struct.unpack("<i", f.read(4))[0]
+        t = _int32.unpack(f.read(4))[0]
         r.append(t)
     return r
 
 
 def ser_int_vector(l):
-    r = ser_compact_size(len(l))
+    r = BytesWriter()
+    r.write_compact_size(len(l))
     for i in l:
-        r += struct.pack("<i", i)
-    return r
+        r += _int32.pack(i)
+    return bytes(r)
 
 # Deserialize from a hex string representation (eg from RPC)
 def FromHex(obj, hex_string):
-    obj.deserialize(BytesIO(hex_str_to_bytes(hex_string)))
+    obj.deserialize(BytesReader(hex_str_to_bytes(hex_string)))
     return obj
 
 # Convert a binary-serializable object to hex (eg for submission via RPC)
@@ -217,6 +670,8 @@ def ToHex(obj):
 # Objects that map to bitcoind objects, which can be serialized/deserialized
 
 class CAddress(object):
+    __slots__ = ("nServices", "pchReserved", "ip", "port")
+
     def __init__(self):
         self.nServices = 1
         self.pchReserved = b"\x00" * 10 + b"\xff" * 2
@@ -224,18 +679,18 @@ class CAddress(object):
         self.port = 0
 
     def deserialize(self, f):
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.pchReserved = f.read(12)
+        self.nServices = _uint64.unpack(f.read(8))[0]
+        self.pchReserved = bytes(f.read(12))
         self.ip = socket.inet_ntoa(f.read(4))
-        self.port = struct.unpack(">H", f.read(2))[0]
+        self.port = _port.unpack(f.read(2))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nServices)
+        r = BytesWriter()
+        r += _uint64.pack(self.nServices)
         r += self.pchReserved
         r += socket.inet_aton(self.ip)
-        r += struct.pack(">H", self.port)
-        return r
+        r += _port.pack(self.port)
+        return bytes(r)
 
     def __repr__(self):
         return "CAddress(nServices=%i ip=%s port=%i)" % (self.nServices,
@@ -244,6 +699,8 @@ class CAddress(object):
 MSG_WITNESS_FLAG = 1<<30
 
 class CInv(object):
+    __slots__ = ("type", "hash")
+
     typemap = {
         0: "Error",
         1: "TX",
@@ -258,80 +715,129 @@ class CInv(object):
         self.hash = h
 
     def deserialize(self, f):
-        self.type = struct.unpack("<i", f.read(4))[0]
-        self.hash = deser_uint256(f)
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self.type, h = f.unpack(_inv)
+        self.hash = _bytes_new(Hash256, h)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.type)
-        r += ser_uint256(self.hash)
-        return r
+        r = BytesWriter()
+        r += _int32.pack(self.type)
+        r.write_uint256(self.hash)
+        return bytes(r)
 
     def __repr__(self):
         return "CInv(type=%s hash=%064x)" \
             % (self.typemap[self.type], self.hash)
 
 
+# deser_vector(f, CInv) for the inv/getdata payloads, unpacked in one go
+def _deser_inv_vector(f):
+    if type(f) is not BytesReader:
+        return deser_vector(f, CInv)
+    nit = f.read_compact_size()
+    return [CInv(t, _bytes_new(Hash256, h)) for t, h in _inv.iter_unpack(f.read_bytes(36 * nit))]
+
+
 class CBlockLocator(object):
+    __slots__ = ("nVersion", "vHave")
+
     def __init__(self):
         self.nVersion = MY_VERSION
         self.vHave = []
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vHave = deser_uint256_vector(f)
+        self.nVersion = _int32.unpack(f.read(4))[0]
+        self.vHave = deser_hash256_vector(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
         r += ser_uint256_vector(self.vHave)
-        return r
+        return bytes(r)
 
     def __repr__(self):
         return "CBlockLocator(nVersion=%i vHave=%s)" \
             % (self.nVersion, repr(self.vHave))
 
 
+# Bumped whenever a field of an input, output, outpoint or witness is
+# assigned, so the transactions can tell that their cached serializations
+# may be stale (the elements don't know which transactions they are in).
+_element_generation = 0
+
+
+def _element_changed():
+    global _element_generation
+    _element_generation += 1
+
+
+def _element_field(name):
+    """An attribute of a transaction element that bumps the element
+    generation when assigned.  The element's own methods use the slot."""
+    slot = "_" + name
+
+    def setter(self, v):
+        setattr(self, slot, v)
+        _element_changed()
+    return property(attrgetter(slot), setter)
+
+
 class COutPoint(object):
+    __slots__ = ("_hash", "_n")
+
     def __init__(self, hash=0, n=0):
-        self.hash = hash
-        self.n = n
+        self._hash = hash
+        self._n = n
+
+    hash = _element_field("hash")
+    n = _element_field("n")
 
     def deserialize(self, f):
-        self.hash = deser_uint256(f)
-        self.n = struct.unpack("<I", f.read(4))[0]
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        h, self._n = f.unpack(_outpoint)
+        self._hash = _bytes_new(Hash256, h)
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.hash)
-        r += struct.pack("<I", self.n)
-        return r
+        r = BytesWriter()
+        r.write_uint256(self._hash)
+        r += _uint32.pack(self._n)
+        return bytes(r)
 
     def __repr__(self):
         return "COutPoint(hash=%064x n=%i)" % (self.hash, self.n)
 
 
 class CTxIn(object):
+    __slots__ = ("_prevout", "_scriptSig", "_nSequence")
+
     def __init__(self, outpoint=None, scriptSig=b"", nSequence=0):
         if outpoint is None:
-            self.prevout = COutPoint()
+            self._prevout = COutPoint()
         else:
-            self.prevout = outpoint
-        self.scriptSig = scriptSig
-        self.nSequence = nSequence
+            self._prevout = outpoint
+        self._scriptSig = scriptSig
+        self._nSequence = nSequence
+
+    prevout = _element_field("prevout")
+    scriptSig = _element_field("scriptSig")
+    nSequence = _element_field("nSequence")
 
     def deserialize(self, f):
-        self.prevout = COutPoint()
-        self.prevout.deserialize(f)
-        self.scriptSig = deser_string(f)
-        self.nSequence = struct.unpack("<I", f.read(4))[0]
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self._prevout = COutPoint()
+        self._prevout.deserialize(f)
+        self._scriptSig = f.read_string()
+        self._nSequence = f.unpack(_uint32)[0]
 
     def serialize(self):
-        r = b""
-        r += self.prevout.serialize()
-        r += ser_string(self.scriptSig)
-        r += struct.pack("<I", self.nSequence)
-        return r
+        r = BytesWriter()
+        r += self._prevout.serialize()
+        r.write_string(self._scriptSig)
+        r += _uint32.pack(self._nSequence)
+        return bytes(r)
 
     def __repr__(self):
         return "CTxIn(prevout=%s scriptSig=%s nSequence=%i)" \
@@ -340,19 +846,26 @@ class CTxIn(object):
 
 
 class CTxOut(object):
+    __slots__ = ("_nValue", "_scriptPubKey")
+
     def __init__(self, nValue=0, scriptPubKey=b""):
-        self.nValue = nValue
-        self.scriptPubKey = scriptPubKey
+        self._nValue = nValue
+        self._scriptPubKey = scriptPubKey
+
+    nValue = _element_field("nValue")
+    scriptPubKey = _element_field("scriptPubKey")
 
     def deserialize(self, f):
-        self.nValue = struct.unpack("<q", f.read(8))[0]
-        self.scriptPubKey = deser_string(f)
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self._nValue = f.unpack(_int64)[0]
+        self._scriptPubKey = f.read_string()
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<q", self.nValue)
-        r += ser_string(self.scriptPubKey)
-        return r
+        r = BytesWriter()
+        r += _int64.pack(self._nValue)
+        r.write_string(self._scriptPubKey)
+        return bytes(r)
 
     def __repr__(self):
         return "CTxOut(nValue=%i.%08i scriptPubKey=%s)" \
@@ -361,9 +874,27 @@ class CTxOut(object):
 
 
 class CScriptWitness(object):
+    __slots__ = ("_stack",)
+
     def __init__(self):
         # stack is a vector of strings
-        self.stack = []
+        self._stack = _tracked((), self)
+
+    stack = property(attrgetter("_stack"))
+
+    @stack.setter
+    def stack(self, l):
+        self._stack = _tracked(l, self)
+        _element_changed()
+
+    def _invalidate(self):
+        _element_changed()
+
+    def __getstate__(self):
+        return self._stack
+
+    def __setstate__(self, state):
+        self._stack = _tracked(state, self)
 
     def __repr__(self):
         return "CScriptWitness(%s)" % \
@@ -376,11 +907,16 @@ class CScriptWitness(object):
 
 
 class CTxInWitness(object):
+    __slots__ = ("_scriptWitness",)
+
     def __init__(self):
-        self.scriptWitness = CScriptWitness()
+        self._scriptWitness = CScriptWitness()
+
+    scriptWitness = _element_field("scriptWitness")
 
     def deserialize(self, f):
-        self.scriptWitness.stack = deser_string_vector(f)
+        witness = self._scriptWitness
+        witness._stack = _tracked(deser_string_vector(f), witness)
 
     def serialize(self):
         return ser_string_vector(self.scriptWitness.stack)
@@ -392,22 +928,112 @@ class CTxInWitness(object):
         return self.scriptWitness.is_null()
 
 
+class _TrackedList(list):
+    """A list that tells its owner (via owner._invalidate()) when it is
+    modified, so cached serializations and hashes can be dropped.
+
+    Only changes to the list itself are seen here; changes made inside its
+    elements go through the element generation.  Copies and pickles are
+    plain lists.
+    """
+    __slots__ = ("_owner",)
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def __setitem__(self, i, v):
+        self._owner._invalidate()
+        list.__setitem__(self, i, v)
+
+    def __delitem__(self, i):
+        self._owner._invalidate()
+        list.__delitem__(self, i)
+
+    def append(self, v):
+        self._owner._invalidate()
+        list.append(self, v)
+
+    def extend(self, l):
+        self._owner._invalidate()
+        list.extend(self, l)
+
+    def insert(self, i, v):
+        self._owner._invalidate()
+        list.insert(self, i, v)
+
+    def pop(self, i=-1):
+        self._owner._invalidate()
+        return list.pop(self, i)
+
+    def remove(self, v):
+        self._owner._invalidate()
+        list.remove(self, v)
+
+    def clear(self):
+        self._owner._invalidate()
+        list.clear(self)
+
+    def reverse(self):
+        self._owner._invalidate()
+        list.reverse(self)
+
+    def __iadd__(self, l):
+        self._owner._invalidate()
+        return list.__iadd__(self, l)
+
+    def __imul__(self, n):
+        self._owner._invalidate()
+        return list.__imul__(self, n)
+
+    def sort(self, *, key=None, reverse=False):
+        self._owner._invalidate()
+        list.sort(self, key=key, reverse=reverse)
+
+
+def _tracked(iterable, owner):
+    l = _TrackedList(iterable)
+    l._owner = owner
+    return l
+
+
 class CTxWitness(object):
+    __slots__ = ("_vtxinwit", "_tx")
+
     def __init__(self):
-        self.vtxinwit = []
+        self._tx = None
+        self._vtxinwit = _tracked((), self)
+
+    vtxinwit = property(attrgetter("_vtxinwit"))
+
+    @vtxinwit.setter
+    def vtxinwit(self, l):
+        self._vtxinwit = _tracked(l, self)
+        self._invalidate()
+
+    # Called when the witness of the transaction that owns us (if any) changes
+    def _invalidate(self):
+        if self._tx is not None:
+            self._tx._invalidate()
+
+    def __getstate__(self):
+        return self._vtxinwit
+
+    def __setstate__(self, state):
+        self._tx = None
+        self.vtxinwit = state
 
     def deserialize(self, f):
         for i in range(len(self.vtxinwit)):
             self.vtxinwit[i].deserialize(f)
 
     def serialize(self):
-        r = b""
+        r = BytesWriter()
         # This is different than the usual vector serialization --
         # we omit the length of the vector, which is required to be
         # the same length as the transaction's vin vector.
         for x in self.vtxinwit:
             r += x.serialize()
-        return r
+        return bytes(r)
 
     def __repr__(self):
         return "CTxWitness(%s)" % \
@@ -420,66 +1046,352 @@ class CTxWitness(object):
         return True
 
 
+# Inlined equivalents of deser_vector(f, CTxIn) and deser_vector(f, CTxOut)
+# for the transaction parsing hot path: fields are decoded straight out of the
+# reader's buffer without a method call per field.
+def _deser_txin_vector(f):
+    buf = f.buf
+    nit = f.read_compact_size()
+    pos = f.pos
+    r = []
+    for i in range(nit):
+        h, n = _outpoint.unpack_from(buf, pos)
+        l = buf[pos + 36]
+        pos += 37
+        if l >= 253:
+            f.pos = pos - 1
+            l = f.read_compact_size()
+            pos = f.pos
+        scriptSig = buf[pos:pos + l].tobytes()
+        pos += l
+        nSequence = _uint32.unpack_from(buf, pos)[0]
+        pos += 4
+        r.append(CTxIn(COutPoint(_bytes_new(Hash256, h), n), scriptSig, nSequence))
+    f.pos = pos
+    return r
+
+
+def _deser_txout_vector(f):
+    buf = f.buf
+    nit = f.read_compact_size()
+    pos = f.pos
+    r = []
+    for i in range(nit):
+        nValue = _int64.unpack_from(buf, pos)[0]
+        l = buf[pos + 8]
+        pos += 9
+        if l >= 253:
+            f.pos = pos - 1
+            l = f.read_compact_size()
+            pos = f.pos
+        scriptPubKey = buf[pos:pos + l].tobytes()
+        pos += l
+        if pos > len(buf):
+            raise struct.error("read past end of buffer")
+        r.append(CTxOut(nValue, scriptPubKey))
+    f.pos = pos
+    return r
+
+
+def _tx_field(name, default):
+    """A CTransaction attribute that drops the cached serializations when
+    assigned, and reads as default while unset."""
+    slot = "_" + name
+
+    def getter(self):
+        return getattr(self, slot, default)
+
+    def setter(self, v):
+        setattr(self, slot, v)
+        self._invalidate()
+    return property(getter, setter)
+
+
+def _tx_vector_field(name):
+    """Like _tx_field, for a list that is also tracked for modifications
+    (and created empty on first access)."""
+    slot = "_" + name
+
+    def getter(self):
+        l = getattr(self, slot, None)
+        if l is None:
+            l = _tracked((), self)
+            setattr(self, slot, l)
+        return l
+
+    def setter(self, l):
+        setattr(self, slot, _tracked(l, self))
+        self._invalidate()
+    return property(getter, setter)
+
+
+def _deser_blob_vector(f, size):
+    nit = f.read_compact_size()
+    data = f.read_bytes(size * nit)
+    return [data[i:i + size] for i in range(0, size * nit, size)]
+
+
 class CTransaction(object):
+    """A transaction.
+
+    The serializations, txid and wtxid are computed on first use and cached.
+    The cache is dropped when nVersion, vin, vout, wit or nLockTime are
+    assigned, when the vin/vout/wit.vtxinwit lists are modified, and when a
+    field of any input, output, outpoint or witness is assigned (of this
+    transaction or another one: the element generation is global).
+
+    With fOverwintered set this is a Zcash/Komodo Overwinter (v3) or
+    Sapling (v4) transaction: nVersion is then without the overwintered
+    bit, and nVersionGroupId, nExpiryHeight and (v4) valueBalance and the
+    shielded vectors are serialized too.  Shielded spends, outputs and
+    joinsplits are kept as their raw serialized bytes.
+    """
+    __slots__ = ("_nVersion", "_vin", "_vout", "_wit", "_nLockTime",
+                 "_fOverwintered", "_nVersionGroupId", "_nExpiryHeight",
+                 "_valueBalance", "_vShieldedSpend", "_vShieldedOutput",
+                 "_vJoinSplit", "_joinSplitPubKey", "_joinSplitSig", "_bindingSig",
+                 "_ser", "_ser_wit", "_sha256", "_hash", "_wsha256", "_gen")
+
+    # Overwinter fields, only serialized when fOverwintered is set
+    _overwinter_fields = ("nVersionGroupId", "nExpiryHeight", "valueBalance",
+                          "vShieldedSpend", "vShieldedOutput", "vJoinSplit",
+                          "joinSplitPubKey", "joinSplitSig", "bindingSig")
+
     def __init__(self, tx=None):
         if tx is None:
-            self.nVersion = 1
-            self.vin = []
-            self.vout = []
-            self.wit = CTxWitness()
-            self.nLockTime = 0
-            self.sha256 = None
-            self.hash = None
+            self._nVersion = 1
+            self._vin = _tracked((), self)
+            self._vout = _tracked((), self)
+            self._wit = CTxWitness()
+            self._wit._tx = self
+            self._nLockTime = 0
+            self._fOverwintered = False
+            self._invalidate()
         else:
             self.nVersion = tx.nVersion
             self.vin = copy.deepcopy(tx.vin)
             self.vout = copy.deepcopy(tx.vout)
             self.nLockTime = tx.nLockTime
-            self.sha256 = tx.sha256
-            self.hash = tx.hash
             self.wit = copy.deepcopy(tx.wit)
+            self._fOverwintered = tx.fOverwintered
+            if tx.fOverwintered:
+                for name in self._overwinter_fields:
+                    setattr(self, name, copy.deepcopy(getattr(tx, name)))
+            # The hashes of tx carry over unless an element edit made
+            # them stale
+            if tx._gen == _element_generation:
+                self._sha256 = tx._sha256
+                self._hash = tx._hash
+
+    def _invalidate(self):
+        self._ser = None
+        self._ser_wit = None
+        self._sha256 = None
+        self._hash = None
+        self._wsha256 = None
+        self._gen = _element_generation
+
+    nVersion = property(attrgetter("_nVersion"))
+    vin = property(attrgetter("_vin"))
+    vout = property(attrgetter("_vout"))
+    wit = property(attrgetter("_wit"))
+    nLockTime = property(attrgetter("_nLockTime"))
+
+    @nVersion.setter
+    def nVersion(self, v):
+        self._nVersion = v
+        self._invalidate()
+
+    @vin.setter
+    def vin(self, l):
+        self._vin = _tracked(l, self)
+        self._invalidate()
+
+    @vout.setter
+    def vout(self, l):
+        self._vout = _tracked(l, self)
+        self._invalidate()
+
+    @wit.setter
+    def wit(self, w):
+        w._tx = self
+        self._wit = w
+        self._invalidate()
+
+    @nLockTime.setter
+    def nLockTime(self, v):
+        self._nLockTime = v
+        self._invalidate()
+
+    fOverwintered = _tx_field("fOverwintered", False)
+    nVersionGroupId = _tx_field("nVersionGroupId", 0)
+    nExpiryHeight = _tx_field("nExpiryHeight", 0)
+    valueBalance = _tx_field("valueBalance", 0)
+    vShieldedSpend = _tx_vector_field("vShieldedSpend")
+    vShieldedOutput = _tx_vector_field("vShieldedOutput")
+    vJoinSplit = _tx_vector_field("vJoinSplit")
+    joinSplitPubKey = _tx_field("joinSplitPubKey", b"\x00" * 32)
+    joinSplitSig = _tx_field("joinSplitSig", b"\x00" * 64)
+    bindingSig = _tx_field("bindingSig", b"\x00" * 64)
+
+    # The txid, as an int and as the usual hex string.  Assigning None
+    # drops the cache.
+    @property
+    def sha256(self):
+        if self._gen != _element_generation:
+            self._invalidate()
+        if self._sha256 is None:
+            self.calc_sha256()
+        return self._sha256
+
+    @sha256.setter
+    def sha256(self, v):
+        if v is None:
+            self._invalidate()
+        self._sha256 = v
+
+    @property
+    def hash(self):
+        if self._gen != _element_generation:
+            self._invalidate()
+        if self._hash is None:
+            self.calc_sha256()
+        return self._hash
+
+    @hash.setter
+    def hash(self, v):
+        self._hash = v
+
+    def __getstate__(self):
+        overwinter = None
+        if self._fOverwintered:
+            overwinter = tuple(getattr(self, name) for name in self._overwinter_fields)
+        return (self._nVersion, self._vin, self._vout, self._wit, self._nLockTime, overwinter)
+
+    def __setstate__(self, state):
+        self.nVersion, self.vin, self.vout, self.wit, self.nLockTime, overwinter = state
+        self._fOverwintered = overwinter is not None
+        if overwinter is not None:
+            for name, value in zip(self._overwinter_fields, overwinter):
+                setattr(self, name, value)
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.vin = deser_vector(f, CTxIn)
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        self._nVersion = f.unpack(_int32)[0]
+        if self._nVersion < 0:
+            return self._deserialize_overwinter(f)
+        self._fOverwintered = False
+        vin = _deser_txin_vector(f)
+        vout = ()
+        wit = self._wit
         flags = 0
-        if len(self.vin) == 0:
-            flags = struct.unpack("<B", f.read(1))[0]
+        if len(vin) == 0:
+            flags = f.unpack(_uint8)[0]
             # Not sure why flags can't be zero, but this
             # matches the implementation in bitcoind
             if (flags != 0):
-                self.vin = deser_vector(f, CTxIn)
-                self.vout = deser_vector(f, CTxOut)
+                vin = _deser_txin_vector(f)
+                vout = _deser_txout_vector(f)
         else:
-            self.vout = deser_vector(f, CTxOut)
+            vout = _deser_txout_vector(f)
         if flags != 0:
-            self.wit.vtxinwit = [CTxInWitness() for i in range(len(self.vin))]
-            self.wit.deserialize(f)
-        self.nLockTime = struct.unpack("<I", f.read(4))[0]
-        self.sha256 = None
-        self.hash = None
+            wit.vtxinwit = [CTxInWitness() for i in range(len(vin))]
+            wit.deserialize(f)
+        self._nLockTime = f.unpack(_uint32)[0]
+        self._vin = _tracked(vin, self)
+        self._vout = _tracked(vout, self)
+        self._invalidate()
+
+    def _deserialize_overwinter(self, f):
+        self._fOverwintered = True
+        nVersion = self._nVersion = self._nVersion & 0x7fffffff
+        self._nVersionGroupId = f.unpack(_uint32)[0]
+        self._vin = _tracked(_deser_txin_vector(f), self)
+        self._vout = _tracked(_deser_txout_vector(f), self)
+        self._nLockTime = f.unpack(_uint32)[0]
+        self._nExpiryHeight = f.unpack(_uint32)[0] if nVersion >= 3 else 0
+        spends = outputs = joinsplits = ()
+        if nVersion >= 4:
+            self._valueBalance = f.unpack(_int64)[0]
+            spends = _deser_blob_vector(f, SPEND_DESCRIPTION_SIZE)
+            outputs = _deser_blob_vector(f, OUTPUT_DESCRIPTION_SIZE)
+        if nVersion >= 2:
+            joinsplits = _deser_blob_vector(f, JOINSPLIT_SIZE_GROTH if nVersion >= 4 else JOINSPLIT_SIZE)
+            if joinsplits:
+                self._joinSplitPubKey = f.read_bytes(32)
+                self._joinSplitSig = f.read_bytes(64)
+        if spends or outputs:
+            self._bindingSig = f.read_bytes(64)
+        self._vShieldedSpend = _tracked(spends, self)
+        self._vShieldedOutput = _tracked(outputs, self)
+        self._vJoinSplit = _tracked(joinsplits, self)
+        self._invalidate()
+
+    def _serialize_overwinter(self):
+        nVersion = self._nVersion
+        r = BytesWriter()
+        r += _uint32.pack(nVersion | 0x80000000)
+        r += _uint32.pack(self.nVersionGroupId)
+        r.write_vector(self._vin)
+        r.write_vector(self._vout)
+        r += _uint32.pack(self._nLockTime)
+        if nVersion >= 3:
+            r += _uint32.pack(self.nExpiryHeight)
+        if nVersion >= 4:
+            r += _int64.pack(self.valueBalance)
+            for blobs in (self.vShieldedSpend, self.vShieldedOutput):
+                r.write_compact_size(len(blobs))
+                for blob in blobs:
+                    r += blob
+        if nVersion >= 2:
+            r.write_compact_size(len(self.vJoinSplit))
+            for blob in self.vJoinSplit:
+                r += blob
+            if self.vJoinSplit:
+                r += self.joinSplitPubKey
+                r += self.joinSplitSig
+        if nVersion >= 4 and (self.vShieldedSpend or self.vShieldedOutput):
+            r += self.bindingSig
+        return bytes(r)
 
     def serialize_without_witness(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        if self._gen != _element_generation:
+            self._invalidate()
+        if self._ser is None:
+            if self._fOverwintered:
+                self._ser = self._serialize_overwinter()
+                return self._ser
+            r = BytesWriter()
+            r += _int32.pack(self._nVersion)
+            r.write_vector(self._vin)
+            r.write_vector(self._vout)
+            r += _uint32.pack(self._nLockTime)
+            self._ser = bytes(r)
+        return self._ser
 
     # Only serialize with witness when explicitly called for
     def serialize_with_witness(self):
+        if self._gen != _element_generation:
+            self._invalidate()
+        if self._ser_wit is None:
+            self._ser_wit = self._serialize_with_witness()
+        return self._ser_wit
+
+    def _serialize_with_witness(self):
+        if self._fOverwintered:
+            return self.serialize_without_witness()
         flags = 0
         if not self.wit.is_null():
             flags |= 1
-        r = b""
-        r += struct.pack("<i", self.nVersion)
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
         if flags:
             dummy = []
-            r += ser_vector(dummy)
-            r += struct.pack("<B", flags)
-        r += ser_vector(self.vin)
-        r += ser_vector(self.vout)
+            r.write_vector(dummy)
+            r += _uint8.pack(flags)
+        r.write_vector(self.vin)
+        r.write_vector(self.vout)
         if flags & 1:
             if (len(self.wit.vtxinwit) != len(self.vin)):
                 # vtxinwit must have the same length as vin
@@ -487,8 +1399,8 @@ class CTransaction(object):
                 for i in range(len(self.wit.vtxinwit), len(self.vin)):
                     self.wit.vtxinwit.append(CTxInWitness())
             r += self.wit.serialize()
-        r += struct.pack("<I", self.nLockTime)
-        return r
+        r += _uint32.pack(self.nLockTime)
+        return bytes(r)
 
     # Regular serialization is without witness -- must explicitly
     # call serialize_with_witness to include witness data.
@@ -497,19 +1409,23 @@ class CTransaction(object):
 
     # Recalculate the txid (transaction hash without witness)
     def rehash(self):
-        self.sha256 = None
+        self._invalidate()
         self.calc_sha256()
 
-    # We will only cache the serialization without witness in
-    # self.sha256 and self.hash -- those are expected to be the txid.
+    # self.sha256 and self.hash are the txid; with_witness returns the
+    # wtxid, which is cached separately.
     def calc_sha256(self, with_witness=False):
+        if self._gen != _element_generation:
+            self._invalidate()
         if with_witness:
-            # Don't cache the result, just return it
-            return uint256_from_str(hash256(self.serialize_with_witness()))
+            if self._wsha256 is None:
+                self._wsha256 = uint256_from_str(hash256(self.serialize_with_witness()))
+            return self._wsha256
 
-        if self.sha256 is None:
-            self.sha256 = uint256_from_str(hash256(self.serialize_without_witness()))
-        self.hash = encode(hash256(self.serialize())[::-1], 'hex_codec').decode('ascii')
+        if self._sha256 is None:
+            h = hash256(self.serialize_without_witness())
+            self._sha256 = uint256_from_str(h)
+            self._hash = h[::-1].hex()
 
     def is_valid(self):
         self.calc_sha256()
@@ -519,11 +1435,225 @@ class CTransaction(object):
         return True
 
     def __repr__(self):
+        if self._fOverwintered:
+            return "CTransaction(fOverwintered=True nVersion=%i nVersionGroupId=%08x vin=%s vout=%s nLockTime=%i nExpiryHeight=%i valueBalance=%i vShieldedSpend=%i vShieldedOutput=%i vJoinSplit=%i)" \
+                % (self.nVersion, self.nVersionGroupId, repr(self.vin), repr(self.vout),
+                   self.nLockTime, self.nExpiryHeight, self.valueBalance,
+                   len(self.vShieldedSpend), len(self.vShieldedOutput), len(self.vJoinSplit))
         return "CTransaction(nVersion=%i vin=%s vout=%s wit=%s nLockTime=%i)" \
             % (self.nVersion, repr(self.vin), repr(self.vout), repr(self.wit), self.nLockTime)
 
 
+def _compact_size_at(buf, pos):
+    nit = buf[pos]
+    if nit < 253:
+        return nit, pos + 1
+    if nit == 253:
+        return _uint16.unpack_from(buf, pos + 1)[0], pos + 3
+    if nit == 254:
+        return _uint32.unpack_from(buf, pos + 1)[0], pos + 5
+    return _uint64.unpack_from(buf, pos + 1)[0], pos + 9
+
+
+# Find the end of the serialized transaction starting at buf[pos] without
+# decoding it.  Returns (end, has_witness).
+def _scan_transaction(buf, pos):
+    if buf[pos + 3] & 0x80:
+        return _scan_overwinter_transaction(buf, pos), False
+    pos += 4
+    nin, pos = _compact_size_at(buf, pos)
+    witness = False
+    if nin == 0 and buf[pos] != 0:
+        witness = True
+        nin, pos = _compact_size_at(buf, pos + 1)
+    for i in range(nin):
+        l, pos = _compact_size_at(buf, pos + 36)
+        pos += l + 4
+    nout, pos = _compact_size_at(buf, pos)
+    for i in range(nout):
+        l, pos = _compact_size_at(buf, pos + 8)
+        pos += l
+    if witness:
+        for i in range(nin):
+            nitems, pos = _compact_size_at(buf, pos)
+            for j in range(nitems):
+                l, pos = _compact_size_at(buf, pos)
+                pos += l
+    pos += 4
+    if pos > len(buf):
+        raise struct.error("transaction extends past end of buffer")
+    return pos, witness
+
+
+def _scan_overwinter_transaction(buf, pos):
+    nVersion = _uint32.unpack_from(buf, pos)[0] & 0x7fffffff
+    pos += 8
+    nin, pos = _compact_size_at(buf, pos)
+    for i in range(nin):
+        l, pos = _compact_size_at(buf, pos + 36)
+        pos += l + 4
+    nout, pos = _compact_size_at(buf, pos)
+    for i in range(nout):
+        l, pos = _compact_size_at(buf, pos + 8)
+        pos += l
+    pos += 8 if nVersion >= 3 else 4
+    shielded = 0
+    if nVersion >= 4:
+        nspend, pos = _compact_size_at(buf, pos + 8)
+        pos += nspend * SPEND_DESCRIPTION_SIZE
+        noutput, pos = _compact_size_at(buf, pos)
+        pos += noutput * OUTPUT_DESCRIPTION_SIZE
+        shielded = nspend + noutput
+    if nVersion >= 2:
+        njoinsplit, pos = _compact_size_at(buf, pos)
+        pos += njoinsplit * (JOINSPLIT_SIZE_GROTH if nVersion >= 4 else JOINSPLIT_SIZE)
+        if njoinsplit:
+            pos += 96
+    if shielded:
+        pos += 64
+    if pos > len(buf):
+        raise struct.error("transaction extends past end of buffer")
+    return pos
+
+
+class LazyTxList(MutableSequence):
+    """Transaction vector of a block deserialized with lazy=True.
+
+    Keeps the raw serialized vector and decodes each CTransaction on first
+    access; the offset index of the transactions is only built once the
+    vector is first looked at, so reading the header of a lazy block costs
+    the same as reading a CBlockHeader.  get_hashes() computes txids
+    straight from the raw slices.  Any structural change (append, insert,
+    item assignment, ...) decodes the remaining transactions, after which
+    this behaves like a plain list.
+    """
+    __slots__ = ("raw", "offsets", "witness", "txs")
+
+    def __init__(self, raw):
+        self.raw = raw
+        self.offsets = None
+        self.witness = None
+        self.txs = None
+
+    def _index(self):
+        if self.offsets is None:
+            buf = self.raw
+            nit, pos = _compact_size_at(buf, 0)
+            offsets = [pos]
+            witness = []
+            for i in range(nit):
+                pos, has_witness = _scan_transaction(buf, pos)
+                offsets.append(pos)
+                witness.append(has_witness)
+            self.offsets = offsets
+            self.witness = witness
+            self.txs = [None] * nit
+
+    def _decode(self, i):
+        tx = self.txs[i]
+        if tx is None:
+            tx = CTransaction()
+            tx.deserialize(BytesReader(self.raw[self.offsets[i]:self.offsets[i + 1]]))
+            self.txs[i] = tx
+        return tx
+
+    def _materialize(self):
+        if self.raw is not None:
+            self._index()
+            for i in range(len(self.txs)):
+                self._decode(i)
+            self.raw = None
+            self.offsets = None
+            self.witness = None
+
+    def is_decoded(self):
+        return self.raw is None
+
+    def __len__(self):
+        if self.raw is not None:
+            self._index()
+        return len(self.txs)
+
+    def __getitem__(self, i):
+        if self.raw is None:
+            return self.txs[i]
+        self._index()
+        if isinstance(i, slice):
+            return [self._decode(j) for j in range(*i.indices(len(self.txs)))]
+        if i < 0:
+            i += len(self.txs)
+        if not 0 <= i < len(self.txs):
+            raise IndexError("transaction index out of range")
+        return self._decode(i)
+
+    def __setitem__(self, i, value):
+        self._materialize()
+        self.txs[i] = value
+
+    def __delitem__(self, i):
+        self._materialize()
+        del self.txs[i]
+
+    def insert(self, i, value):
+        self._materialize()
+        self.txs.insert(i, value)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        if isinstance(other, (list, LazyTxList)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def get_raw(self, with_witness=False):
+        """Return the serialized vector if it is known to be unchanged.
+
+        That is the case as long as no transaction has been handed out (and
+        so possibly modified); None otherwise."""
+        if self.raw is None:
+            return None
+        if self.offsets is None and with_witness:
+            return self.raw
+        self._index()
+        if any(tx is not None for tx in self.txs):
+            return None
+        if not with_witness and any(self.witness):
+            return None
+        return self.raw
+
+    def get_hashes(self):
+        """Return the txids as 32-byte little endian strings, in order."""
+        hashes = []
+        if self.raw is None:
+            for tx in self.txs:
+                tx.calc_sha256()
+                hashes.append(ser_uint256(tx.sha256))
+            return hashes
+        self._index()
+        raw = self.raw
+        offsets = self.offsets
+        for i in range(len(self.txs)):
+            if self.txs[i] is not None or self.witness[i]:
+                tx = self._decode(i)
+                tx.calc_sha256()
+                hashes.append(ser_uint256(tx.sha256))
+            else:
+                hashes.append(hash256(raw[offsets[i]:offsets[i + 1]]))
+        return hashes
+
+
 class CBlockHeader(object):
+    __slots__ = ("nVersion", "hashPrevBlock", "hashMerkleRoot", "nTime", "nBits",
+                 "nNonce", "sha256", "hash")
+
     def __init__(self, header=None):
         if header is None:
             self.set_null()
@@ -549,36 +1679,37 @@ class CBlockHeader(object):
         self.hash = None
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.hashPrevBlock = deser_uint256(f)
-        self.hashMerkleRoot = deser_uint256(f)
-        self.nTime = struct.unpack("<I", f.read(4))[0]
-        self.nBits = struct.unpack("<I", f.read(4))[0]
-        self.nNonce = struct.unpack("<I", f.read(4))[0]
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        (self.nVersion, hashPrevBlock, hashMerkleRoot,
+         self.nTime, self.nBits, self.nNonce) = f.unpack(_block_header)
+        self.hashPrevBlock = int.from_bytes(hashPrevBlock, 'little')
+        self.hashMerkleRoot = int.from_bytes(hashMerkleRoot, 'little')
         self.sha256 = None
         self.hash = None
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += ser_uint256(self.hashPrevBlock)
-        r += ser_uint256(self.hashMerkleRoot)
-        r += struct.pack("<I", self.nTime)
-        r += struct.pack("<I", self.nBits)
-        r += struct.pack("<I", self.nNonce)
-        return r
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
+        r.write_uint256(self.hashPrevBlock)
+        r.write_uint256(self.hashMerkleRoot)
+        r += _uint32.pack(self.nTime)
+        r += _uint32.pack(self.nBits)
+        r += _uint32.pack(self.nNonce)
+        return bytes(r)
 
     def calc_sha256(self):
         if self.sha256 is None:
-            r = b""
-            r += struct.pack("<i", self.nVersion)
-            r += ser_uint256(self.hashPrevBlock)
-            r += ser_uint256(self.hashMerkleRoot)
-            r += struct.pack("<I", self.nTime)
-            r += struct.pack("<I", self.nBits)
-            r += struct.pack("<I", self.nNonce)
-            self.sha256 = uint256_from_str(hash256(r))
-            self.hash = encode(hash256(r)[::-1], 'hex_codec').decode('ascii')
+            r = BytesWriter()
+            r += _int32.pack(self.nVersion)
+            r.write_uint256(self.hashPrevBlock)
+            r.write_uint256(self.hashMerkleRoot)
+            r += _uint32.pack(self.nTime)
+            r += _uint32.pack(self.nBits)
+            r += _uint32.pack(self.nNonce)
+            h = hash256(r)
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
 
     def rehash(self):
         self.sha256 = None
@@ -591,23 +1722,119 @@ class CBlockHeader(object):
                time.ctime(self.nTime), self.nBits, self.nNonce)
 
 
+# Equihash (200,9) solutions are always this long
+EQUIHASH_SOLUTION_SIZE = 1344
+
+
+class CKomodoBlockHeader(CBlockHeader):
+    """Block header of Komodo and its asset chains (Zcash layout): adds
+    hashFinalSaplingRoot, a 256-bit nNonce and the Equihash nSolution,
+    1487 bytes in all.  The hash covers the whole header, solution
+    included.
+    """
+    __slots__ = ("hashFinalSaplingRoot", "nSolution")
+
+    # header may also be a plain CBlockHeader (or CBlock): it gets a zero
+    # hashFinalSaplingRoot and an empty nSolution, its nNonce is widened,
+    # and the hash is computed over the Komodo serialization.
+    def __init__(self, header=None):
+        komodo = isinstance(header, CKomodoBlockHeader)
+        if komodo:
+            self.hashFinalSaplingRoot = header.hashFinalSaplingRoot
+            self.nSolution = header.nSolution
+        elif header is not None:
+            self.hashFinalSaplingRoot = 0
+            self.nSolution = b""
+        super(CKomodoBlockHeader, self).__init__(header)
+        if header is not None and not komodo:
+            self.rehash()
+
+    def set_null(self):
+        super(CKomodoBlockHeader, self).set_null()
+        self.hashFinalSaplingRoot = 0
+        self.nSolution = b""
+
+    def deserialize(self, f):
+        if type(f) is not BytesReader:
+            return deserialize_stream(self, f)
+        (self.nVersion, hashPrevBlock, hashMerkleRoot, hashFinalSaplingRoot,
+         self.nTime, self.nBits, nNonce) = f.unpack(_komodo_header)
+        self.hashPrevBlock = int.from_bytes(hashPrevBlock, 'little')
+        self.hashMerkleRoot = int.from_bytes(hashMerkleRoot, 'little')
+        self.hashFinalSaplingRoot = int.from_bytes(hashFinalSaplingRoot, 'little')
+        self.nNonce = int.from_bytes(nNonce, 'little')
+        self.nSolution = f.read_string()
+        self.sha256 = None
+        self.hash = None
+
+    def serialize(self):
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
+        r.write_uint256(self.hashPrevBlock)
+        r.write_uint256(self.hashMerkleRoot)
+        r.write_uint256(self.hashFinalSaplingRoot)
+        r += _uint32.pack(self.nTime)
+        r += _uint32.pack(self.nBits)
+        r.write_uint256(self.nNonce)
+        r.write_string(self.nSolution)
+        return bytes(r)
+
+    # The header without nSolution, which is what the solution solves
+    def get_equihash_input(self):
+        return self.serialize()[:_komodo_header.size]
+
+    def calc_sha256(self):
+        if self.sha256 is None:
+            h = hash256(self.serialize())
+            self.sha256 = uint256_from_str(h)
+            self.hash = h[::-1].hex()
+
+    def __repr__(self):
+        return "CKomodoBlockHeader(nVersion=%i hashPrevBlock=%064x hashMerkleRoot=%064x hashFinalSaplingRoot=%064x nTime=%s nBits=%08x nNonce=%064x nSolution=%s)" \
+            % (self.nVersion, self.hashPrevBlock, self.hashMerkleRoot,
+               self.hashFinalSaplingRoot, time.ctime(self.nTime), self.nBits,
+               self.nNonce, bytes_to_hex_str(self.nSolution))
+
+
 class CBlock(CBlockHeader):
+    __slots__ = ("vtx",)
+
     def __init__(self, header=None):
         super(CBlock, self).__init__(header)
         self.vtx = []
 
-    def deserialize(self, f):
+    # With lazy=True the transactions are kept as a LazyTxList and only
+    # decoded when accessed.  The block is assumed to extend to the end of f.
+    def deserialize(self, f, lazy=False):
+        if type(f) is not BytesReader:
+            r = BytesReader.from_stream(f)
+            self.deserialize(r, lazy)
+            r.sync(f)
+            return
         super(CBlock, self).deserialize(f)
-        self.vtx = deser_vector(f, CTransaction)
+        if lazy:
+            raw = f.read()
+            if not raw.readonly:
+                # Don't hold on to a buffer that may be reused (eg the
+                # NodeConn receive buffer)
+                raw = raw.tobytes()
+            self.vtx = LazyTxList(raw)
+        else:
+            self.vtx = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=False):
-        r = b""
+        r = BytesWriter()
         r += super(CBlock, self).serialize()
-        if with_witness:
-            r += ser_vector(self.vtx, "serialize_with_witness")
+        raw = None
+        if type(self.vtx) is LazyTxList:
+            raw = self.vtx.get_raw(with_witness)
+        if raw is not None:
+            r += raw
+        elif with_witness:
+            r.write_vector(self.vtx, "serialize_with_witness")
         else:
-            r += ser_vector(self.vtx)
-        return r
+            r.write_vector(self.vtx)
+        return bytes(r)
 
     # Calculate the merkle root given a vector of transaction hashes
     def get_merkle_root(self, hashes):
@@ -620,6 +1847,8 @@ class CBlock(CBlockHeader):
         return uint256_from_str(hashes[0])
 
     def calc_merkle_root(self):
+        if type(self.vtx) is LazyTxList:
+            return self.get_merkle_root(self.vtx.get_hashes())
         hashes = []
         for tx in self.vtx:
             tx.calc_sha256()
@@ -679,36 +1908,36 @@ class CUnsignedAlert(object):
         self.strReserved = b""
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
-        self.nRelayUntil = struct.unpack("<q", f.read(8))[0]
-        self.nExpiration = struct.unpack("<q", f.read(8))[0]
-        self.nID = struct.unpack("<i", f.read(4))[0]
-        self.nCancel = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = _int32.unpack(f.read(4))[0]
+        self.nRelayUntil = _int64.unpack(f.read(8))[0]
+        self.nExpiration = _int64.unpack(f.read(8))[0]
+        self.nID = _int32.unpack(f.read(4))[0]
+        self.nCancel = _int32.unpack(f.read(4))[0]
         self.setCancel = deser_int_vector(f)
-        self.nMinVer = struct.unpack("<i", f.read(4))[0]
-        self.nMaxVer = struct.unpack("<i", f.read(4))[0]
+        self.nMinVer = _int32.unpack(f.read(4))[0]
+        self.nMaxVer = _int32.unpack(f.read(4))[0]
         self.setSubVer = deser_string_vector(f)
-        self.nPriority = struct.unpack("<i", f.read(4))[0]
+        self.nPriority = _int32.unpack(f.read(4))[0]
         self.strComment = deser_string(f)
         self.strStatusBar = deser_string(f)
         self.strReserved = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<q", self.nRelayUntil)
-        r += struct.pack("<q", self.nExpiration)
-        r += struct.pack("<i", self.nID)
-        r += struct.pack("<i", self.nCancel)
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
+        r += _int64.pack(self.nRelayUntil)
+        r += _int64.pack(self.nExpiration)
+        r += _int32.pack(self.nID)
+        r += _int32.pack(self.nCancel)
         r += ser_int_vector(self.setCancel)
-        r += struct.pack("<i", self.nMinVer)
-        r += struct.pack("<i", self.nMaxVer)
+        r += _int32.pack(self.nMinVer)
+        r += _int32.pack(self.nMaxVer)
         r += ser_string_vector(self.setSubVer)
-        r += struct.pack("<i", self.nPriority)
-        r += ser_string(self.strComment)
-        r += ser_string(self.strStatusBar)
-        r += ser_string(self.strReserved)
-        return r
+        r += _int32.pack(self.nPriority)
+        r.write_string(self.strComment)
+        r.write_string(self.strStatusBar)
+        r.write_string(self.strReserved)
+        return bytes(r)
 
     def __repr__(self):
         return "CUnsignedAlert(nVersion %d, nRelayUntil %d, nExpiration %d, nID %d, nCancel %d, nMinVer %d, nMaxVer %d, nPriority %d, strComment %s, strStatusBar %s, strReserved %s)" \
@@ -727,10 +1956,10 @@ class CAlert(object):
         self.vchSig = deser_string(f)
 
     def serialize(self):
-        r = b""
-        r += ser_string(self.vchMsg)
-        r += ser_string(self.vchSig)
-        return r
+        r = BytesWriter()
+        r.write_string(self.vchMsg)
+        r.write_string(self.vchSig)
+        return bytes(r)
 
     def __repr__(self):
         return "CAlert(vchMsg.sz %d, vchSig.sz %d)" \
@@ -748,13 +1977,13 @@ class PrefilledTransaction(object):
         self.tx.deserialize(f)
 
     def serialize(self, with_witness=False):
-        r = b""
-        r += ser_compact_size(self.index)
+        r = BytesWriter()
+        r.write_compact_size(self.index)
         if with_witness:
             r += self.tx.serialize_with_witness()
         else:
             r += self.tx.serialize_without_witness()
-        return r
+        return bytes(r)
 
     def serialize_with_witness(self):
         return self.serialize(with_witness=True)
@@ -774,29 +2003,29 @@ class P2PHeaderAndShortIDs(object):
 
     def deserialize(self, f):
         self.header.deserialize(f)
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _uint64.unpack(f.read(8))[0]
         self.shortids_length = deser_compact_size(f)
         for i in range(self.shortids_length):
             # shortids are defined to be 6 bytes in the spec, so append
             # two zero bytes and read it in as an 8-byte number
-            self.shortids.append(struct.unpack("<Q", f.read(6) + b'\x00\x00')[0])
+            self.shortids.append(_uint64.unpack(bytes(f.read(6)) + b'\x00\x00')[0])
         self.prefilled_txn = deser_vector(f, PrefilledTransaction)
         self.prefilled_txn_length = len(self.prefilled_txn)
 
     # When using version 2 compact blocks, we must serialize with_witness.
     def serialize(self, with_witness=False):
-        r = b""
+        r = BytesWriter()
         r += self.header.serialize()
-        r += struct.pack("<Q", self.nonce)
-        r += ser_compact_size(self.shortids_length)
+        r += _uint64.pack(self.nonce)
+        r.write_compact_size(self.shortids_length)
         for x in self.shortids:
             # We only want the first 6 bytes
-            r += struct.pack("<Q", x)[0:6]
+            r += _uint64.pack(x)[0:6]
         if with_witness:
-            r += ser_vector(self.prefilled_txn, "serialize_with_witness")
+            r.write_vector(self.prefilled_txn, "serialize_with_witness")
         else:
-            r += ser_vector(self.prefilled_txn)
-        return r
+            r.write_vector(self.prefilled_txn)
+        return bytes(r)
 
     def __repr__(self):
         return "P2PHeaderAndShortIDs(header=%s, nonce=%d, shortids_length=%d, shortids=%s, prefilled_txn_length=%d, prefilledtxn=%s" % (repr(self.header), self.nonce, self.shortids_length, repr(self.shortids), self.prefilled_txn_length, repr(self.prefilled_txn))
@@ -851,7 +2080,7 @@ class HeaderAndShortIDs(object):
 
     def get_siphash_keys(self):
         header_nonce = self.header.serialize()
-        header_nonce += struct.pack("<Q", self.nonce)
+        header_nonce += _uint64.pack(self.nonce)
         hash_header_nonce_as_str = sha256(header_nonce)
         key0 = struct.unpack("<Q", hash_header_nonce_as_str[0:8])[0]
         key1 = struct.unpack("<Q", hash_header_nonce_as_str[8:16])[0]
@@ -889,12 +2118,12 @@ class BlockTransactionsRequest(object):
             self.indexes.append(deser_compact_size(f))
 
     def serialize(self):
-        r = b""
-        r += ser_uint256(self.blockhash)
-        r += ser_compact_size(len(self.indexes))
+        r = BytesWriter()
+        r.write_uint256(self.blockhash)
+        r.write_compact_size(len(self.indexes))
         for x in self.indexes:
-            r += ser_compact_size(x)
-        return r
+            r.write_compact_size(x)
+        return bytes(r)
 
     # helper to set the differentially encoded indexes from absolute ones
     def from_absolute(self, absolute_indexes):
@@ -927,13 +2156,13 @@ class BlockTransactions(object):
         self.transactions = deser_vector(f, CTransaction)
 
     def serialize(self, with_witness=False):
-        r = b""
-        r += ser_uint256(self.blockhash)
+        r = BytesWriter()
+        r.write_uint256(self.blockhash)
         if with_witness:
-            r += ser_vector(self.transactions, "serialize_with_witness")
+            r.write_vector(self.transactions, "serialize_with_witness")
         else:
-            r += ser_vector(self.transactions)
-        return r
+            r.write_vector(self.transactions)
+        return bytes(r)
 
     def __repr__(self):
         return "BlockTransactions(hash=%064x transactions=%s)" % (self.blockhash, repr(self.transactions))
@@ -955,18 +2184,18 @@ class msg_version(object):
         self.nRelay = MY_RELAY
 
     def deserialize(self, f):
-        self.nVersion = struct.unpack("<i", f.read(4))[0]
+        self.nVersion = _int32.unpack(f.read(4))[0]
         if self.nVersion == 10300:
             self.nVersion = 300
-        self.nServices = struct.unpack("<Q", f.read(8))[0]
-        self.nTime = struct.unpack("<q", f.read(8))[0]
+        self.nServices = _uint64.unpack(f.read(8))[0]
+        self.nTime = _int64.unpack(f.read(8))[0]
         self.addrTo = CAddress()
         self.addrTo.deserialize(f)
 
         if self.nVersion >= 106:
             self.addrFrom = CAddress()
             self.addrFrom.deserialize(f)
-            self.nNonce = struct.unpack("<Q", f.read(8))[0]
+            self.nNonce = _uint64.unpack(f.read(8))[0]
             self.strSubVer = deser_string(f)
         else:
             self.addrFrom = None
@@ -975,31 +2204,31 @@ class msg_version(object):
             self.nStartingHeight = None
 
         if self.nVersion >= 209:
-            self.nStartingHeight = struct.unpack("<i", f.read(4))[0]
+            self.nStartingHeight = _int32.unpack(f.read(4))[0]
         else:
             self.nStartingHeight = None
 
         if self.nVersion >= 70001:
             # Relay field is optional for version 70001 onwards
             try:
-                self.nRelay = struct.unpack("<b", f.read(1))[0]
+                self.nRelay = _int8.unpack(f.read(1))[0]
             except:
                 self.nRelay = 0
         else:
             self.nRelay = 0
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<i", self.nVersion)
-        r += struct.pack("<Q", self.nServices)
-        r += struct.pack("<q", self.nTime)
+        r = BytesWriter()
+        r += _int32.pack(self.nVersion)
+        r += _uint64.pack(self.nServices)
+        r += _int64.pack(self.nTime)
         r += self.addrTo.serialize()
         r += self.addrFrom.serialize()
-        r += struct.pack("<Q", self.nNonce)
-        r += ser_string(self.strSubVer)
-        r += struct.pack("<i", self.nStartingHeight)
-        r += struct.pack("<b", self.nRelay)
-        return r
+        r += _uint64.pack(self.nNonce)
+        r.write_string(self.strSubVer)
+        r += _int32.pack(self.nStartingHeight)
+        r += _int8.pack(self.nRelay)
+        return bytes(r)
 
     def __repr__(self):
         return 'msg_version(nVersion=%i nServices=%i nTime=%s addrTo=%s addrFrom=%s nNonce=0x%016X strSubVer=%s nStartingHeight=%i nRelay=%i)' \
@@ -1051,9 +2280,7 @@ class msg_alert(object):
         self.alert.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.alert.serialize()
-        return r
+        return self.alert.serialize()
 
     def __repr__(self):
         return "msg_alert(alert=%s)" % (repr(self.alert), )
@@ -1069,7 +2296,7 @@ class msg_inv(object):
             self.inv = inv
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = _deser_inv_vector(f)
 
     def serialize(self):
         return ser_vector(self.inv)
@@ -1085,7 +2312,7 @@ class msg_getdata(object):
         self.inv = inv if inv != None else []
 
     def deserialize(self, f):
-        self.inv = deser_vector(f, CInv)
+        self.inv = _deser_inv_vector(f)
 
     def serialize(self):
         return ser_vector(self.inv)
@@ -1104,13 +2331,13 @@ class msg_getblocks(object):
     def deserialize(self, f):
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = deser_hash256(f)
 
     def serialize(self):
-        r = b""
+        r = BytesWriter()
         r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        r.write_uint256(self.hashstop)
+        return bytes(r)
 
     def __repr__(self):
         return "msg_getblocks(locator=%s hashstop=%064x)" \
@@ -1172,8 +2399,7 @@ class msg_generic(object):
 class msg_witness_block(msg_block):
 
     def serialize(self):
-        r = self.block.serialize(with_witness=True)
-        return r
+        return self.block.serialize(with_witness=True)
 
 class msg_getaddr(object):
     command = b"getaddr"
@@ -1214,12 +2440,10 @@ class msg_ping(object):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _uint64.unpack(f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return _uint64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_ping(nonce=%08x)" % self.nonce
@@ -1232,12 +2456,10 @@ class msg_pong(object):
         self.nonce = nonce
 
     def deserialize(self, f):
-        self.nonce = struct.unpack("<Q", f.read(8))[0]
+        self.nonce = _uint64.unpack(f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.nonce)
-        return r
+        return _uint64.pack(self.nonce)
 
     def __repr__(self):
         return "msg_pong(nonce=%08x)" % self.nonce
@@ -1288,13 +2510,13 @@ class msg_getheaders(object):
     def deserialize(self, f):
         self.locator = CBlockLocator()
         self.locator.deserialize(f)
-        self.hashstop = deser_uint256(f)
+        self.hashstop = deser_hash256(f)
 
     def serialize(self):
-        r = b""
+        r = BytesWriter()
         r += self.locator.serialize()
-        r += ser_uint256(self.hashstop)
-        return r
+        r.write_uint256(self.hashstop)
+        return bytes(r)
 
     def __repr__(self):
         return "msg_getheaders(locator=%s, stop=%064x)" \
@@ -1331,43 +2553,58 @@ class msg_reject(object):
         self.message = b""
         self.code = 0
         self.reason = b""
-        self.data = 0
+        self.data = Hash256()
 
     def deserialize(self, f):
         self.message = deser_string(f)
-        self.code = struct.unpack("<B", f.read(1))[0]
+        self.code = _uint8.unpack(f.read(1))[0]
         self.reason = deser_string(f)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            self.data = deser_uint256(f)
+            self.data = deser_hash256(f)
 
     def serialize(self):
-        r = ser_string(self.message)
-        r += struct.pack("<B", self.code)
-        r += ser_string(self.reason)
+        r = BytesWriter()
+        r.write_string(self.message)
+        r += _uint8.pack(self.code)
+        r.write_string(self.reason)
         if (self.code != self.REJECT_MALFORMED and
                 (self.message == b"block" or self.message == b"tx")):
-            r += ser_uint256(self.data)
-        return r
+            r.write_uint256(self.data)
+        return bytes(r)
 
     def __repr__(self):
         return "msg_reject: %s %d %s [%064x]" \
             % (self.message, self.code, self.reason, self.data)
 
-# Helper function
-def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf')):
-    attempt = 0
-    elapsed = 0
-
-    while attempt < attempts and elapsed < timeout:
-        with mininode_lock:
-            if predicate():
-                return True
-        attempt += 1
-        elapsed += 0.05
-        time.sleep(0.05)
+# How often wait_until() checks the predicate when nothing wakes it up, for
+# predicates on state that messages don't change (an RPC call, say)
+WAIT_POLL_INTERVAL = 0.05
+
+# Wait until predicate() is true, checking it with lock held.  With a lock
+# that can be waited on (mininode_lock, a threading.Condition) the check is
+# repeated as soon as the lock is notified, and at least every
+# WAIT_POLL_INTERVAL seconds; attempts counts such intervals.
+def wait_until(predicate, *, attempts=float('inf'), timeout=float('inf'), lock=mininode_lock):
+    timeout = min(timeout, attempts * WAIT_POLL_INTERVAL)
+    deadline = time.monotonic() + timeout
+    wait = getattr(lock, "wait", None)
+
+    with lock:
+        while not predicate():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if wait is not None:
+                wait(min(remaining, WAIT_POLL_INTERVAL))
+            else:
+                lock.release()
+                try:
+                    time.sleep(min(remaining, WAIT_POLL_INTERVAL))
+                finally:
+                    lock.acquire()
 
-    return False
+    return True
 
 class msg_feefilter(object):
     command = b"feefilter"
@@ -1376,12 +2613,10 @@ class msg_feefilter(object):
         self.feerate = feerate
 
     def deserialize(self, f):
-        self.feerate = struct.unpack("<Q", f.read(8))[0]
+        self.feerate = _uint64.unpack(f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<Q", self.feerate)
-        return r
+        return _uint64.pack(self.feerate)
 
     def __repr__(self):
         return "msg_feefilter(feerate=%08x)" % self.feerate
@@ -1394,14 +2629,14 @@ class msg_sendcmpct(object):
         self.version = 1
 
     def deserialize(self, f):
-        self.announce = struct.unpack("<?", f.read(1))[0]
-        self.version = struct.unpack("<Q", f.read(8))[0]
+        self.announce = _bool.unpack(f.read(1))[0]
+        self.version = _uint64.unpack(f.read(8))[0]
 
     def serialize(self):
-        r = b""
-        r += struct.pack("<?", self.announce)
-        r += struct.pack("<Q", self.version)
-        return r
+        r = BytesWriter()
+        r += _bool.pack(self.announce)
+        r += _uint64.pack(self.version)
+        return bytes(r)
 
     def __repr__(self):
         return "msg_sendcmpct(announce=%s, version=%lu)" % (self.announce, self.version)
@@ -1417,9 +2652,7 @@ class msg_cmpctblock(object):
         self.header_and_shortids.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.header_and_shortids.serialize()
-        return r
+        return self.header_and_shortids.serialize()
 
     def __repr__(self):
         return "msg_cmpctblock(HeaderAndShortIDs=%s)" % repr(self.header_and_shortids)
@@ -1435,9 +2668,7 @@ class msg_getblocktxn(object):
         self.block_txn_request.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_txn_request.serialize()
-        return r
+        return self.block_txn_request.serialize()
 
     def __repr__(self):
         return "msg_getblocktxn(block_txn_request=%s)" % (repr(self.block_txn_request))
@@ -1452,51 +2683,192 @@ class msg_blocktxn(object):
         self.block_transactions.deserialize(f)
 
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize()
-        return r
+        return self.block_transactions.serialize()
 
     def __repr__(self):
         return "msg_blocktxn(block_transactions=%s)" % (repr(self.block_transactions))
 
 class msg_witness_blocktxn(msg_blocktxn):
     def serialize(self):
-        r = b""
-        r += self.block_transactions.serialize(with_witness=True)
-        return r
+        return self.block_transactions.serialize(with_witness=True)
+
+# nSPV request (getnSPV) and response (nSPV) messages.  The payload is
+# passed through as is; its first byte is the NSPV_* request or response
+# type of nSPV_defs.h.
+class msg_getnSPV(object):
+    command = b"getnSPV"
+
+    def __init__(self, payload=b""):
+        self.payload = payload
+
+    def deserialize(self, f):
+        self.payload = bytes(f.read())
+
+    def serialize(self):
+        return self.payload
+
+    def get_type(self):
+        return self.payload[0] if self.payload else None
+
+    def __repr__(self):
+        return "%s(payload=%s)" % (type(self).__name__, self.payload.hex())
+
+class msg_nSPV(msg_getnSPV):
+    command = b"nSPV"
+
+# Calls several handlers of a message in turn (see NodeConnCB.add_handler)
+class _FanOut(object):
+    __slots__ = ("handlers",)
+
+    def __init__(self, handlers):
+        self.handlers = tuple(handlers)
+
+    def __call__(self, conn, message):
+        for handler in self.handlers:
+            handler(conn, message)
 
 # This is what a callback should look like for NodeConn
 # Reimplement the on_* functions to provide handling for events
 class NodeConnCB(object):
+    # on_* callbacks that don't handle a message
+    _not_handlers = ("on_close", "on_open")
+
     def __init__(self):
         self.verack_received = False
         # deliver_sleep_time is helpful for debugging race conditions in p2p
         # tests; it causes message delivery to sleep for the specified time
-        # before acquiring the global lock and delivering the next message.
+        # before acquiring the lock and delivering the next message.
         self.deliver_sleep_time = None
+        # Held while delivering a message to this callback
+        self.lock = RLock()
+        # Notified after each delivery while wait_until() waits on it
+        self.changed = threading.Condition(self.lock)
+        # Threads waiting on changed, or on mininode_lock
+        self.waiting = 0
         # Remember the services our peer has advertised
         self.peer_services = None
         self.connection = None
         self.ping_counter = 1
         self.last_pong = msg_pong()
+        # command -> what deliver() calls for it: the on_<command> method,
+        # unless changed with set_handler()/add_handler()
+        self._methods = dict((command, getattr(self, name))
+                             for command, name in self._handler_names().items())
+        self.handlers = dict(self._methods)
+        mininode_lock.register(self)
+
+    # An on_<command> method assigned to (or deleted from) the instance
+    # after __init__ takes the place of the one handlers had for it.  A
+    # handler set with set_handler() stays in place.
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        if name[:3] == "on_":
+            self._replace_method(name)
+
+    def __delattr__(self, name):
+        object.__delattr__(self, name)
+        if name[:3] == "on_":
+            self._replace_method(name)
+
+    def _replace_method(self, name):
+        methods = getattr(self, "_methods", None)
+        command = name[3:].encode('ascii')
+        if methods is None or command not in methods:
+            return
+        old = methods[command]
+        new = methods[command] = getattr(self, name)
+        with self.lock:
+            current = self.handlers.get(command)
+            if type(current) is _FanOut:
+                self.handlers[command] = _FanOut(new if handler == old else handler for handler in current.handlers)
+            elif current == old:
+                self.handlers[command] = new
+
+    # command -> name of its on_<command> method, found once per class
+    @classmethod
+    def _handler_names(cls):
+        names = cls.__dict__.get("_handler_name_map")
+        if names is None:
+            names = {}
+            for name in dir(cls):
+                if name.startswith("on_") and name not in cls._not_handlers:
+                    names[name[3:].encode('ascii')] = name
+            cls._handler_name_map = names
+        return names
 
     def deliver(self, conn, message):
-        deliver_sleep = self.get_deliver_sleep_time()
-        if deliver_sleep is not None:
-            time.sleep(deliver_sleep)
-        with mininode_lock:
+        if self.deliver_sleep_time is not None:
+            time.sleep(self.deliver_sleep_time)
+        command = message.command
+        handler = self.handlers.get(command)
+        if handler is None:
+            logger.error("ERROR delivering %s: no handler" % repr(message))
+            return
+        # Deliver times are recorded only if turned on in the registry
+        stats = getattr(conn, "conn_metrics", None)
+        if stats is not None and not stats.deliver_times:
+            stats = None
+        with self.lock:
+            if stats is not None:
+                start = time.perf_counter_ns()
             try:
-                getattr(self, 'on_' + message.command.decode('ascii'))(conn, message)
+                handler(conn, message)
             except:
                 logger.exception("ERROR delivering %s" % repr(message))
+            if stats is not None:
+                stats.delivered(command, time.perf_counter_ns() - start)
+            if self.waiting:
+                self.changed.notify_all()
+                mininode_lock.notify_delivery()
+
+    # Call on_open()/on_close() (event is "open" or "close") under the
+    # same locks as a message, so waits see the change
+    def deliver_event(self, conn, event):
+        with self.lock:
+            try:
+                getattr(self, "on_" + event)(conn)
+            finally:
+                if self.waiting:
+                    self.changed.notify_all()
+                    mininode_lock.notify_delivery()
+
+    # Have deliver() call handler(conn, message) for messages of command,
+    # instead of the handler(s) it had
+    def set_handler(self, command, handler):
+        with self.lock:
+            self.handlers[command] = handler
+
+    # Have deliver() call handler(conn, message) for messages of command
+    # after the handler(s) it already has.  An exception in one handler
+    # skips the ones after it.
+    def add_handler(self, command, handler):
+        with self.lock:
+            current = self.handlers.get(command)
+            if current is None:
+                self.handlers[command] = handler
+            elif type(current) is _FanOut:
+                self.handlers[command] = _FanOut(current.handlers + (handler,))
+            else:
+                self.handlers[command] = _FanOut((current, handler))
+
+    # Undo add_handler()
+    def remove_handler(self, command, handler):
+        with self.lock:
+            current = self.handlers.get(command)
+            if type(current) is _FanOut:
+                handlers = list(current.handlers)
+                handlers.remove(handler)
+                self.handlers[command] = handlers[0] if len(handlers) == 1 else _FanOut(handlers)
+            elif current == handler:
+                del self.handlers[command]
+            else:
+                raise ValueError("%r is not a handler of %r" % (handler, command))
 
     def set_deliver_sleep_time(self, value):
-        with mininode_lock:
-            self.deliver_sleep_time = value
+        self.deliver_sleep_time = value
 
     def get_deliver_sleep_time(self):
-        with mininode_lock:
-            return self.deliver_sleep_time
+        return self.deliver_sleep_time
 
     # Callbacks which can be overridden by subclasses
     #################################################
@@ -1513,8 +2885,10 @@ class NodeConnCB(object):
     def on_getblocktxn(self, conn, message): pass
     def on_getdata(self, conn, message): pass
     def on_getheaders(self, conn, message): pass
+    def on_getnSPV(self, conn, message): pass
     def on_headers(self, conn, message): pass
     def on_mempool(self, conn): pass
+    def on_nSPV(self, conn, message): pass
     def on_open(self, conn): pass
     def on_reject(self, conn, message): pass
     def on_sendcmpct(self, conn, message): pass
@@ -1562,12 +2936,22 @@ class NodeConnCB(object):
         self.send_message(message)
         self.sync_with_ping()
 
+    # wait_until() on this callback's state, woken up by each message
+    # delivered to it
+    def wait_until(self, predicate, *, attempts=float('inf'), timeout=float('inf')):
+        with self.lock:
+            self.waiting += 1
+            try:
+                return wait_until(predicate, attempts=attempts, timeout=timeout, lock=self.changed)
+            finally:
+                self.waiting -= 1
+
     # Sync up with the node
     def sync_with_ping(self, timeout=60):
         def received_pong():
             return (self.last_pong.nonce == self.ping_counter)
         self.send_message(msg_ping(nonce=self.ping_counter))
-        success = wait_until(received_pong, timeout=timeout)
+        success = self.wait_until(received_pong, timeout=timeout)
         if not success:
             logger.error("sync_with_ping failed!")
             raise AssertionError("sync_with_ping failed!")
@@ -1575,20 +2959,333 @@ class NodeConnCB(object):
 
         return success
 
-    # Spin until verack message is received from the node.
+    # Wait until verack message is received from the node.
     # Tests may want to use this as a signal that the test can begin.
     # This can be called from the testing thread, so it needs to acquire the
-    # global lock.
+    # lock.
     def wait_for_verack(self):
+        self.wait_until(lambda: self.verack_received)
+
+class RecvBuffer(object):
+    """Receive buffer of a P2P connection.
+
+    The socket reads straight into a preallocated bytearray (recv_into)
+    and messages are consumed from a read offset, so the payloads can be
+    handed to the parser as memoryview slices of the buffer.  The unread
+    tail is moved to the front only when the free space at the end runs
+    out, and the buffer grows once to fit a message larger than itself,
+    which keeps receiving a multi-megabyte block linear in its size.
+
+    Parsed objects must not keep views of the buffer: it is overwritten
+    by later reads (CBlock.deserialize(lazy=True) copies, for instance).
+    """
+    __slots__ = ("size", "buf", "view", "start", "end", "want")
+
+    # Minimum free space offered to recv_into
+    MIN_READ = 4096
+
+    def __init__(self, size=64 * 1024):
+        self.size = size
+        self.buf = bytearray(size)
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # Size of the message being received, if it didn't fit
+        self.want = 0
+
+    def __len__(self):
+        return self.end - self.start
+
+    def capacity(self):
+        return len(self.buf)
+
+    def clear(self):
+        self.start = self.end = self.want = 0
+        if len(self.buf) != self.size:
+            self.buf = bytearray(self.size)
+            self.view = memoryview(self.buf)
+
+    # The free space to recv_into(); call commit() with the byte count read
+    def get_free(self):
+        start = self.start
+        unread = self.end - start
+        need = max(self.want, unread + self.MIN_READ)
+        if start + need > len(self.buf):
+            if need > len(self.buf):
+                buf = bytearray(max(need, len(self.buf) * 2))
+                buf[:unread] = self.view[start:self.end]
+                self.buf = buf
+                self.view = memoryview(buf)
+            else:
+                # (a bytearray slice is a copy, so the ranges may overlap)
+                self.buf[:unread] = self.buf[start:self.end]
+            self.start = 0
+            self.end = unread
+        return self.view[self.end:]
+
+    def commit(self, n):
+        self.end += n
+
+    # Mark the first n unread bytes as read
+    def consume(self, n):
+        self.start += n
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    # Make get_free() leave room for an n-byte message at the read offset
+    def reserve(self, n):
+        self.want = n
+
+    def peek(self):
+        return self.view[self.start:self.end]
+
+
+class SendQueue(object):
+    """Send queue of a P2P connection.
+
+    Frames are queued as their separate buffers (message header and
+    payload) and written with socket.sendmsg, many at a time, so neither
+    the frame nor the queue is ever joined into one string.  After a
+    partial write the head of the queue becomes a memoryview of its unsent
+    part, so a payload larger than the socket buffer is never copied.
+    """
+    __slots__ = ("buffers", "size")
+
+    try:
+        IOV_MAX = min(os.sysconf("SC_IOV_MAX"), 1024)
+    except (AttributeError, ValueError, OSError):
+        IOV_MAX = 16
+
+    def __init__(self):
+        self.buffers = deque()
+        # Bytes queued
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, *buffers):
+        for b in buffers:
+            if len(b):
+                self.buffers.append(b)
+                self.size += len(b)
+
+    def clear(self):
+        self.buffers.clear()
+        self.size = 0
+
+    # Write as much as the socket takes without blocking.  Returns the
+    # number of bytes sent; socket errors other than EAGAIN are raised.
+    def flush(self, sock):
+        buffers = self.buffers
+        total = 0
+        while buffers:
+            try:
+                sent = sock.sendmsg(islice(buffers, self.IOV_MAX))
+            except (BlockingIOError, InterruptedError):
+                break
+            total += sent
+            self.size -= sent
+            while sent:
+                b = buffers[0]
+                if len(b) <= sent:
+                    buffers.popleft()
+                    sent -= len(b)
+                else:
+                    buffers[0] = memoryview(b)[sent:]
+                    # The socket buffer is full
+                    return total
+        return total
+
+
+class _PipelineJob(object):
+    __slots__ = ("command", "checksum", "payload", "size", "message", "event", "done")
+
+    def __init__(self, command, checksum, payload, event=None):
+        self.command = command
+        self.checksum = checksum
+        self.payload = payload
+        self.size = len(payload)
+        # The deserialized message, None if it failed
+        self.message = None
+        # Or the deliver_event() to run in its place
+        self.event = event
+        self.done = event is not None
+
+
+# The messages of one connection in the pipeline, in the order received
+class _RecvQueue(object):
+    __slots__ = ("lock", "jobs", "undecoded", "scheduled", "size", "delivering", "paused")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = deque()
+        # The jobs no worker has picked up yet, and whether the connection
+        # is in the pipeline's ready queue for them
+        self.undecoded = deque()
+        self.scheduled = False
+        # Payload bytes queued
+        self.size = 0
+        # Set while a worker delivers this connection's messages
+        self.delivering = False
+        # Set while the connection doesn't read, because size got above
+        # the pipeline's max_pending
+        self.paused = False
+
+
+class ReceivePipeline(object):
+    """Checks and deserializes received messages on worker threads.
+
+    Set as the `pipeline` of a connection class, its network thread only
+    frames the messages it receives; the payloads are copied out of the
+    receive buffer and the checksums (hashlib releases the GIL) and
+    deserialization run on `workers` threads, so a large block doesn't hold
+    up the other connections:
+
+        class PipelinedNodeConn(NodeConn):
+            pipeline = ReceivePipeline(workers=4)
+
+    The workers take one message from each connection with messages to
+    decode in turn, so a connection sending a lot doesn't hold up the
+    others either.  Each connection's messages are still delivered in the
+    order they arrived, one at a time, by whichever worker finishes the
+    head of its queue; the messages of different connections are
+    delivered concurrently.  A connection stops reading while more than
+    max_pending bytes of its messages are queued, until half of them are
+    delivered.
+
+    The framing doesn't follow version changes of the messages in the
+    pipeline, so the peer must use checksums (version 209 and later).
+    """
+
+    def __init__(self, workers=None, max_pending=16 * 1024 * 1024):
+        self.max_pending = max_pending
+        # Connections with messages to decode
+        self.ready = deque()
+        self.cond = threading.Condition(threading.Lock())
+        self.closed = False
+        self.threads = []
+        if workers is None:
+            # As ThreadPoolExecutor: more than the cores, so a message
+            # doesn't wait while all of them decode large blocks
+            workers = min(32, (os.cpu_count() or 1) + 4)
+        for i in range(workers):
+            thread = Thread(target=self._work, name="ReceivePipeline-%d" % i, daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    # Stop the workers once the messages queued are delivered
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()
+
+    # Queue a message received on conn.  Returns True if conn should stop
+    # reading until the pipeline calls its _resume_reading().
+    def submit(self, conn, command, checksum, payload):
+        job = _PipelineJob(command, checksum, payload)
+        queue = conn.recv_queue
+        with queue.lock:
+            queue.jobs.append(job)
+            queue.undecoded.append(job)
+            queue.size += job.size
+            if queue.size > self.max_pending:
+                queue.paused = True
+            full = queue.paused
+            schedule = not queue.scheduled
+            queue.scheduled = True
+        if schedule:
+            with self.cond:
+                self.ready.append(conn)
+                self.cond.notify()
+        return full
+
+    # Queue deliver_event(conn, event) after conn's queued messages.
+    # Returns False (without queueing it) if there are none.
+    def submit_event(self, conn, event):
+        queue = conn.recv_queue
+        with queue.lock:
+            if not queue.jobs:
+                return False
+            queue.jobs.append(_PipelineJob(None, None, b"", event))
+        return True
+
+    def _work(self):
+        while True:
+            with self.cond:
+                while not self.ready:
+                    if self.closed:
+                        return
+                    self.cond.wait()
+                conn = self.ready.popleft()
+            queue = conn.recv_queue
+            with queue.lock:
+                job = queue.undecoded.popleft()
+                queue.scheduled = bool(queue.undecoded)
+            if queue.scheduled:
+                # Back of the line for its next message, which another
+                # worker may decode meanwhile
+                with self.cond:
+                    self.ready.append(conn)
+                    self.cond.notify()
+            self._decode(conn, job)
+
+    def _decode(self, conn, job):
+        try:
+            start = time.perf_counter_ns()
+            payload = job.payload
+            if job.checksum is not None and sha256(sha256(payload))[:4] != job.checksum:
+                raise ValueError("got bad checksum for %s message from %s:%d"
+                                 % (job.command, conn.dstaddr, conn.dstport))
+            message = conn.messagemap[job.command]()
+            message.deserialize(BytesReader(payload))
+            job.message = message
+            if conn.conn_metrics is not None:
+                conn.conn_metrics.parsed(job.command, time.perf_counter_ns() - start)
+        except Exception:
+            logger.exception("ERROR decoding %s message" % repr(job.command))
+        job.payload = None
+        self._deliver(conn, job)
+
+    # Deliver conn's messages from the head of its queue while they are
+    # decoded, unless another worker is at it already
+    def _deliver(self, conn, job):
+        queue = conn.recv_queue
+        with queue.lock:
+            job.done = True
+            if queue.delivering:
+                return
+            queue.delivering = True
         while True:
-            with mininode_lock:
-                if self.verack_received:
+            resume = False
+            with queue.lock:
+                jobs = queue.jobs
+                if not jobs or not jobs[0].done:
+                    queue.delivering = False
                     return
-            time.sleep(0.05)
-
-# The actual NodeConn class
-# This class provides an interface for a p2p connection to a specified node
-class NodeConn(asyncore.dispatcher):
+                job = jobs.popleft()
+                queue.size -= job.size
+                if queue.paused and queue.size <= self.max_pending // 2:
+                    queue.paused = False
+                    resume = True
+            if resume:
+                conn._resume_reading()
+            try:
+                if job.event is not None:
+                    conn.cb.deliver_event(conn, job.event)
+                elif job.message is not None:
+                    conn.got_message(job.message)
+            except Exception:
+                logger.exception("ERROR delivering %s" % repr(job.message))
+
+
+# The message framing and parsing shared by NodeConn and AsyncNodeConn.
+# Subclasses push framed messages in send_message() and receive into
+# self.recvbuf (a RecvBuffer of recv_buffer_size bytes) before calling
+# got_data().
+class NodeConnBase(object):
     messagemap = {
         b"version": msg_version,
         b"verack": msg_verack,
@@ -1611,21 +3308,36 @@ class NodeConn(asyncore.dispatcher):
         b"sendcmpct": msg_sendcmpct,
         b"cmpctblock": msg_cmpctblock,
         b"getblocktxn": msg_getblocktxn,
-        b"blocktxn": msg_blocktxn
+        b"blocktxn": msg_blocktxn,
+        b"getnSPV": msg_getnSPV,
+        b"nSPV": msg_nSPV,
     }
     MAGIC_BYTES = {
         "mainnet": b"\xf9\xbe\xb4\xd9",   # mainnet
         "testnet3": b"\x0b\x11\x09\x07",  # testnet3
         "regtest": b"\xfa\xbf\xb5\xda",   # regtest
     }
-
-    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True):
-        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+    # Initial receive buffer size; it grows as needed for larger messages
+    recv_buffer_size = 64 * 1024
+    # send_message() from the test thread waits while this many bytes are
+    # queued for the peer (None for no limit), until half of them are sent
+    send_buffer_limit = 32 * 1024 * 1024
+    # A ReceivePipeline to check and deserialize the messages received on
+    # worker threads, or None to do it on the network thread
+    pipeline = None
+    # A p2pcapture.CaptureWriter recording the messages sent and received,
+    # and the number the connection has in it (set on its first record)
+    capture = None
+    capture_number = None
+    # The p2pmetrics.MetricsRegistry the connections register with, None
+    # for no metrics
+    metrics = mininode_metrics
+
+    def _init_state(self, dstaddr, dstport, rpc, callback, net):
         self.dstaddr = dstaddr
         self.dstport = dstport
-        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.sendbuf = b""
-        self.recvbuf = b""
+        self.rpc = rpc
+        self.recvbuf = RecvBuffer(self.recv_buffer_size)
         self.ver_send = 209
         self.ver_recv = 209
         self.last_sent = 0
@@ -1634,136 +3346,129 @@ class NodeConn(asyncore.dispatcher):
         self.cb = callback
         self.disconnect = False
         self.nServices = 0
-
-        if send_version:
-            # stuff version msg into sendbuf
-            vt = msg_version()
-            vt.nServices = services
-            vt.addrTo.ip = self.dstaddr
-            vt.addrTo.port = self.dstport
-            vt.addrFrom.ip = "0.0.0.0"
-            vt.addrFrom.port = 0
-            self.send_message(vt, True)
-
-        logger.info('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
-
-        try:
-            self.connect((dstaddr, dstport))
-        except:
-            self.handle_close()
-        self.rpc = rpc
-
-    def handle_connect(self):
-        if self.state != "connected":
-            logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
-            self.state = "connected"
-            self.cb.on_open(self)
-
-    def handle_close(self):
-        logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
-        self.state = "closed"
-        self.recvbuf = b""
-        self.sendbuf = b""
-        try:
-            self.close()
-        except:
-            pass
-        self.cb.on_close(self)
-
-    def handle_read(self):
-        try:
-            t = self.recv(8192)
-            if len(t) > 0:
-                self.recvbuf += t
-                self.got_data()
-        except:
-            pass
-
-    def readable(self):
-        return True
-
-    def writable(self):
-        with mininode_lock:
-            pre_connection = self.state == "connecting"
-            length = len(self.sendbuf)
-        return (length > 0 or pre_connection)
-
-    def handle_write(self):
-        with mininode_lock:
-            # asyncore does not expose socket connection, only the first read/write
-            # event, thus we must check connection manually here to know when we
-            # actually connect
-            if self.state == "connecting":
-                self.handle_connect()
-            if not self.writable():
-                return
-
-            try:
-                sent = self.send(self.sendbuf)
-            except:
-                self.handle_close()
-                return
-            self.sendbuf = self.sendbuf[sent:]
+        # Messages waiting in the pipeline; recv_resumed is set when the
+        # connection may read again
+        self.recv_queue = _RecvQueue() if self.pipeline is not None else None
+        self.recv_resumed = False
+        self.conn_metrics = None
+        if self.metrics is not None:
+            self.conn_metrics = self.metrics.connection("%s:%s" % (dstaddr, dstport))
+
+    def _version_message(self, services):
+        vt = msg_version()
+        vt.nServices = services
+        vt.addrTo.ip = self.dstaddr
+        vt.addrTo.port = self.dstport
+        vt.addrFrom.ip = "0.0.0.0"
+        vt.addrFrom.port = 0
+        return vt
 
     def got_data(self):
+        rb = self.recvbuf
+        pipeline = self.pipeline
+        stats = self.conn_metrics
         try:
             while True:
-                if len(self.recvbuf) < 4:
+                buf = rb.buf
+                start = rb.start
+                avail = rb.end - start
+                if avail < 4:
                     return
-                if self.recvbuf[:4] != self.MAGIC_BYTES[self.network]:
-                    raise ValueError("got garbage %s" % repr(self.recvbuf))
+                if buf[start:start+4] != self.MAGIC_BYTES[self.network]:
+                    raise ValueError("got garbage %s" % repr(bytes(rb.peek())))
                 if self.ver_recv < 209:
-                    if len(self.recvbuf) < 4 + 12 + 4:
+                    if avail < 4 + 12 + 4:
                         return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
+                    command = buf[start+4:start+4+12].split(b"\x00", 1)[0]
+                    msglen = _int32.unpack_from(buf, start+4+12)[0]
                     checksum = None
-                    if len(self.recvbuf) < 4 + 12 + 4 + msglen:
+                    if avail < 4 + 12 + 4 + msglen:
+                        rb.reserve(4 + 12 + 4 + msglen)
                         return
-                    msg = self.recvbuf[4+12+4:4+12+4+msglen]
-                    self.recvbuf = self.recvbuf[4+12+4+msglen:]
+                    msg = rb.view[start+4+12+4:start+4+12+4+msglen]
+                    framelen = 4 + 12 + 4 + msglen
+                    if stats is not None:
+                        parse_start = time.perf_counter_ns()
+                elif pipeline is not None:
+                    # Frame only; the pipeline checks the checksum
+                    if avail < 4 + 12 + 4 + 4:
+                        return
+                    command = buf[start+4:start+4+12].split(b"\x00", 1)[0]
+                    msglen = _int32.unpack_from(buf, start+4+12)[0]
+                    checksum = buf[start+4+12+4:start+4+12+4+4]
+                    if avail < 4 + 12 + 4 + 4 + msglen:
+                        rb.reserve(4 + 12 + 4 + 4 + msglen)
+                        return
+                    msg = rb.view[start+4+12+4+4:start+4+12+4+4+msglen]
+                    framelen = 4 + 12 + 4 + 4 + msglen
                 else:
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4:
+                    if avail < 4 + 12 + 4 + 4:
                         return
-                    command = self.recvbuf[4:4+12].split(b"\x00", 1)[0]
-                    msglen = struct.unpack("<i", self.recvbuf[4+12:4+12+4])[0]
-                    checksum = self.recvbuf[4+12+4:4+12+4+4]
-                    if len(self.recvbuf) < 4 + 12 + 4 + 4 + msglen:
+                    command = buf[start+4:start+4+12].split(b"\x00", 1)[0]
+                    msglen = _int32.unpack_from(buf, start+4+12)[0]
+                    checksum = buf[start+4+12+4:start+4+12+4+4]
+                    if avail < 4 + 12 + 4 + 4 + msglen:
+                        rb.reserve(4 + 12 + 4 + 4 + msglen)
                         return
-                    msg = self.recvbuf[4+12+4+4:4+12+4+4+msglen]
+                    # Parse straight out of the receive buffer, no copy
+                    msg = rb.view[start+4+12+4+4:start+4+12+4+4+msglen]
+                    if stats is not None:
+                        parse_start = time.perf_counter_ns()
                     th = sha256(msg)
                     h = sha256(th)
                     if checksum != h[:4]:
-                        raise ValueError("got bad checksum " + repr(self.recvbuf))
-                    self.recvbuf = self.recvbuf[4+12+4+4+msglen:]
-                if command in self.messagemap:
-                    f = BytesIO(msg)
+                        raise ValueError("got bad checksum " + repr(bytes(rb.peek())))
+                    framelen = 4 + 12 + 4 + 4 + msglen
+                if self.capture is not None:
+                    self.capture.received(self, rb.view[start:start+framelen])
+                rb.consume(framelen)
+                rb.reserve(0)
+                command = bytes(command)
+                if command in self.messagemap and pipeline is not None:
+                    # The payload must outlive the receive buffer
+                    full = pipeline.submit(self, command, checksum, bytes(msg))
+                    if stats is not None:
+                        stats.received(command, framelen, queued=self.recv_queue.size)
+                    if full:
+                        self._pause_reading()
+                        return
+                elif command in self.messagemap:
+                    f = BytesReader(msg)
                     t = self.messagemap[command]()
                     t.deserialize(f)
+                    if stats is not None:
+                        stats.received(command, framelen, time.perf_counter_ns() - parse_start)
                     self.got_message(t)
                 else:
-                    logger.warning("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(msg)))
+                    if stats is not None:
+                        stats.received(command, framelen)
+                    logger.warning("Received unknown command from %s:%d: '%s' %s" % (self.dstaddr, self.dstport, command, repr(bytes(msg))))
         except Exception as e:
             logger.exception('got_data:', repr(e))
 
-    def send_message(self, message, pushbuf=False):
-        if self.state != "connected" and not pushbuf:
-            raise IOError('Not connected, no pushbuf')
+    # The message header and the payload of a message
+    def _frame_message(self, message):
         self._log_message("send", message)
         command = message.command
         data = message.serialize()
-        tmsg = self.MAGIC_BYTES[self.network]
-        tmsg += command
-        tmsg += b"\x00" * (12 - len(command))
-        tmsg += struct.pack("<I", len(data))
+        header = self.MAGIC_BYTES[self.network]
+        header += command
+        header += b"\x00" * (12 - len(command))
+        header += struct.pack("<I", len(data))
         if self.ver_send >= 209:
             th = sha256(data)
             h = sha256(th)
-            tmsg += h[:4]
-        tmsg += data
-        with mininode_lock:
-            self.sendbuf += tmsg
-            self.last_sent = time.time()
+            header += h[:4]
+        if self.capture is not None:
+            self.capture.sent(self, header, data)
+        if command == b"ping" and self.conn_metrics is not None:
+            nonce = getattr(message, "nonce", None)
+            if nonce is not None:
+                self.conn_metrics.ping_sent(nonce)
+        return header, data
+
+    def _build_message(self, message):
+        return b"".join(self._frame_message(message))
 
     def got_message(self, message):
         if message.command == b"version":
@@ -1771,6 +3476,8 @@ class NodeConn(asyncore.dispatcher):
                 self.messagemap[b'ping'] = msg_ping_prebip31
         if self.last_sent + 30 * 60 < time.time():
             self.send_message(self.messagemap[b'ping']())
+        if message.command == b"pong" and self.conn_metrics is not None:
+            self.conn_metrics.pong_received(message.nonce)
         self._log_message("receive", message)
         self.cb.deliver(self, message)
 
@@ -1787,21 +3494,459 @@ class NodeConn(asyncore.dispatcher):
     def disconnect_node(self):
         self.disconnect = True
 
+    # on_close(), after the messages still in the pipeline
+    def _deliver_close(self):
+        if self.conn_metrics is not None:
+            self.conn_metrics.close()
+        if self.recv_queue is None or not self.pipeline.submit_event(self, "close"):
+            self.cb.deliver_event(self, "close")
+
+# Parse messages of message_class.command on all connections.  They are
+# delivered to the NodeConnCB's on_<command> method, or to the handlers
+# given to its set_handler()/add_handler().
+def register_message(message_class):
+    NodeConnBase.messagemap[message_class.command] = message_class
+
+# The actual NodeConn class
+# This class provides an interface for a p2p connection to a specified node
+class NodeConn(NodeConnBase, asyncore.dispatcher if asyncore is not None else object):
+    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True):
+        asyncore.dispatcher.__init__(self, map=mininode_socket_map)
+        self._init_state(dstaddr, dstport, rpc, callback, net)
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sendbuf = SendQueue()
+        # Guards sendbuf; notified when it drains below send_buffer_limit / 2
+        self.send_drained = threading.Condition(threading.Lock())
+
+        if send_version:
+            # stuff version msg into sendbuf
+            self.send_message(self._version_message(services), True)
+
+        logger.info('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
+
+        try:
+            self.connect((dstaddr, dstport))
+        except:
+            self.handle_close()
+
+    def handle_connect(self):
+        if self.state != "connected":
+            logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
+            self.state = "connected"
+            self.cb.deliver_event(self, "open")
+
+    def handle_close(self):
+        logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
+        self.state = "closed"
+        self.recvbuf.clear()
+        with self.send_drained:
+            self.sendbuf.clear()
+            self.send_drained.notify_all()
+        try:
+            self.close()
+        except:
+            pass
+        self._deliver_close()
+
+    def handle_read(self):
+        try:
+            n = self.socket.recv_into(self.recvbuf.get_free())
+        except BlockingIOError:
+            return
+        except OSError:
+            self.handle_close()
+            return
+        if n == 0:
+            self.handle_close()
+            return
+        self.recvbuf.commit(n)
+        self.got_data()
+
+    def readable(self):
+        return self.recv_queue is None or not self.recv_queue.paused
+
+    # The pipeline is full: readable() is False until it resumes us
+    def _pause_reading(self):
+        pass
+
+    def _resume_reading(self):
+        self.recv_resumed = True
+        _wake_network_thread()
+
+    # On the network thread after _resume_reading(): frame the messages
+    # left in the receive buffer
+    def handle_resume(self):
+        self.recv_resumed = False
+        self.got_data()
+
+    # Called for every connection on every loop, so without taking the
+    # lock: at worst a message queued meanwhile waits for the next loop,
+    # which send_message() wakes up.
+    def writable(self):
+        return self.state == "connecting" or len(self.sendbuf) > 0
+
+    def handle_write(self):
+        # asyncore does not expose socket connection, only the first read/write
+        # event, thus we must check connection manually here to know when we
+        # actually connect
+        if self.state == "connecting":
+            self.handle_connect()
+        with self.send_drained:
+            if not self.sendbuf:
+                return
+            try:
+                self.sendbuf.flush(self.socket)
+                failed = False
+            except:
+                failed = True
+            limit = self.send_buffer_limit
+            if limit is not None and len(self.sendbuf) <= limit // 2:
+                self.send_drained.notify_all()
+        if failed:
+            self.handle_close()
+
+    def send_message(self, message, pushbuf=False):
+        if self.state != "connected" and not pushbuf:
+            raise IOError('Not connected, no pushbuf')
+        header, data = self._frame_message(message)
+        with self.send_drained:
+            limit = self.send_buffer_limit
+            if limit is not None and len(self.sendbuf) >= limit \
+                    and not isinstance(threading.current_thread(), NetworkThread):
+                # The network thread can't wait for itself to send
+                self.send_drained.wait_for(
+                    lambda: len(self.sendbuf) <= limit // 2 or self.state == "closed")
+            was_empty = not self.sendbuf
+            self.sendbuf.push(header, data)
+            self.last_sent = time.time()
+            queued = len(self.sendbuf)
+        if self.conn_metrics is not None:
+            self.conn_metrics.sent(message.command, len(header) + len(data), queued)
+        if was_empty:
+            _wake_network_thread()
+
+    def disconnect_node(self):
+        self.disconnect = True
+        _wake_network_thread()
+
+
+# Set while a NetworkThread runs
+_network_waker = None
+
+
+def _wake_network_thread():
+    waker = _network_waker
+    if waker is not None and not isinstance(threading.current_thread(), NetworkThread):
+        waker.wake()
+
+
+# Wakes up the NetworkThread's poll() when there's something new to send,
+# rather than leaving it asleep until the next 0.1s poll timeout
+class _NetworkWaker(asyncore.dispatcher if asyncore is not None else object):
+    def __init__(self):
+        self.reader, self.writer = socket.socketpair()
+        self.writer.setblocking(False)
+        self.disconnect = False
+        self.recv_resumed = False
+        asyncore.dispatcher.__init__(self, self.reader, map=mininode_socket_map)
+
+    def readable(self):
+        return True
+
+    def writable(self):
+        return False
+
+    def handle_read(self):
+        try:
+            self.reader.recv(4096)
+        except OSError:
+            pass
+
+    def wake(self):
+        try:
+            self.writer.send(b"\x00")
+        except OSError:
+            # Full, so the thread is awake anyway
+            pass
+
+    def close(self):
+        asyncore.dispatcher.close(self)
+        self.writer.close()
+
 
 class NetworkThread(Thread):
     def run(self):
-        while mininode_socket_map:
+        global _network_waker
+        waker = _network_waker = _NetworkWaker()
+        try:
+            self._loop()
+        finally:
+            _network_waker = None
+            waker.close()
+
+    def _loop(self):
+        # (the waker alone doesn't keep the thread running)
+        while len(mininode_socket_map) > 1:
             # We check for whether to disconnect outside of the asyncore
             # loop to workaround the behavior of asyncore when using
             # select
             disconnected = []
+            resumed = []
             for fd, obj in mininode_socket_map.items():
                 if obj.disconnect:
                     disconnected.append(obj)
+                elif obj.recv_resumed:
+                    resumed.append(obj)
             [ obj.handle_close() for obj in disconnected ]
+            [ obj.handle_resume() for obj in resumed ]
             asyncore.loop(0.1, use_poll=True, map=mininode_socket_map, count=1)
 
 
+_network_event_loop = None
+
+
+def network_event_loop():
+    """The event loop of the AsyncNodeConn connections, run by
+    AsyncNetworkThread."""
+    global _network_event_loop
+    if _network_event_loop is None:
+        _network_event_loop = asyncio.new_event_loop()
+    return _network_event_loop
+
+
+def _on_network_thread():
+    try:
+        return asyncio.get_running_loop() is _network_event_loop
+    except RuntimeError:
+        return False
+
+
+def _stop_if_idle():
+    if not async_connections and not async_servers:
+        _network_event_loop.stop()
+
+
+# NodeConn as an asyncio protocol.  Thousands of these can share the one
+# event loop of AsyncNetworkThread, where the NodeConnCB callbacks are
+# delivered (as with NodeConn).  Usage is the same as
+# NodeConn's:
+#
+#     conn = AsyncNodeConn('127.0.0.1', p2p_port(0), node, test_node)
+#     test_node.add_connection(conn)
+#     AsyncNetworkThread().start()
+#
+# send_message() and disconnect_node() may be called from any thread.
+class AsyncNodeConn(NodeConnBase, asyncio.BufferedProtocol):
+    # connect=False makes an inbound connection, for listen()
+    def __init__(self, dstaddr, dstport, rpc, callback, net="regtest", services=NODE_NETWORK, send_version=True, connect=True):
+        self._init_state(dstaddr, dstport, rpc, callback, net)
+        self.transport = None
+        self.inbound = not connect
+        self.services = services
+        self.send_version = send_version
+        # Frames pushed before the connection is made
+        self.sendbuf = []
+        # Frames sent from other threads, for the event loop to pick up,
+        # and their size in bytes.  send_message() waits on send_drained
+        # while the transport's buffer or the outbox is over
+        # send_buffer_limit.
+        self.outbox = []
+        self.queued = 0
+        self.drain_scheduled = False
+        self.write_paused = False
+        self.send_drained = threading.Condition()
+
+        if connect:
+            async_connections.add(self)
+            if send_version:
+                self.send_message(self._version_message(services), True)
+            logger.info('Connecting to Bitcoin Node: %s:%d' % (self.dstaddr, self.dstport))
+            network_event_loop().call_soon_threadsafe(self._connect)
+
+    def _connect(self):
+        coro = _network_event_loop.create_connection(lambda: self, self.dstaddr, self.dstport)
+        _network_event_loop.create_task(coro).add_done_callback(self._connect_done)
+
+    def _connect_done(self, task):
+        if task.cancelled() or task.exception() is not None:
+            logger.debug("Connection to %s:%d failed: %r" % (self.dstaddr, self.dstport, task.exception()))
+            self.connection_lost(None)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.send_buffer_limit is not None:
+            transport.set_write_buffer_limits(self.send_buffer_limit, self.send_buffer_limit // 2)
+        sock = transport.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.inbound:
+            async_connections.add(self)
+            self.dstaddr, self.dstport = transport.get_extra_info("peername")[:2]
+            if self.conn_metrics is not None:
+                self.conn_metrics.name = "%s:%s" % (self.dstaddr, self.dstport)
+            if self.send_version:
+                self.send_message(self._version_message(self.services), True)
+        logger.debug("Connected & Listening: %s:%d" % (self.dstaddr, self.dstport))
+        self.state = "connected"
+        if self.sendbuf:
+            transport.writelines(self.sendbuf)
+            self.sendbuf = []
+        if self.disconnect:
+            transport.abort()
+        self.cb.deliver_event(self, "open")
+
+    def connection_lost(self, exc):
+        if self.state == "closed":
+            return
+        logger.debug("Closing connection to: %s:%d" % (self.dstaddr, self.dstport))
+        self.state = "closed"
+        self.recvbuf.clear()
+        self.sendbuf = []
+        self.transport = None
+        with self.send_drained:
+            self.send_drained.notify_all()
+        async_connections.discard(self)
+        self._deliver_close()
+        _stop_if_idle()
+
+    def get_buffer(self, sizehint):
+        return self.recvbuf.get_free()
+
+    def buffer_updated(self, nbytes):
+        self.recvbuf.commit(nbytes)
+        self.got_data()
+
+    def _pause_reading(self):
+        self.transport.pause_reading()
+
+    def _resume_reading(self):
+        self.recv_resumed = True
+        network_event_loop().call_soon_threadsafe(self._resume)
+
+    def _resume(self):
+        self.recv_resumed = False
+        if self.transport is not None:
+            self.transport.resume_reading()
+            self.got_data()
+
+    def pause_writing(self):
+        with self.send_drained:
+            self.write_paused = True
+
+    def resume_writing(self):
+        with self.send_drained:
+            self.write_paused = False
+            self.send_drained.notify_all()
+
+    def send_message(self, message, pushbuf=False):
+        if self.state != "connected" and not pushbuf:
+            raise IOError('Not connected, no pushbuf')
+        header, data = self._frame_message(message)
+        self.last_sent = time.time()
+        stats = self.conn_metrics
+        if _on_network_thread():
+            self._write(header, data)
+            if stats is not None:
+                transport = self.transport
+                stats.sent(message.command, len(header) + len(data),
+                           transport.get_write_buffer_size() if transport is not None else None)
+            return
+        limit = self.send_buffer_limit
+        with self.send_drained:
+            if limit is not None:
+                self.send_drained.wait_for(
+                    lambda: self.state == "closed" or not self.write_paused and self.queued < limit)
+            self.outbox.append((header, data))
+            self.queued += len(header) + len(data)
+            queued = self.queued
+            schedule = not self.drain_scheduled
+            self.drain_scheduled = True
+        if stats is not None:
+            stats.sent(message.command, len(header) + len(data), queued)
+        # One wakeup of the event loop for everything sent until it runs
+        if schedule:
+            network_event_loop().call_soon_threadsafe(self._drain_outbox)
+
+    def _drain_outbox(self):
+        with self.send_drained:
+            frames = self.outbox
+            self.outbox = []
+            self.queued = 0
+            self.drain_scheduled = False
+            self.send_drained.notify_all()
+        for header, data in frames:
+            self._write(header, data)
+
+    # The transport sends header and data as they are (with sendmsg since
+    # python 3.12)
+    def _write(self, header, data):
+        if self.transport is not None:
+            self.transport.writelines((header, data))
+        elif self.state != "closed":
+            self.sendbuf.extend((header, data))
+
+    def disconnect_node(self):
+        self.disconnect = True
+        network_event_loop().call_soon_threadsafe(self._close)
+
+    # Drop whatever is still queued, like NodeConn.handle_close
+    def _close(self):
+        if self.transport is not None:
+            self.transport.abort()
+
+
+# Accept P2P connections on host:port, on the AsyncNetworkThread's loop.
+# callback_factory() returns the NodeConnCB of each incoming connection,
+# which sends its version message as soon as it is accepted.  Returns the
+# asyncio Server, which keeps the network thread running until
+# close_listener() is called.  conn_class may be an AsyncNodeConn subclass.
+def listen(host, port, callback_factory, net="regtest", services=NODE_NETWORK, backlog=4096,
+           conn_class=AsyncNodeConn):
+    if _on_network_thread():
+        raise RuntimeError("listen() must be called from outside the network thread")
+
+    def protocol_factory():
+        callback = callback_factory()
+        conn = conn_class(host, port, None, callback, net, services, connect=False)
+        callback.add_connection(conn)
+        return conn
+
+    loop = network_event_loop()
+    coro = loop.create_server(protocol_factory, host, port, backlog=backlog, reuse_address=True)
+    if loop.is_running():
+        server = asyncio.run_coroutine_threadsafe(coro, loop).result()
+    else:
+        server = loop.run_until_complete(coro)
+    async_servers.add(server)
+    return server
+
+
+def close_listener(server):
+    def close():
+        server.close()
+        async_servers.discard(server)
+        _stop_if_idle()
+    if network_event_loop().is_running():
+        _network_event_loop.call_soon_threadsafe(close)
+    else:
+        server.close()
+        async_servers.discard(server)
+
+
+class AsyncNetworkThread(Thread):
+    """Runs network_event_loop() until all AsyncNodeConns are closed and
+    all listeners are closed."""
+
+    def __init__(self):
+        super().__init__(name="AsyncNetworkThread", daemon=True)
+
+    def run(self):
+        loop = network_event_loop()
+        asyncio.set_event_loop(loop)
+        if async_connections or async_servers:
+            loop.run_forever()
+
+
 # An exception we can raise if we detect a potential disconnect
 # (p2p or rpc) before the test is complete
 class EarlyDisconnectError(Exception):
@@ -1810,3 +3955,8 @@ class EarlyDisconnectError(Exception):
 
     def __str__(self):
         return repr(self.value)
+
+
+if asyncore is None:
+    NodeConn = AsyncNodeConn
+    NetworkThread = AsyncNetworkThread
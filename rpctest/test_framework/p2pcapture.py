@@ -0,0 +1,298 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Capture and replay of raw P2P traffic.
+
+A CaptureWriter records the messages of NodeConn (or AsyncNodeConn)
+sessions as they were on the wire, with the time and direction of each:
+
+    capture = CaptureWriter("session.p2pcap")
+    conn = NodeConn('127.0.0.1', p2p_port(0), node, test_node)
+    conn.capture = capture          # or NodeConn.capture, for all of them
+    ...
+    capture.close()
+
+The capture then replays offline, with no node running: replay_into()
+feeds the received messages to a connection's got_data(), and
+CaptureServer pushes them over a socket to a client such as bitcoin-spv
+or nspv.  Both go as fast as possible or at the recorded pace.
+
+File format: the 8 bytes FILE_MAGIC, then one record per message:
+
+    uint64  timestamp, nanoseconds since the epoch
+    uint8   direction (RECEIVED or SENT)
+    uint32  connection number, in the order connections were first seen
+            (kept in the connection's capture_number)
+    uint32  frame length
+            the frame: message header and payload
+"""
+
+import mmap
+import socket
+import struct
+import threading
+import time
+from collections import namedtuple
+
+from .mininode import NodeConnBase
+
+FILE_MAGIC = b"P2PCAP\x00\x01"
+
+RECEIVED = 0
+SENT = 1
+
+_record_header = struct.Struct("<QBII")
+
+CaptureRecord = namedtuple("CaptureRecord", "timestamp direction conn frame")
+
+
+class CaptureWriter(object):
+    """Appends the frames sent and received by connections to a file.
+
+    Thread safe: connections call received() from the network thread and
+    sent() from whichever thread sends.  A connection takes its number on
+    its first record and keeps it in its capture_number attribute, so it
+    should be recorded by one writer only.
+    """
+
+    def __init__(self, path):
+        self.file = open(path, "wb")
+        self.file.write(FILE_MAGIC)
+        self.lock = threading.Lock()
+        # Connections numbered so far
+        self.conns = 0
+
+    def close(self):
+        with self.lock:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, direction, conn, *buffers, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time_ns()
+        size = sum(len(b) for b in buffers)
+        with self.lock:
+            number = getattr(conn, "capture_number", None)
+            if number is None:
+                number = conn.capture_number = self.conns
+                self.conns += 1
+            self.file.write(_record_header.pack(timestamp, direction, number, size))
+            for b in buffers:
+                self.file.write(b)
+
+    # The hooks of NodeConnBase.capture
+    def received(self, conn, frame):
+        self.write(RECEIVED, conn, frame)
+
+    def sent(self, conn, header, data):
+        self.write(SENT, conn, header, data)
+
+
+class CaptureReader(object):
+    """The records of a capture file, read through mmap.
+
+    Iterating yields CaptureRecords whose frame is a memoryview of the
+    mapping.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[:len(FILE_MAGIC)] != FILE_MAGIC:
+            self.map.close()
+            raise ValueError("%s is not a P2P capture" % path)
+        self.view = memoryview(self.map)
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Frames are still referenced; the mapping goes with them
+            pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def __iter__(self):
+        view = self.view
+        pos = len(FILE_MAGIC)
+        end = len(view)
+        while pos + _record_header.size <= end:
+            timestamp, direction, conn, size = _record_header.unpack_from(view, pos)
+            pos += _record_header.size
+            if pos + size > end:
+                raise ValueError("truncated capture record at offset %d" % (pos - _record_header.size))
+            yield CaptureRecord(timestamp, direction, conn, view[pos:pos + size])
+            pos += size
+
+    # The records of one direction, and of one connection unless conn is None
+    def select(self, direction=RECEIVED, conn=None):
+        return [r for r in self if r.direction == direction and (conn is None or r.conn == conn)]
+
+
+# Sleep until the time of a record at the recorded pace: pace 2 replays
+# twice as fast as recorded, None doesn't wait
+class _Pacer(object):
+    def __init__(self, pace):
+        self.pace = pace
+        self.first = None
+        self.start = None
+
+    def wait(self, record):
+        if self.pace is None:
+            return
+        if self.first is None:
+            self.first = record.timestamp
+            self.start = time.perf_counter()
+            return
+        delay = (record.timestamp - self.first) / 1e9 / self.pace - (time.perf_counter() - self.start)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ReplayConn(NodeConnBase):
+    """A connection without a socket, for replay_into().
+
+    Messages the callback sends are counted and dropped.
+    """
+
+    def __init__(self, callback, net="regtest"):
+        self._init_state("127.0.0.1", 0, None, callback, net)
+        self.state = "connected"
+        # got_message() sends a ping when nothing was sent for 30 minutes
+        self.last_sent = float('inf')
+        self.sent = 0
+
+    def send_message(self, message, pushbuf=False):
+        self._frame_message(message)
+        self.sent += 1
+
+
+# Feed the frames of records (CaptureRecords) to conn.got_data() through
+# its receive buffer, in reads of up to chunk bytes as from a socket.
+# Returns the number of bytes fed.
+def replay_into(conn, records, pace=None, chunk=64 * 1024):
+    if pace is None:
+        return _feed(conn, (record.frame for record in records), chunk)
+    pacer = _Pacer(pace)
+    total = 0
+    for record in records:
+        pacer.wait(record)
+        total += _feed(conn, (record.frame,), chunk)
+    return total
+
+
+# Copy frames into conn's receive buffer back to back, calling got_data()
+# each time the free space (up to chunk bytes) is filled
+def _feed(conn, frames, chunk):
+    rb = conn.recvbuf
+    total = 0
+    free = None
+    filled = 0
+    for frame in frames:
+        frame = memoryview(frame)
+        while len(frame):
+            if free is None:
+                free = rb.get_free()[:chunk]
+                filled = 0
+            n = min(len(free) - filled, len(frame))
+            free[filled:filled + n] = frame[:n]
+            filled += n
+            frame = frame[n:]
+            if filled == len(free):
+                rb.commit(filled)
+                total += filled
+                free = None
+                conn.got_data()
+    if free is not None and filled:
+        rb.commit(filled)
+        total += filled
+        conn.got_data()
+    return total
+
+
+class CaptureServer(threading.Thread):
+    """Serves the frames of a capture to the clients that connect.
+
+    Listens on host:port (port 0 picks one, see self.port) and sends each
+    of `connections` clients the frames of records, as fast as possible or
+    at the recorded pace, then waits for the client to hang up.  What
+    clients send is read and dropped.
+    """
+
+    # Frames are joined into writes of up to this many bytes when not
+    # pacing
+    WRITE_SIZE = 1024 * 1024
+
+    def __init__(self, records, host="127.0.0.1", port=0, pace=None, connections=1):
+        super().__init__(name="CaptureServer", daemon=True)
+        self.records = records
+        self.pace = pace
+        self.connections = connections
+        self.sock = socket.socket()
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(connections)
+        self.port = self.sock.getsockname()[1]
+        # (bytes sent, seconds) per client
+        self.results = []
+
+    def stop(self):
+        self.sock.close()
+
+    def run(self):
+        try:
+            for i in range(self.connections):
+                try:
+                    client, addr = self.sock.accept()
+                except OSError:
+                    return
+                with client:
+                    self._serve(client)
+        finally:
+            self.sock.close()
+
+    def _serve(self, client):
+        client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        drain = threading.Thread(target=_drain, args=(client,), daemon=True)
+        drain.start()
+        pacer = _Pacer(self.pace)
+        start = time.perf_counter()
+        total = 0
+        batch = []
+        size = 0
+        try:
+            for record in self.records:
+                pacer.wait(record)
+                batch.append(record.frame)
+                size += len(record.frame)
+                if self.pace is not None or size >= self.WRITE_SIZE:
+                    client.sendall(b"".join(batch))
+                    total += size
+                    batch = []
+                    size = 0
+            if batch:
+                client.sendall(b"".join(batch))
+                total += size
+        except OSError:
+            pass
+        self.results.append((total, time.perf_counter() - start))
+        drain.join()
+
+
+def _drain(sock):
+    try:
+        while sock.recv(65536):
+            pass
+    except OSError:
+        pass
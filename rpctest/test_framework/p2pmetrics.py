@@ -0,0 +1,386 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+"""Traffic counters and latency histograms of P2P connections.
+
+Every NodeConn and AsyncNodeConn registers a ConnMetrics with
+mininode.mininode_metrics (NodeConnBase.metrics, None to turn it off),
+which counts the messages and bytes sent and received per command, and
+keeps histograms of
+
+    parse     nanoseconds to check and deserialize a received message
+    deliver   nanoseconds in the NodeConnCB's handlers of the message, once
+              turned on with mininode_metrics.time_deliver() (timing it
+              costs a second lock acquisition per message)
+    ping      round trip time of ping/pong in nanoseconds
+    recv_queue, send_queue
+              bytes queued in the ReceivePipeline / to send, as each
+              message is queued
+
+The registry lists the connections open and the last MAX_CLOSED closed;
+the counts of older ones are only kept in its totals.  Any thread may read
+them while the connections run:
+
+    snapshot = mininode_metrics.snapshot()
+    for command, m in sorted(snapshot["commands"].items(),
+                             key=lambda item: -item[1]["parse"]["total"]):
+        ...
+    mininode_metrics.dump(os.path.join(tmpdir, "p2pmetrics.json"))
+
+Histograms are HDR-style: exact up to 2 * SUB_BUCKETS, then SUB_BUCKETS
+linear buckets per power of two (about 3% precision), so recording is a
+couple of integer operations and the buckets only grow with the log of the
+largest value.
+"""
+
+import json
+import threading
+import time
+from collections import deque
+
+# Linear buckets per power of two
+SUB_BUCKET_BITS = 5
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+
+# Most pings in flight followed per connection
+MAX_PINGS = 1000
+
+# Closed connections the registry keeps listing
+MAX_CLOSED = 100
+
+
+class Histogram(object):
+    """Counts of non-negative integer values in log-linear buckets.
+
+    Only the buckets are kept, so min, max and the percentiles are known to
+    within the precision of the buckets.
+    """
+    __slots__ = ("counts", "count", "total")
+
+    def __init__(self):
+        self.counts = []
+        self.count = 0
+        self.total = 0
+
+    def record(self, value):
+        if value < 2 * SUB_BUCKETS:
+            index = value if value > 0 else 0
+        else:
+            shift = value.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift << SUB_BUCKET_BITS) + (value >> shift)
+        counts = self.counts
+        if index >= len(counts):
+            counts.extend([0] * (index + 1 - len(counts)))
+        counts[index] += 1
+        self.count += 1
+        self.total += value
+
+    # Lowest and highest value of bucket index
+    @staticmethod
+    def bucket_range(index):
+        if index < 2 * SUB_BUCKETS:
+            return index, index
+        shift = (index >> SUB_BUCKET_BITS) - 1
+        low = (index - (shift << SUB_BUCKET_BITS)) << shift
+        return low, low + (1 << shift) - 1
+
+    def merge(self, other):
+        if len(other.counts) > len(self.counts):
+            self.counts.extend([0] * (len(other.counts) - len(self.counts)))
+        for index, n in enumerate(other.counts):
+            self.counts[index] += n
+        self.count += other.count
+        self.total += other.total
+
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    # Lowest value of the first non-empty bucket
+    def min(self):
+        for index, n in enumerate(self.counts):
+            if n:
+                return self.bucket_range(index)[0]
+        return None
+
+    # Highest value of the last non-empty bucket
+    def max(self):
+        return self.bucket_range(len(self.counts) - 1)[1] if self.count else None
+
+    # The value below which a fraction p of the values are: the middle of
+    # the bucket it falls in
+    def percentile(self, p):
+        if not self.count:
+            return None
+        rank = max(1, int(round(p * self.count)))
+        seen = 0
+        for index, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                low, high = self.bucket_range(index)
+                return (low + high) // 2
+        return self.max()
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "total": self.total,
+            "min": self.min(),
+            "max": self.max(),
+            "mean": self.mean(),
+            "p50": self.percentile(0.5),
+            "p90": self.percentile(0.9),
+            "p99": self.percentile(0.99),
+            "p999": self.percentile(0.999),
+            # [lowest value, count] of the non-empty buckets
+            "buckets": [[self.bucket_range(index)[0], n] for index, n in enumerate(self.counts) if n],
+        }
+
+    def __repr__(self):
+        return "Histogram(count=%i p50=%s p99=%s max=%s)" \
+            % (self.count, self.percentile(0.5), self.percentile(0.99), self.max())
+
+
+class CommandMetrics(object):
+    """The traffic of one command on a connection (or on all of them)."""
+    __slots__ = ("sent", "sent_bytes", "received", "received_bytes", "parse", "deliver")
+
+    def __init__(self):
+        self.sent = 0
+        self.sent_bytes = 0
+        self.received = 0
+        self.received_bytes = 0
+        self.parse = Histogram()
+        self.deliver = Histogram()
+
+    def merge(self, other):
+        self.sent += other.sent
+        self.sent_bytes += other.sent_bytes
+        self.received += other.received
+        self.received_bytes += other.received_bytes
+        self.parse.merge(other.parse)
+        self.deliver.merge(other.deliver)
+
+    def to_dict(self):
+        return {
+            "sent": self.sent,
+            "sent_bytes": self.sent_bytes,
+            "received": self.received,
+            "received_bytes": self.received_bytes,
+            "parse": self.parse.to_dict(),
+            "deliver": self.deliver.to_dict(),
+        }
+
+
+class ConnMetrics(object):
+    """The metrics of one connection.
+
+    The connection's threads update it under self.lock; snapshot() copies
+    it under the same lock.  Byte counts include the message headers.
+    """
+
+    def __init__(self, name, registry=None, deliver_times=False):
+        self.name = name
+        self.registry = registry
+        # Whether deliver histograms are recorded (see time_deliver())
+        self.deliver_times = deliver_times
+        self.closed = None
+        self.lock = threading.Lock()
+        self.reset()
+
+    # The connection is closed: tell the registry, once
+    def close(self):
+        with self.lock:
+            if self.closed is not None:
+                return
+            self.closed = time.time()
+        if self.registry is not None:
+            self.registry.connection_closed(self)
+
+    def reset(self):
+        with self.lock:
+            self.opened = time.time()
+            # command (bytes) -> CommandMetrics
+            self.commands = {}
+            self.ping = Histogram()
+            self.recv_queue = Histogram()
+            self.send_queue = Histogram()
+            # ping nonce -> time sent
+            self.pings = {}
+
+    def _command(self, command):
+        m = self.commands.get(command)
+        if m is None:
+            m = self.commands[command] = CommandMetrics()
+        return m
+
+    # These are called for every message, so they take the lock without
+    # a with statement, and do all there is to count at that point in one
+    # call.  queued: the bytes queued with it.
+
+    def sent(self, command, size, queued=None):
+        self.lock.acquire()
+        try:
+            m = self.commands.get(command) or self._command(command)
+            m.sent += 1
+            m.sent_bytes += size
+            if queued is not None:
+                self.send_queue.record(queued)
+        finally:
+            self.lock.release()
+
+    # parse: nanoseconds it took, if it was parsed already
+    def received(self, command, size, parse=None, queued=None):
+        self.lock.acquire()
+        try:
+            m = self.commands.get(command) or self._command(command)
+            m.received += 1
+            m.received_bytes += size
+            if parse is not None:
+                m.parse.record(parse)
+            if queued is not None:
+                self.recv_queue.record(queued)
+        finally:
+            self.lock.release()
+
+    def parsed(self, command, nanoseconds):
+        self.lock.acquire()
+        try:
+            (self.commands.get(command) or self._command(command)).parse.record(nanoseconds)
+        finally:
+            self.lock.release()
+
+    def delivered(self, command, nanoseconds):
+        self.lock.acquire()
+        try:
+            (self.commands.get(command) or self._command(command)).deliver.record(nanoseconds)
+        finally:
+            self.lock.release()
+
+    def ping_sent(self, nonce):
+        with self.lock:
+            if len(self.pings) >= MAX_PINGS:
+                # Forget the oldest, its pong isn't coming
+                del self.pings[next(iter(self.pings))]
+            self.pings[nonce] = time.perf_counter_ns()
+
+    def pong_received(self, nonce):
+        with self.lock:
+            sent = self.pings.pop(nonce, None)
+            if sent is not None:
+                self.ping.record(time.perf_counter_ns() - sent)
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "name": self.name,
+                "opened": self.opened,
+                "closed": self.closed,
+                "commands": dict((command.decode("ascii", "replace"), m.to_dict())
+                                 for command, m in self.commands.items()),
+                "ping": self.ping.to_dict(),
+                "recv_queue": self.recv_queue.to_dict(),
+                "send_queue": self.send_queue.to_dict(),
+            }
+
+    # Add this connection's per command counts into totals (command ->
+    # CommandMetrics), and its ping histogram into ping if given
+    def merge_into(self, totals, ping=None):
+        with self.lock:
+            for command, m in self.commands.items():
+                total = totals.get(command)
+                if total is None:
+                    total = totals[command] = CommandMetrics()
+                total.merge(m)
+            if ping is not None:
+                ping.merge(self.ping)
+
+
+class MetricsRegistry(object):
+    """The ConnMetrics of the connections of a run: the open ones and the
+    last MAX_CLOSED closed ones, and the totals of all of them."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.connections = []
+        self.deliver_times = False
+        self._reset_totals()
+
+    def _reset_totals(self):
+        self.started = time.time()
+        # The listed connections that are closed, oldest first
+        self.closed = deque()
+        # Per command counts and ping histogram of the closed connections
+        # no longer listed, and how many there were
+        self.dropped = {}
+        self.dropped_ping = Histogram()
+        self.dropped_connections = 0
+
+    def connection(self, name):
+        m = ConnMetrics(name, self, self.deliver_times)
+        with self.lock:
+            self.connections.append(m)
+        return m
+
+    # Record the deliver histograms of the connections (open and to come),
+    # or stop recording them
+    def time_deliver(self, enabled=True):
+        with self.lock:
+            self.deliver_times = enabled
+            for m in self.connections:
+                m.deliver_times = enabled
+
+    # Called by ConnMetrics.close()
+    def connection_closed(self, m):
+        with self.lock:
+            self.closed.append(m)
+            if len(self.closed) > MAX_CLOSED:
+                old = self.closed.popleft()
+                self.connections.remove(old)
+                old.merge_into(self.dropped, self.dropped_ping)
+                self.dropped_connections += 1
+
+    def reset(self):
+        with self.lock:
+            self.connections = [m for m in self.connections if m.closed is None]
+            connections = list(self.connections)
+            self._reset_totals()
+        for m in connections:
+            m.reset()
+
+    # Counts per command summed over all connections
+    def by_command(self):
+        totals = {}
+        with self.lock:
+            connections = list(self.connections)
+            for command, m in self.dropped.items():
+                totals[command] = CommandMetrics()
+                totals[command].merge(m)
+        for m in connections:
+            m.merge_into(totals)
+        return totals
+
+    def snapshot(self):
+        with self.lock:
+            connections = list(self.connections)
+            started = self.started
+            dropped = {
+                "connections": self.dropped_connections,
+                "ping": self.dropped_ping.to_dict(),
+            }
+        return {
+            "started": started,
+            "time": time.time(),
+            "commands": dict((command.decode("ascii", "replace"), m.to_dict())
+                             for command, m in self.by_command().items()),
+            "connections": [m.snapshot() for m in connections],
+            # The closed connections no longer listed
+            "dropped": dropped,
+        }
+
+    def to_json(self, indent=None):
+        return json.dumps(self.snapshot(), indent=indent, sort_keys=True)
+
+    def dump(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_json(indent=1))
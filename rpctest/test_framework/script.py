@@ -7,7 +7,7 @@
 This file is modified from python-bitcoinlib.
 """
 
-from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string
+from .mininode import CTransaction, CTxOut, sha256, hash256, uint256_from_str, ser_uint256, ser_string, SAPLING_BRANCH_ID, SPEND_DESCRIPTION_SIZE
 from binascii import hexlify
 import hashlib
 
@@ -937,3 +937,70 @@ def SegwitVersion1SignatureHash(script, txTo, inIdx, hashtype, amount):
     ss += struct.pack("<I", hashtype)
 
     return hash256(ss)
+
+def _blake2b_256(data, person):
+    return hashlib.blake2b(data, digest_size=32, person=person).digest()
+
+# ZIP 143 (Overwinter, v3) and ZIP 243 (Sapling, v4) signature hash, for
+# fOverwintered transactions.  inIdx None hashes for a shielded signature
+# (no transparent input), as in zcashd's NOT_AN_INPUT.
+def OverwinterSignatureHash(script, txTo, inIdx, hashtype, amount, consensus_branch_id=SAPLING_BRANCH_ID):
+    ZERO = b'\x00' * 32
+    sapling = txTo.nVersion >= 4
+
+    hashPrevouts = ZERO
+    hashSequence = ZERO
+    hashOutputs = ZERO
+    hashJoinSplits = ZERO
+    hashShieldedSpends = ZERO
+    hashShieldedOutputs = ZERO
+
+    if not (hashtype & SIGHASH_ANYONECANPAY):
+        serialize_prevouts = b''.join(i.prevout.serialize() for i in txTo.vin)
+        hashPrevouts = _blake2b_256(serialize_prevouts, b'ZcashPrevoutHash')
+
+    if (not (hashtype & SIGHASH_ANYONECANPAY) and (hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
+        serialize_sequence = b''.join(struct.pack("<I", i.nSequence) for i in txTo.vin)
+        hashSequence = _blake2b_256(serialize_sequence, b'ZcashSequencHash')
+
+    if ((hashtype & 0x1f) != SIGHASH_SINGLE and (hashtype & 0x1f) != SIGHASH_NONE):
+        serialize_outputs = b''.join(o.serialize() for o in txTo.vout)
+        hashOutputs = _blake2b_256(serialize_outputs, b'ZcashOutputsHash')
+    elif ((hashtype & 0x1f) == SIGHASH_SINGLE and inIdx is not None and inIdx < len(txTo.vout)):
+        serialize_outputs = txTo.vout[inIdx].serialize()
+        hashOutputs = _blake2b_256(serialize_outputs, b'ZcashOutputsHash')
+
+    if txTo.vJoinSplit:
+        serialize_joinsplits = b''.join(txTo.vJoinSplit) + txTo.joinSplitPubKey
+        hashJoinSplits = _blake2b_256(serialize_joinsplits, b'ZcashJSplitsHash')
+
+    if sapling and txTo.vShieldedSpend:
+        # Everything but spendAuthSig, the last 64 bytes
+        serialize_spends = b''.join(spend[:SPEND_DESCRIPTION_SIZE - 64] for spend in txTo.vShieldedSpend)
+        hashShieldedSpends = _blake2b_256(serialize_spends, b'ZcashSSpendsHash')
+
+    if sapling and txTo.vShieldedOutput:
+        hashShieldedOutputs = _blake2b_256(b''.join(txTo.vShieldedOutput), b'ZcashSOutputHash')
+
+    ss = bytes()
+    ss += struct.pack("<I", txTo.nVersion | 0x80000000)
+    ss += struct.pack("<I", txTo.nVersionGroupId)
+    ss += hashPrevouts
+    ss += hashSequence
+    ss += hashOutputs
+    ss += hashJoinSplits
+    if sapling:
+        ss += hashShieldedSpends
+        ss += hashShieldedOutputs
+    ss += struct.pack("<I", txTo.nLockTime)
+    ss += struct.pack("<I", txTo.nExpiryHeight)
+    if sapling:
+        ss += struct.pack("<q", txTo.valueBalance)
+    ss += struct.pack("<I", hashtype)
+    if inIdx is not None:
+        ss += txTo.vin[inIdx].prevout.serialize()
+        ss += ser_string(script)
+        ss += struct.pack("<q", amount)
+        ss += struct.pack("<I", txTo.vin[inIdx].nSequence)
+
+    return _blake2b_256(ss, b'ZcashSigHash' + struct.pack("<I", consensus_branch_id))
@@ -27,6 +27,7 @@ from .util import (
     PortSeed,
 )
 from .authproxy import JSONRPCException
+from .mininode import mininode_metrics
 
 class BitcoinTestFramework(object):
 
@@ -124,6 +125,8 @@ class BitcoinTestFramework(object):
                           help="The seed to use for assigning port numbers (default: current process id)")
         parser.add_option("--coveragedir", dest="coveragedir",
                           help="Write tested RPC commands into this directory")
+        parser.add_option("--p2pmetrics", dest="p2pmetrics",
+                          help="Write the traffic metrics of the P2P connections, deliver times included, to this JSON file")
         self.add_options(parser)
         (self.options, self.args) = parser.parse_args()
 
@@ -133,6 +136,9 @@ class BitcoinTestFramework(object):
         if self.options.coveragedir:
             enable_coverage(self.options.coveragedir)
 
+        if self.options.p2pmetrics:
+            mininode_metrics.time_deliver()
+
         PortSeed.n = self.options.port_seed
 
         os.environ['PATH'] = self.options.srcdir+":"+self.options.srcdir+"/qt:"+os.environ['PATH']
@@ -161,6 +167,9 @@ class BitcoinTestFramework(object):
         except KeyboardInterrupt as e:
             self.log.warning("Exiting after keyboard interrupt")
 
+        if self.options.p2pmetrics:
+            mininode_metrics.dump(self.options.p2pmetrics)
+
         if not self.options.noshutdown:
             self.log.info("Stopping nodes")
             stop_nodes(self.nodes)
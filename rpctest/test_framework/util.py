@@ -272,17 +272,22 @@ def initialize_chain(test_dir, num_nodes, cachedir):
         # initialize_chain, only 4 nodes will generate coins.
         #
         # blocks are created with timestamps 10 minutes apart
-        # starting from 2010 minutes in the past
+        # starting from 2010 minutes in the past.  They are built offline
+        # as a chain fixture, with the coinbases paying to a key of each
+        # node's wallet in turn, and submitted to node 0 instead of mined
+        # one generate() round trip at a time.
+        from .chainfixture import generate_chain
         enable_mocktime()
-        block_time = get_mocktime() - (201 * 10 * 60)
-        for i in range(2):
-            for peer in range(4):
-                for j in range(25):
-                    set_node_times(rpcs, block_time)
-                    rpcs[peer].generate(1)
-                    block_time += 10*60
-                # Must sync before next peer starts generating blocks
-                sync_blocks(rpcs)
+        pubkeys = [hex_str_to_bytes(rpc.validateaddress(rpc.getnewaddress())["pubkey"])
+                   for rpc in rpcs[:4]]
+        fixture_path = os.path.join(cachedir, "chain-200.fixture")
+        fixture = generate_chain(fixture_path, 200, start_time=get_mocktime() - (202 * 10 * 60),
+                                 spend=False, pubkey_of=lambda height: pubkeys[(height - 1) // 25 % 4])
+        set_node_times(rpcs, fixture.header(200).nTime)
+        fixture.submit(rpcs[0])
+        fixture.close()
+        os.remove(fixture_path)
+        sync_blocks(rpcs)
 
         # Shut them down, and clean up cache directories:
         stop_nodes(rpcs)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import NodeConnCB, msg_inv, msg_pong
+
+"""
+   Offline checks of the handler table of NodeConnCB: on_* methods, handlers
+   added with set_handler()/add_handler(), and on_* methods monkeypatched
+   on an instance.
+   To run: "python3 -m pytest test_handlers.py" from rpctest directory
+"""
+
+
+class Recorder(NodeConnCB):
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+
+    def on_inv(self, conn, message):
+        self.calls.append("on_inv")
+
+
+def test_class_handler():
+    callback = Recorder()
+    callback.deliver(None, msg_inv())
+    assert callback.calls == ["on_inv"]
+
+
+def test_instance_override():
+    callback = Recorder()
+    callback.on_inv = lambda conn, message: callback.calls.append("patched")
+    callback.deliver(None, msg_inv())
+    assert callback.calls == ["patched"]
+    # Deleting it brings the method back
+    del callback.on_inv
+    callback.deliver(None, msg_inv())
+    assert callback.calls == ["patched", "on_inv"]
+
+
+def test_override_in_fan_out():
+    callback = Recorder()
+    callback.add_handler(b"inv", lambda conn, message: callback.calls.append("added"))
+    callback.on_inv = lambda conn, message: callback.calls.append("patched")
+    callback.deliver(None, msg_inv())
+    assert callback.calls == ["patched", "added"]
+
+
+def test_set_handler_stays():
+    callback = Recorder()
+    callback.set_handler(b"pong", lambda conn, message: callback.calls.append("set"))
+    callback.on_pong = lambda conn, message: callback.calls.append("patched")
+    callback.deliver(None, msg_pong())
+    assert callback.calls == ["set"]
+
+
+def test_override_before_init():
+    class Early(Recorder):
+        def __init__(self):
+            self.on_inv = lambda conn, message: self.calls.append("early")
+            super().__init__()
+
+    callback = Early()
+    callback.deliver(None, msg_inv())
+    assert callback.calls == ["early"]
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import Hash256, ser_uint256, uint256_from_str
+
+"""
+   Offline checks that Hash256 stands in for the int hashes: equal values
+   compare and hash alike, so dicts and sets keyed by either still work.
+   To run: "python3 -m pytest test_hash256.py" from rpctest directory
+"""
+
+VALUE = 0x07346a1c0f98bb5ab3a6c3a5f1e0b7d2c4e9f8a7b6c5d4e3f2a1b0c9d8e7f6a5
+
+
+def test_int_equivalence():
+    h = Hash256.from_int(VALUE)
+    assert h == VALUE and VALUE == h
+    assert hash(h) == hash(VALUE)
+    assert {VALUE: 1}[h] == 1 and {h: 1}[VALUE] == 1
+    assert len({h, VALUE}) == 1
+    assert Hash256(VALUE) == h and int(h) == VALUE
+    assert Hash256.from_hex(h.to_hex()) == h
+    assert "%064x" % h == "%064x" % VALUE
+
+
+def test_not_equal_to_bytes():
+    # Plain bytes hash differently from the int, so they never compare equal
+    h = Hash256.from_int(VALUE)
+    raw = bytes(h)
+    assert h != raw and raw != h
+    assert not (h == raw or raw == h)
+    assert len({h, raw}) == 2
+    assert Hash256(raw) == h
+    assert uint256_from_str(ser_uint256(h)) == h
+
+
+def test_ordering():
+    low, high = Hash256.from_int(1), Hash256.from_int(1 << 255)
+    assert low < high and high > 1 and low <= 1 and high >= low
+    assert sorted([high, 5, low]) == [low, 5, high]
+    assert not Hash256() and Hash256.from_int(1)
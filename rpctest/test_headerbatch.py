@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+
+import pytest
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework import headerbatch
+from test_framework.blockstore import block_proof
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.headerbatch import HeaderBatch
+from test_framework.mininode import CBlockHeader, msg_headers
+
+"""
+   Offline checks of the proof of work test of HeaderBatch against nBits
+   values CheckProofOfWork() rejects, with numpy and without.
+   To run: "python3 -m pytest test_headerbatch.py" from rpctest directory
+"""
+
+REGTEST_BITS = 0x207fffff
+
+# Targets above the regtest one, met by a header solved for it
+VALID_BITS = [REGTEST_BITS, 0x2100ffff, 0x21008000]
+
+INVALID_BITS = [
+    0x20800000,     # only the sign bit in the mantissa: zero target
+    0x20800001,     # negative
+    0x21800000,
+    0x00000000,     # zero
+    0x01003456,     # mantissa shifted out: zero
+    0x217fffff,     # overflows 256 bits
+    0x22010000,
+    0x2300ff00,
+]
+
+
+# Three regtest headers, then one with nBits (its hash meets the regtest
+# target)
+def make_batch(nBits):
+    headers = []
+    prev = 0
+    for i in range(4):
+        block = create_block(prev, create_coinbase(i + 1), 1500000000 + i * 600)
+        block.nBits = REGTEST_BITS
+        block.solve()
+        if i == 3:
+            block.nBits = nBits
+            block.rehash()
+        headers.append(CBlockHeader(block))
+        prev = block.sha256
+    message = msg_headers()
+    message.headers = headers
+    return HeaderBatch.from_headers_payload(message.serialize())
+
+
+@pytest.fixture(params=["numpy", "python"])
+def check_path(request, monkeypatch):
+    if request.param == "numpy":
+        if headerbatch.numpy is None:
+            pytest.skip("numpy is not installed")
+    else:
+        monkeypatch.setattr(headerbatch, "numpy", None)
+    return request.param
+
+
+@pytest.mark.parametrize("nBits", VALID_BITS)
+def test_valid_bits(check_path, nBits):
+    assert block_proof(nBits) > 0
+    assert make_batch(nBits).first_invalid() is None
+
+
+@pytest.mark.parametrize("nBits", INVALID_BITS)
+def test_invalid_bits(check_path, nBits):
+    # block_proof() is zero for the targets bitcoind rejects
+    assert block_proof(nBits) == 0
+    assert make_batch(nBits).first_invalid() == (3, "high-hash")
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import random
+import sys
+
+import pytest
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.blocktools import create_block, create_coinbase
+from test_framework.merkle import CMerkleBlock, MerkleTree, PartialMerkleTree, verify_branch
+from test_framework.mininode import BytesReader, COutPoint, CTransaction, CTxIn, CTxOut, ser_uint256
+
+"""
+   Offline checks of the merkle module against CBlock.calc_merkle_root:
+   roots, branches, and partial merkle trees through serialization.
+   To run: "python3 -m pytest test_merkle.py" from rpctest directory
+"""
+
+# Odd and even counts, powers of two and one past them
+SIZES = [1, 2, 3, 4, 5, 7, 8, 9, 16, 17, 33]
+
+
+def make_block(num_txs, seed=1):
+    rng = random.Random(seed)
+    block = create_block(rng.getrandbits(256), create_coinbase(1), 1500000000)
+    for i in range(num_txs - 1):
+        tx = CTransaction()
+        tx.vin.append(CTxIn(COutPoint(rng.getrandbits(256), 0), b"\x51", 0xffffffff))
+        tx.vout.append(CTxOut(rng.randrange(1, 10**8), b"\x51"))
+        block.vtx.append(tx)
+    block.hashMerkleRoot = block.calc_merkle_root()
+    block.rehash()
+    return block
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_root(size):
+    block = make_block(size)
+    assert MerkleTree.from_block(block).calc_merkle_root() == block.hashMerkleRoot
+    # Built one leaf at a time
+    tree = MerkleTree()
+    for tx in block.vtx:
+        tree.append(ser_uint256(tx.sha256))
+    assert tree.calc_merkle_root() == block.hashMerkleRoot
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_branches(size):
+    block = make_block(size)
+    tree = MerkleTree.from_block(block)
+    for index, tx in enumerate(block.vtx):
+        leaf = ser_uint256(tx.sha256)
+        branch = tree.get_branch(index)
+        assert len(branch) == tree.height()
+        assert verify_branch(leaf, branch, index, block.hashMerkleRoot)
+        assert not verify_branch(bytes(32), branch, index, block.hashMerkleRoot)
+
+
+@pytest.mark.parametrize("size", SIZES)
+def test_partial_tree_round_trip(size):
+    block = make_block(size)
+    tree = MerkleTree.from_block(block)
+    rng = random.Random(size)
+    for matches in ([], [0], [size - 1], sorted(rng.sample(range(size), (size + 1) // 2)), list(range(size))):
+        partial = PartialMerkleTree.from_tree(tree, matches)
+        parsed = PartialMerkleTree()
+        parsed.deserialize(BytesReader(partial.serialize()))
+        root, hashes, indexes = parsed.extract_matches()
+        assert int.from_bytes(root, "little") == block.hashMerkleRoot
+        assert indexes == matches
+        assert hashes == [ser_uint256(block.vtx[i].sha256) for i in matches]
+
+
+def test_merkle_block():
+    block = make_block(9)
+    txids = [block.vtx[2].sha256, block.vtx[8].sha256]
+    merkle_block = CMerkleBlock.from_block(block, txids)
+    parsed = CMerkleBlock()
+    parsed.deserialize(BytesReader(merkle_block.serialize()))
+    parsed.header.calc_sha256()
+    assert parsed.header.sha256 == block.sha256
+    assert parsed.get_matched_txids() == txids
+    # A proof against another merkle root doesn't verify
+    parsed.header.hashMerkleRoot ^= 1
+    assert parsed.get_matched_txids() is None
+
+
+def test_malformed_partial_tree():
+    partial = PartialMerkleTree.from_tree(MerkleTree.from_block(make_block(5)), [3])
+    truncated = PartialMerkleTree()
+    truncated.nTransactions = partial.nTransactions
+    truncated.vHash = partial.vHash[:-1]
+    truncated.vBits = partial.vBits
+    assert truncated.extract_matches() is None
+    extra = PartialMerkleTree()
+    extra.nTransactions = partial.nTransactions
+    extra.vHash = partial.vHash + [bytes(32)]
+    extra.vBits = partial.vBits
+    assert extra.extract_matches() is None
@@ -0,0 +1,141 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+import threading
+import time
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import NodeConnCB, mininode_lock, msg_ping, wait_until
+
+"""
+   Offline checks of mininode_lock: deliveries only take their NodeConnCB's
+   lock, holding mininode_lock stops them on every connection, and handlers
+   taking mininode_lock at the same time are served in turn.
+   To run: "python3 -m pytest test_mininode_lock.py" from rpctest directory
+"""
+
+
+def deliver_in_thread(callback, nonce=1):
+    thread = threading.Thread(target=callback.deliver, args=(None, msg_ping(nonce)), daemon=True)
+    thread.start()
+    return thread
+
+
+def recording_callback():
+    callback = NodeConnCB()
+    callback.pings = []
+    callback.set_handler(b"ping", lambda conn, message: callback.pings.append(message.nonce))
+    return callback
+
+
+def test_delivery_skips_the_global_lock():
+    callback = recording_callback()
+    # Nothing waits on mininode_lock, so its internal mutex isn't touched
+    with mininode_lock._mutex:
+        thread = deliver_in_thread(callback)
+        thread.join(3)
+        assert not thread.is_alive()
+    assert callback.pings == [1]
+
+
+def test_exclusive_blocks_deliveries():
+    callbacks = [recording_callback() for _ in range(3)]
+    with mininode_lock:
+        threads = [deliver_in_thread(callback) for callback in callbacks]
+        time.sleep(0.2)
+        assert not any(callback.pings for callback in callbacks)
+    for thread in threads:
+        thread.join(3)
+    assert all(callback.pings == [1] for callback in callbacks)
+
+
+def test_waits_for_deliveries_in_progress():
+    callback = NodeConnCB()
+    entered = threading.Event()
+    release = threading.Event()
+
+    def slow(conn, message):
+        entered.set()
+        release.wait()
+    callback.set_handler(b"ping", slow)
+    thread = deliver_in_thread(callback)
+    entered.wait()
+    assert not mininode_lock.acquire(blocking=False)
+    assert not mininode_lock.acquire(timeout=0.1)
+    threading.Timer(0.2, release.set).start()
+    start = time.monotonic()
+    assert mininode_lock.acquire(timeout=3)
+    assert time.monotonic() - start < 2
+    mininode_lock.release()
+    thread.join(3)
+    # Free again after the failed attempts
+    assert mininode_lock.acquire(blocking=False)
+    mininode_lock.release()
+
+
+def test_handlers_take_it_in_turn():
+    # Two handlers on different connections using the old "with
+    # mininode_lock" idiom at once: neither raises nor deadlocks, and they
+    # don't overlap
+    barrier = threading.Barrier(2)
+    inside = []
+    overlaps = []
+    errors = []
+
+    def handler(conn, message):
+        try:
+            barrier.wait(3)
+            with mininode_lock:
+                inside.append(message.nonce)
+                overlaps.append(len(inside))
+                time.sleep(0.05)
+                inside.remove(message.nonce)
+        except Exception as e:
+            errors.append(e)
+    callbacks = [NodeConnCB() for _ in range(2)]
+    for callback in callbacks:
+        callback.set_handler(b"ping", handler)
+    threads = [deliver_in_thread(callback, nonce) for nonce, callback in enumerate(callbacks)]
+    for thread in threads:
+        thread.join(5)
+        assert not thread.is_alive()
+    assert not errors
+    assert overlaps == [1, 1]
+
+
+def test_handler_reads_other_connections():
+    # A handler holding mininode_lock excludes the test thread reading
+    # through another connection's lock until it is done
+    first, second = recording_callback(), NodeConnCB()
+    entered = threading.Event()
+    release = threading.Event()
+
+    def handler(conn, message):
+        with mininode_lock:
+            entered.set()
+            release.wait()
+    second.set_handler(b"ping", handler)
+    thread = deliver_in_thread(second)
+    entered.wait()
+    assert not first.lock.acquire(timeout=0.1)
+    release.set()
+    thread.join(3)
+    with first.lock:
+        pass
+
+
+def test_wait_wakes_on_delivery():
+    callback = recording_callback()
+    threading.Timer(0.2, lambda: callback.deliver(None, msg_ping(2))).start()
+    start = time.monotonic()
+    assert wait_until(lambda: callback.pings == [2], timeout=5)
+    assert time.monotonic() - start < 2
+    with mininode_lock:
+        assert not mininode_lock.wait(0.05)
+    assert callback.waiting == 0
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import random
+import sys
+import threading
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import (
+    CBlockHeader,
+    NodeConnBase,
+    ReceivePipeline,
+    _RecvQueue,
+    msg_headers,
+    msg_ping,
+    sha256,
+)
+
+"""
+   Offline checks of ReceivePipeline: each connection's messages and
+   events are delivered in the order received, whatever order the
+   workers decode them in.
+   To run: "python3 -m pytest test_pipeline.py" from rpctest directory
+"""
+
+
+# Stands in for a NodeConn: records what the pipeline delivers to it
+class FakeConn(object):
+    messagemap = NodeConnBase.messagemap
+    dstaddr = "127.0.0.1"
+    dstport = 0
+    conn_metrics = None
+
+    def __init__(self):
+        self.recv_queue = _RecvQueue()
+        self.cb = self
+        self.delivered = []
+        self.resumed = 0
+        self.done = threading.Event()
+
+    def got_message(self, message):
+        self.delivered.append(message)
+
+    def deliver_event(self, conn, event):
+        self.delivered.append(event)
+        self.done.set()
+
+    def _resume_reading(self):
+        self.resumed += 1
+
+
+# As NodeConnBase._deliver_close(): on_close() after the messages queued
+def close(pipeline, conn):
+    if not pipeline.submit_event(conn, "close"):
+        conn.deliver_event(conn, "close")
+    assert conn.done.wait(30)
+
+
+def submit(pipeline, conn, message, checksum=None):
+    payload = message.serialize()
+    if checksum is None:
+        checksum = sha256(sha256(payload))[:4]
+    return pipeline.submit(conn, message.command, checksum, payload)
+
+
+def big_headers(count):
+    message = msg_headers()
+    message.headers = [CBlockHeader() for _ in range(count)]
+    return message
+
+
+def test_order_per_connection():
+    pipeline = ReceivePipeline(workers=4)
+    rng = random.Random(1)
+    conns = [FakeConn() for _ in range(3)]
+    sent = dict((conn, []) for conn in conns)
+    try:
+        for i in range(300):
+            conn = rng.choice(conns)
+            # Large messages take longer to decode than the pings after them
+            message = big_headers(rng.randrange(200, 2000)) if i % 7 == 0 else msg_ping(i)
+            sent[conn].append(message)
+            submit(pipeline, conn, message)
+        for conn in conns:
+            close(pipeline, conn)
+    finally:
+        pipeline.close()
+    for conn in conns:
+        assert conn.delivered[-1] == "close"
+        received = conn.delivered[:-1]
+        assert len(received) == len(sent[conn])
+        for message, expected in zip(received, sent[conn]):
+            assert message.command == expected.command
+            assert message.serialize() == expected.serialize()
+
+
+def test_bad_checksum_skipped():
+    pipeline = ReceivePipeline(workers=2)
+    conn = FakeConn()
+    try:
+        submit(pipeline, conn, msg_ping(1))
+        submit(pipeline, conn, msg_ping(2), checksum=b"\0\0\0\0")
+        submit(pipeline, conn, msg_ping(3))
+        close(pipeline, conn)
+    finally:
+        pipeline.close()
+    assert [message.nonce for message in conn.delivered[:-1]] == [1, 3]
+
+
+def test_event_without_messages():
+    pipeline = ReceivePipeline(workers=1)
+    try:
+        # Nothing queued: the caller delivers the event itself
+        assert not pipeline.submit_event(FakeConn(), "close")
+    finally:
+        pipeline.close()
+
+
+def test_pause_and_resume():
+    message = big_headers(1000)
+    size = len(message.serialize())
+    pipeline = ReceivePipeline(workers=1, max_pending=2 * size)
+    conn = FakeConn()
+    # Hold up delivery so the messages pile up
+    blocker = threading.Lock()
+    got_message = conn.got_message
+
+    def slow_got_message(message):
+        with blocker:
+            got_message(message)
+    conn.got_message = slow_got_message
+    try:
+        with blocker:
+            full = [submit(pipeline, conn, message) for _ in range(4)]
+            assert full[-1] and not full[0]
+        close(pipeline, conn)
+    finally:
+        pipeline.close()
+    assert conn.resumed == 1
+    assert len(conn.delivered) == 5
+    assert not conn.recv_queue.paused and conn.recv_queue.size == 0
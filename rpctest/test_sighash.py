@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import os
+import sys
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.key import CECKey
+from test_framework.mininode import (
+    OVERWINTER_BRANCH_ID,
+    SAPLING_BRANCH_ID,
+    SAPLING_VERSION_GROUP_ID,
+    CTransaction,
+    FromHex,
+)
+from test_framework.script import (
+    OP_CHECKSIG,
+    SIGHASH_ALL,
+    SIGHASH_ANYONECANPAY,
+    SIGHASH_NONE,
+    SIGHASH_SINGLE,
+    CScript,
+    OverwinterSignatureHash,
+)
+
+"""
+   Offline checks of the ZIP 243 (Sapling) signature hash.
+   To run: "python3 -m pytest test_sighash.py" from rpctest directory
+"""
+
+# A Sapling transaction signed by nSPV on a Komodo asset chain, from the
+# log in src/tools/nSPV_htmlgui.h.  Its input spends 140856.3435 coins
+# paid to the P2PK script of PUBKEY (the change goes back to it).
+SIGNED_TX = (
+    "0400008085202f8901f6d0399ba893030b98b208b30c80a570a81bbb90a935d4b4f5981149b20b"
+    "aef50100000048473044022055857a361c31f99b1bacb518597aee57e37b430f537d158ad21888"
+    "a0330700ea02204734f66d49472319534001f187f402993d6bb80398aefc92d90893204ec23ea3"
+    "01ffffffff0200e1f505000000001976a914bed47f9cda72a1bf743257617d7a5a1b2a68216688"
+    "aca053458bcf0c000023210286de5bd7831baacc55b87cdf14a1938b2f2ab905529c739c82709c"
+    "2993cfeafcac00000000000000000000000000000000000000")
+SIGNED_TXID = "aa19764684e3c6dda23de3a4989d16d6568b41d87777dce2fca18e8548f57633"
+PUBKEY = bytes.fromhex("0286de5bd7831baacc55b87cdf14a1938b2f2ab905529c739c82709c2993cfeafc")
+AMOUNT = 14085634350000
+
+
+def signed_tx():
+    return FromHex(CTransaction(), SIGNED_TX)
+
+
+def signature_of(tx):
+    # scriptSig is <signature + hashtype>
+    script_sig = tx.vin[0].scriptSig
+    return script_sig[1:1 + script_sig[0]]
+
+
+def verify(sighash, signature):
+    key = CECKey()
+    key.set_pubkey(PUBKEY)
+    return key.verify(sighash, signature)
+
+
+def test_parse_signed_tx():
+    tx = signed_tx()
+    assert tx.fOverwintered and tx.nVersion == 4 and tx.nVersionGroupId == SAPLING_VERSION_GROUP_ID
+    assert tx.hash == SIGNED_TXID
+    assert tx.serialize().hex() == SIGNED_TX
+
+
+def test_signature_verifies():
+    tx = signed_tx()
+    signature = signature_of(tx)
+    assert signature[-1] == SIGHASH_ALL
+    sighash = OverwinterSignatureHash(CScript([PUBKEY, OP_CHECKSIG]), tx, 0, SIGHASH_ALL, AMOUNT,
+                                      SAPLING_BRANCH_ID)
+    assert verify(sighash, signature[:-1])
+
+
+def test_signature_commits_to_inputs():
+    # The sighash covers the amount, the branch id, the script code and the
+    # outputs: changing any of them breaks the signature
+    tx = signed_tx()
+    signature = signature_of(tx)[:-1]
+    script_code = CScript([PUBKEY, OP_CHECKSIG])
+    assert not verify(OverwinterSignatureHash(script_code, tx, 0, SIGHASH_ALL, AMOUNT + 1), signature)
+    assert not verify(OverwinterSignatureHash(script_code, tx, 0, SIGHASH_ALL, AMOUNT,
+                                              OVERWINTER_BRANCH_ID), signature)
+    assert not verify(OverwinterSignatureHash(CScript([OP_CHECKSIG]), tx, 0, SIGHASH_ALL, AMOUNT),
+                      signature)
+    tx.vout[0].nValue += 1
+    assert not verify(OverwinterSignatureHash(script_code, tx, 0, SIGHASH_ALL, AMOUNT), signature)
+
+
+def test_hash_types():
+    tx = signed_tx()
+    script_code = CScript([PUBKEY, OP_CHECKSIG])
+    hashes = set()
+    for hashtype in (SIGHASH_ALL, SIGHASH_NONE, SIGHASH_SINGLE):
+        for anyonecanpay in (0, SIGHASH_ANYONECANPAY):
+            sighash = OverwinterSignatureHash(script_code, tx, 0, hashtype | anyonecanpay, AMOUNT)
+            assert len(sighash) == 32
+            hashes.add(sighash)
+    assert len(hashes) == 6
+    # SIGHASH_NONE doesn't cover the outputs
+    none = OverwinterSignatureHash(script_code, tx, 0, SIGHASH_NONE, AMOUNT)
+    tx.vout[1].nValue -= 1
+    assert OverwinterSignatureHash(script_code, tx, 0, SIGHASH_NONE, AMOUNT) == none
+    # SIGHASH_SINGLE only covers the output of the same index
+    single = OverwinterSignatureHash(script_code, tx, 0, SIGHASH_SINGLE, AMOUNT)
+    tx.vout[1].nValue -= 1
+    assert OverwinterSignatureHash(script_code, tx, 0, SIGHASH_SINGLE, AMOUNT) == single
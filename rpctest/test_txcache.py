@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+# Copyright (c) 2020 SuperNET developers
+# Distributed under the MIT software license, see the accompanying
+# file COPYING or https://www.opensource.org/licenses/mit-license.php.
+
+import copy
+import os
+import pickle
+import sys
+
+# util.py imports coverage/authproxy as top level modules
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "test_framework"))
+
+from test_framework.mininode import (
+    COutPoint,
+    CTransaction,
+    CTxIn,
+    CTxInWitness,
+    CTxOut,
+    FromHex,
+    ToHex,
+)
+
+"""
+   Offline checks that the cached serializations and hashes of
+   CTransaction follow edits made inside its inputs, outputs and witness.
+   To run: "python3 -m pytest test_txcache.py" from rpctest directory
+"""
+
+
+def make_tx():
+    tx = CTransaction()
+    tx.vin.append(CTxIn(COutPoint(0x1234, 1), b"\x51", 0xffffffff))
+    tx.vout.append(CTxOut(100, b"\x51"))
+    tx.rehash()
+    return tx
+
+
+def reparse(tx):
+    return FromHex(CTransaction(), ToHex(tx))
+
+
+def test_vout_edit():
+    tx = make_tx()
+    serialized, txid = ToHex(tx), tx.hash
+    tx.vout[0].nValue = 200
+    assert ToHex(tx) != serialized
+    assert reparse(tx).vout[0].nValue == 200
+    assert tx.hash != txid
+    assert tx.hash == copy.deepcopy(tx).hash == reparse(tx).hash
+
+
+def test_vin_edits():
+    tx = make_tx()
+    tx.serialize()
+    tx.vin[0].prevout.n = 7
+    assert reparse(tx).vin[0].prevout.n == 7
+    tx.vin[0].prevout = COutPoint(0x5678, 2)
+    assert reparse(tx).vin[0].prevout.hash == 0x5678
+    tx.vin[0].scriptSig = b"\x00\x51"
+    tx.vin[0].nSequence = 5
+    parsed = reparse(tx)
+    assert parsed.vin[0].scriptSig == b"\x00\x51" and parsed.vin[0].nSequence == 5
+    assert tx.sha256 == parsed.sha256
+
+
+def test_witness_edits():
+    tx = make_tx()
+    tx.wit.vtxinwit = [CTxInWitness()]
+    without = tx.serialize_with_witness()
+    wtxid = tx.calc_sha256(True)
+    tx.wit.vtxinwit[0].scriptWitness.stack.append(b"\x01")
+    with_item = tx.serialize_with_witness()
+    assert with_item != without and tx.calc_sha256(True) != wtxid
+    tx.wit.vtxinwit[0].scriptWitness.stack = [b"\x02", b"\x03"]
+    parsed = FromHex(CTransaction(), tx.serialize_with_witness().hex())
+    assert parsed.wit.vtxinwit[0].scriptWitness.stack == [b"\x02", b"\x03"]
+    # The txid doesn't cover the witness
+    assert parsed.sha256 == tx.sha256
+
+
+def test_shared_element():
+    # An output in two transactions: editing it through one is seen by both
+    first = make_tx()
+    second = make_tx()
+    second.vout.append(first.vout[0])
+    first.serialize()
+    second.serialize()
+    first.vout[0].nValue = 300
+    assert reparse(first).vout[0].nValue == 300
+    assert reparse(second).vout[1].nValue == 300
+
+
+def test_copies_and_pickles():
+    tx = make_tx()
+    # A copy made after an edit inside the original has the new txid
+    tx.vin[0].nSequence = 7
+    copied = CTransaction(tx)
+    assert copied.serialize() == tx.serialize()
+    assert copied.hash == tx.hash == reparse(tx).hash
+    assert copied.sha256 == tx.sha256
+    clone = CTransaction(tx)
+    clone.vout[0].nValue = 400
+    assert reparse(tx).vout[0].nValue == 100
+    assert reparse(clone).vout[0].nValue == 400
+    restored = pickle.loads(pickle.dumps(clone))
+    assert restored.serialize() == clone.serialize()
+    restored.vin[0].prevout.n = 9
+    assert reparse(restored).vin[0].prevout.n == 9
+    assert reparse(clone).vin[0].prevout.n == 1